@@ -0,0 +1,208 @@
+# aio.py - asyncio 版本的聊天记录、在线列表、正在输入状态和消息发布队列（配合 socketio.AsyncServer）
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import LoopLagMonitor
+from pipeline import DEFAULT_PIPELINE_WORKERS, RoomPipeline, _Entry
+from presence import PresenceScheduler
+from typing_state import TypingAggregator
+
+logger = logging.getLogger('chat.pipeline')
+
+
+class AsyncEmitter:
+    """把 AsyncServer 包装成同步调度器使用的 socketio 接口
+
+    PresenceScheduler / TypingAggregator 在同步代码中调用 emit，
+    这里把发送放进事件循环的任务里，按调用顺序执行。
+    """
+
+    def __init__(self, sio):
+        self.sio = sio
+
+    def emit(self, event, data, **kwargs):
+        self.sio.start_background_task(self.sio.emit, event, data, **kwargs)
+
+    def start_background_task(self, target, *args, **kwargs):
+        return self.sio.start_background_task(target, *args, **kwargs)
+
+    async def sleep(self, seconds):
+        await self.sio.sleep(seconds)
+
+
+class AsyncPresenceScheduler(PresenceScheduler):
+    """在事件循环中等待合并窗口的在线列表调度器"""
+
+    def __init__(self, sio, roster, count, window):
+        super().__init__(AsyncEmitter(sio), roster, count, window)
+
+    async def _flush_later(self, room):
+        await self.socketio.sleep(self.window)
+        self.flush(room)
+
+
+class AsyncTypingAggregator(TypingAggregator):
+    """在事件循环中定时广播的正在输入状态"""
+
+    def __init__(self, sio, *args, **kwargs):
+        super().__init__(AsyncEmitter(sio), *args, **kwargs)
+
+    async def _flush_loop(self, room):
+        try:
+            while True:
+                await self.socketio.sleep(self.interval)
+                if not self.flush(room):
+                    return
+        finally:
+            self._scheduled.discard(room)
+
+
+class AsyncRoomHistory:
+    """RoomHistory 的 asyncio 接口
+
+    内存缓冲区的读写直接在事件循环中进行；需要读存储的操作
+    （第一次加载房间、分页查询更早的消息）放到单独的读线程中，
+    读线程只有一个，存储的读连接不会被并发使用。写入本来就在存储的后台线程中。
+    """
+
+    def __init__(self, history):
+        self.history = history
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history-reader')
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._reader, func, *args)
+
+    async def load(self, room):
+        """在读线程中加载房间的缓冲区，之后的 append / recent 只访问内存"""
+        if room not in self.history:
+            await self._run(self.history.__getitem__, room)
+
+    def append(self, room, message):
+        return self.history.append(room, message)
+
+    def recent(self, room, limit=None):
+        return self.history.recent(room, limit)
+
+    def version(self, room):
+        return self.history.version(room)
+
+    async def page(self, room, before=None, limit=50):
+        """同 RoomHistory.page，读存储的部分不阻塞事件循环"""
+        await self.load(room)
+        history = self.history
+        page = history.buffered(room, before, limit)
+        if len(page) < limit and history.store is not None:
+            oldest = page[0]['id'] if page else before
+            older = await self._run(history.store.load_before, room, oldest, limit - len(page))
+            if history.record is not None:
+                older = [history.record(message) for message in older]
+            page = older + page
+        return page
+
+    def close(self):
+        self._reader.shutdown(wait=False)
+
+
+class AsyncRoomPipeline(RoomPipeline):
+    """RoomPipeline 的 asyncio 版本
+
+    prepare 在线程池中执行，publish(result, error) 是协程，同一房间按提交顺序逐条等待。
+    """
+
+    def __init__(self, workers=DEFAULT_PIPELINE_WORKERS):
+        super().__init__(None, workers)
+        # 保留后台任务的引用，执行完之前不会被回收
+        self._tasks = set()
+
+    async def submit(self, room, publish, prepare=None, *args):
+        queue = self._rooms.get(room)
+        if prepare is None and not queue and room not in self._draining:
+            # 房间空闲，直接发布；等待发布期间到达的消息排队，由这里接着发布
+            self._draining.add(room)
+            try:
+                await publish(None, None)
+            finally:
+                await self._drain(room, owner=True)
+            return
+        entry = _Entry(publish)
+        if queue is None:
+            queue = self._rooms[room] = deque()
+        queue.append(entry)
+        if prepare is None:
+            entry.done = True
+        else:
+            task = asyncio.ensure_future(self._prepare(room, entry, prepare, args))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def wait(self, interval=0.01):
+        while self._rooms:
+            await asyncio.sleep(interval)
+
+    async def _prepare(self, room, entry, prepare, args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pipeline')
+        try:
+            entry.result = await asyncio.get_running_loop().run_in_executor(
+                self._executor, prepare, *args)
+        except Exception as e:
+            entry.error = e
+        entry.done = True
+        await self._drain(room)
+
+    async def _drain(self, room, owner=False):
+        if not owner:
+            if room in self._draining:
+                return
+            self._draining.add(room)
+        try:
+            queue = self._rooms.get(room)
+            while queue and queue[0].done:
+                entry = queue.popleft()
+                try:
+                    await entry.publish(entry.result, entry.error)
+                except Exception:
+                    logger.exception('消息发布失败')
+            if queue is not None and not queue:
+                del self._rooms[room]
+        finally:
+            self._draining.discard(room)
+
+
+class AsyncLoopLagMonitor(LoopLagMonitor):
+    """测量事件循环的调度延迟（同 LoopLagMonitor）"""
+
+    async def _run(self):
+        while self._running:
+            await self.sample()
+
+    async def sample(self):
+        start = self.clock()
+        await self.socketio.sleep(self.interval)
+        return self._record(start)
+
+
+class RequestStream:
+    """把 ASGI 请求体包装成阻塞读取的二进制流，在工作线程中使用
+
+    每次 read 在事件循环中等待下一块请求体，BlobStore.put_stream 边收边写入磁盘，
+    整个请求体不会留在内存里。客户端中途断开时抛出 ConnectionError。
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def read(self, size):
+        while not self._buffer and self._more:
+            message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('client disconnected')
+            self._buffer = message.get('body', b'')
+            self._more = message.get('more_body', False)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
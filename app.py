@@ -1,180 +1,350 @@
-from flask import Flask, render_template, request
-from flask_socketio import SocketIO, emit, join_room
-from datetime import datetime
-import uuid
-import base64
-import imghdr
-import html
+import logging
+import os
+
+# 多进程部署时的消息队列地址，例如 redis://localhost:6379/0 或
+# unix:///run/redis.sock；local://名称 使用进程内的队列（测试用）。
+# 不设置时为单进程模式
+MESSAGE_QUEUE = os.environ.get('CHAT_MESSAGE_QUEUE')
+if MESSAGE_QUEUE and not MESSAGE_QUEUE.startswith('local://'):
+    # Redis 客户端是阻塞的，需要在导入其他模块前打补丁
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, stream_template, request, jsonify, send_file, abort
+from flask_socketio import SocketIO, emit, join_room, leave_room
+from markupsafe import Markup
+
+from records import ChatMessage, UserInfo
+from history import RoomHistory, DEFAULT_HISTORY_SIZE
+from presence import PresenceScheduler, DEFAULT_PRESENCE_WINDOW
+from typing_state import TypingAggregator, DEFAULT_TYPING_INTERVAL
+from ratelimit import RateLimiter
+from chatlog import setup_logging, log_event
+from blobstore import BlobStore, BlobTooLarge
+import images
+from images import ImageProcessor, ImageRejected
+from broadcast import broadcast
+from pipeline import RoomPipeline
+from cluster import StateReplicator, create_broker, create_client_manager
+from codec import CodecNegotiator
+import compression
+from chatcore import (ChatError, ChatMetrics, ChatState, create_history_store, public_user,
+                      set_image, user_joined_event, user_left_event, validate_image_data,
+                      ROOM_HISTORY_SIZES, RATE_LIMITS, RATE_LIMIT_ENABLED, LOG_LEVEL, LOG_JSON,
+                      LOG_SAMPLING, INITIAL_HISTORY_SIZE, MAX_IMAGE_SIZE, UPLOAD_FOLDER,
+                      IMAGE_CACHE_MAX_AGE, IMAGE_WORKERS, MESSAGE_PIPELINE_WORKERS)
 
 app = Flask(__name__)
 app.secret_key = 'simple_chat_secret_key'
 
-# 配置 SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+# 配置 SocketIO（多进程部署时通过消息队列互相转发广播）
+socketio_options = {'cors_allowed_origins': '*'}
+if MESSAGE_QUEUE:
+    socketio_options['client_manager'] = create_client_manager(MESSAGE_QUEUE)
+socketio = SocketIO(app, **socketio_options)
 
-# 存储在线用户和消息（内存中）
-online_users = {}
-chat_messages = []
+# 设置 CHAT_MSGPACK=1 时，支持的客户端改用 MessagePack（需要安装 msgpack），
+# 其他客户端继续使用 JSON
+MSGPACK_ENABLED = os.environ.get('CHAT_MSGPACK') == '1'
+if MSGPACK_ENABLED:
+    CodecNegotiator(socketio.server)
 
-ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+# WebSocket permessage-deflate 压缩（CHAT_WS_COMPRESSION=0 关闭）：
+# 小于阈值（字节）的帧直接发送；内存紧张时可以关闭上下文接管或减小窗口
+WS_COMPRESSION = compression.DeflateOptions(
+    enabled=os.environ.get('CHAT_WS_COMPRESSION', '1') != '0',
+    threshold=int(os.environ.get('CHAT_WS_COMPRESSION_THRESHOLD', 256)),
+    context_takeover=os.environ.get('CHAT_WS_CONTEXT_TAKEOVER', '1') != '0',
+    window_bits=int(os.environ.get('CHAT_WS_WINDOW_BITS', 15)))
+compression_stats = compression.CompressionStats()
+compression.install(socketio.server, WS_COMPRESSION, compression_stats)
 
-def validate_image_data(image_data):
-    """验证图片数据"""
-    try:
-        # 检查是否是base64编码的图片
-        if not image_data.startswith('data:image/'):
-            return False
-        
-        # 提取图片格式
-        format_part = image_data.split(',')[0]
-        if 'image/' not in format_part:
-            return False
-            
-        # 提取base64数据
-        base64_data = image_data.split(',')[1]
-        decoded_data = base64.b64decode(base64_data)
-        
-        # 检查文件大小 (限制为5MB)
-        if len(decoded_data) > 100 * 1024 * 1024:
-            return False
-            
-        # 检查图片格式
-        image_type = imghdr.what(None, decoded_data)
-        if image_type not in ALLOWED_IMAGE_EXTENSIONS:
-            return False
-            
-        return True
-    except Exception:
-        return False
+# 在线列表合并广播的窗口（秒），0 表示每次变化立即广播
+PRESENCE_BROADCAST_WINDOW = DEFAULT_PRESENCE_WINDOW
+
+# 正在输入状态的广播间隔（秒），0 表示每次变化立即广播
+TYPING_BROADCAST_INTERVAL = DEFAULT_TYPING_INTERVAL
+
+# 其他配置（限流、日志、聊天记录、图片）与 asgi_app.py 共用，见 chatcore.py
+rate_limiter = RateLimiter(RATE_LIMITS)
+rate_limiter.enabled = RATE_LIMIT_ENABLED
+setup_logging(LOG_LEVEL, LOG_JSON, LOG_SAMPLING)
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_IMAGE_SIZE
+
+chat_messages = RoomHistory(DEFAULT_HISTORY_SIZE, ROOM_HISTORY_SIZES,
+                            store=create_history_store(MESSAGE_QUEUE), record=ChatMessage.from_dict)
+image_store = BlobStore(UPLOAD_FOLDER)
+image_processor = ImageProcessor(IMAGE_WORKERS, async_mode=socketio.async_mode)
+
+
+def replicate(op, **data):
+    """多进程部署时把状态变化同步给其他工作进程"""
+    if replicator is not None:
+        replicator.publish(op, **data)
+
+
+# 在线用户和房间成员索引（内存中）；image_store 在调用时再取，测试可以替换
+chat = ChatState(chat_messages, rate_limiter, lambda digest: image_store.meta(digest), replicate)
+online_users = chat.online_users
+room_members = chat.room_members
+room_roster = chat.room_roster
+room_size = chat.room_size
+remove_room_member = chat.remove_room_member
+
+# 在线列表广播调度（按房间合并窗口内的加入/离开，发送增量）
+presence = chat.presence = PresenceScheduler(socketio, room_roster, room_size,
+                                             PRESENCE_BROADCAST_WINDOW)
+
+# 正在输入状态（按房间汇总，定时广播 users_typing）
+typing_indicator = chat.typing = TypingAggregator(socketio, TYPING_BROADCAST_INTERVAL)
+
+message_pipeline = RoomPipeline(socketio, MESSAGE_PIPELINE_WORKERS)
+
+# 运行指标，GET /metrics 以 Prometheus 文本格式输出
+chat_metrics = ChatMetrics(socketio, socketio.server, chat, chat_messages, message_pipeline)
+registry = chat_metrics.registry
+event_latency = chat_metrics.event_latency
+room_messages = chat_metrics.room_messages
+room_bytes = chat_metrics.room_bytes
+broadcast_fanout = chat_metrics.broadcast_fanout
+slow_handlers = chat_metrics.slow_handlers
+loop_monitor = chat_metrics.loop_monitor
+registry.callback('chat_ws_compressed_frames_total', '压缩发送的 WebSocket 帧数',
+                  lambda: compression_stats.compressed_frames, type='counter')
+registry.callback('chat_ws_compressed_in_bytes_total', '压缩前的字节数',
+                  lambda: compression_stats.compressed_in, type='counter')
+registry.callback('chat_ws_compressed_out_bytes_total', '压缩后实际发送的字节数',
+                  lambda: compression_stats.compressed_out, type='counter')
+registry.callback('chat_ws_uncompressed_frames_total', '小于阈值没有压缩的 WebSocket 帧数',
+                  lambda: compression_stats.skipped_frames, type='counter')
 
 @app.route('/')
 def index():
-    return render_template('index.html', messages=chat_messages)
+    # 流式输出：先发送页面框架，渲染到消息列表时才取最近的消息
+    room = 'general'
+    return stream_template('index.html', room=room, history=lambda: render_history(room),
+                           msgpack=MSGPACK_ENABLED)
+
+# 渲染好的最近消息 {room: (版本号, HTML)}，房间有新消息时版本号变化
+history_html_cache = {}
+
+def render_history(room):
+    """房间最近 INITIAL_HISTORY_SIZE 条消息的 HTML（按版本号缓存）"""
+    version = chat_messages.version(room)
+    cached = history_html_cache.get(room)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    messages = chat_messages.recent(room, INITIAL_HISTORY_SIZE)
+    # 不依赖请求上下文，缓存的结果可以给所有请求共用
+    template = app.jinja_env.get_template('messages.html')
+    html_text = Markup(template.render(messages=messages,
+                                       has_more=len(messages) == INITIAL_HISTORY_SIZE))
+    history_html_cache[room] = (version, html_text)
+    return html_text
+
+@app.route('/upload', methods=['POST'])
+def upload_image():
+    """上传图片，请求体为图片的二进制内容，返回图片引用"""
+    if request.content_length is not None and request.content_length > MAX_IMAGE_SIZE:
+        return jsonify({'error': 'too large'}), 413
+    
+    try:
+        ref = store_image(request.stream)
+    except BlobTooLarge:
+        return jsonify({'error': 'too large'}), 413
+    except ImageRejected:
+        return jsonify({'error': 'invalid image'}), 400
+    return jsonify(ref)
+
+def store_image(stream):
+    """把图片存入图片存储，返回图片引用（见 images.store_image）"""
+    return images.store_image(image_store, image_processor, stream, MAX_IMAGE_SIZE)
+
+@app.route('/images/<digest>')
+def serve_image(digest):
+    """按哈希返回上传的图片
+
+    哈希同时作为强 ETag，支持 If-None-Match（304）和 Range 请求。
+    部署在反向代理后面时可以打开 USE_X_SENDFILE，由代理直接发送文件。
+    """
+    meta = image_store.meta(digest)
+    if meta is None:
+        abort(404)
+    response = send_file(image_store.path(digest), mimetype=meta['mime'],
+                         etag=digest, conditional=True, max_age=IMAGE_CACHE_MAX_AGE)
+    # 按内容寻址的文件永远不会改变
+    response.cache_control.immutable = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    return response
 
 @socketio.on('connect')
 def handle_connect():
-    print('用户连接成功')
+    # 第一个连接到来时开始测量调度延迟
+    loop_monitor.start()
+    log_event('connect', logging.DEBUG, sid=request.sid)
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    if request.sid in online_users:
-        user_info = online_users[request.sid]
-        username = user_info['username']
-        room = user_info.get('room', 'general')
-        
-        # 移除用户
-        del online_users[request.sid]
-        
-        # 通知其他用户有用户离开
-        emit('user_left', {
-            'username': username,
-            'message': f'{username} 離開了聊天室',
-            'time': datetime.now().strftime('%H:%M:%S')
-        }, room=room)
-        
-        # 广播更新的在线用户列表
-        broadcast_online_users(room)
-        
-        print(f'{username} 离开了房间 {room}')
-    else:
-        print('用户断开连接')
+    user_info = chat.disconnect(request.sid)
+    if user_info is None:
+        log_event('disconnect', logging.DEBUG, sid=request.sid)
+        return
+    # 通知其他用户有用户离开
+    emit('user_left', user_left_event(user_info['username']), room=user_info.get('room', 'general'))
 
+def rate_limited(event):
+    """当前连接的事件超出限流时返回 True（事件应该丢弃）"""
+    try:
+        return not chat.allow(request.sid, event)
+    except ChatError as e:
+        emit('error', {'message': str(e)})
+        return True
 
 @socketio.on('join')
 def handle_join(data):
-    username = data['username']
-    room = data.get('room', 'general')
-    
-    # 生成用户ID
-    user_id = str(uuid.uuid4())[:8]
-    online_users[request.sid] = {
-        'username': username,
-        'user_id': user_id,
-        'room': room
-    }
-    
+    if rate_limited('join'):
+        return
+    user_info, previous_room = chat.join(request.sid, data)
+    room = user_info['room']
+    if previous_room is not None and previous_room != room:
+        leave_room(previous_room)
     join_room(room)
     
     # 通知其他用户有新用户加入
-    emit('user_joined', {
-        'username': username,
-        'message': f'{username} 加入了聊天室',
-        'time': datetime.now().strftime('%H:%M:%S')
-    }, room=room)
-    broadcast_online_users(room)
-    print(f'{username} 加入了房间 {room}')
-
-def broadcast_online_users(room):
-    """广播在线用户列表"""
-    users_in_room = []
-    for sid, user_info in online_users.items():
-        if user_info.get('room') == room:
-            users_in_room.append({
-                'username': user_info['username'],
-                'user_id': user_info['user_id']
-            })
-    
-    socketio.emit('online_users_update', {
-        'users': users_in_room,
-        'count': len(users_in_room)
-    }, room=room)
+    emit('user_joined', user_joined_event(user_info['username']), room=room)
+    # 新加入的用户直接拿到完整列表，之后只接收增量
+    emit('online_users_update', presence.snapshot(room))
 
-@socketio.on('send_message')
-def handle_message(data):
+def apply_remote_join(message):
+    """其他工作进程上有用户加入"""
+    room, sid = message['room'], message['sid']
+    members = room_members.setdefault(room, {})
+    if sid in members:
+        return
+    user_info = members[sid] = UserInfo.from_dict(message['user'])
+    presence.user_joined(room, public_user(user_info))
+
+def apply_remote_leave(message):
+    """其他工作进程上有用户离开"""
+    room, sid = message['room'], message['sid']
+    user_info = room_members.get(room, {}).get(sid)
+    if user_info is None:
+        return
+    remove_room_member(room, sid)
+    presence.user_left(room, public_user(user_info))
+    typing_indicator.user_left(room, public_user(user_info))
+
+def apply_remote_message(message):
+    """其他工作进程收到的聊天消息（发送方已经写入数据库）"""
+    chat_messages.append(message['room'], message['message'], persist=False)
+    typing_indicator.user_left(message['room'], {
+        'username': message['message']['username'],
+        'user_id': message['message']['user_id']
+    })
+
+def apply_remote_typing(message):
+    """其他工作进程上的用户正在输入"""
+    typing_indicator.update(message['room'], message['user'], message['is_typing'])
+
+def share_local_members(message):
+    """新的工作进程启动时，把本进程的在线用户发给它"""
+    replicate('members', members=[
+        (user_info.get('room', 'general'), sid, user_info.to_dict())
+        for sid, user_info in online_users.items()
+    ])
+
+def apply_remote_members(message):
+    for room, sid, user_info in message['members']:
+        apply_remote_join({'room': room, 'sid': sid, 'user': user_info})
+
+# 工作进程之间的状态同步（单进程模式下为 None）
+replicator = None
+if MESSAGE_QUEUE:
+    broker = create_broker(MESSAGE_QUEUE)
+    replicator = StateReplicator(broker)
+    # 消息 id 从消息队列上的共享计数器分配，各进程之间不会重复，可以作为分页游标
+    chat_messages.ids = lambda room, floor: broker.next_id(f'chat-message-id:{room}', floor)
+    replicator.on('join', apply_remote_join)
+    replicator.on('leave', apply_remote_leave)
+    replicator.on('message', apply_remote_message)
+    replicator.on('typing', apply_remote_typing)
+    replicator.on('hello', share_local_members)
+    replicator.on('members', apply_remote_members)
+    replicator.start(socketio)
+    # 向已经在运行的工作进程要在线用户
+    replicator.publish('hello')
+
+@socketio.on('request_online_users')
+def handle_request_online_users():
+    """客户端发现版本号不连续时请求完整列表"""
     if request.sid not in online_users:
         return
-    
-    user_info = online_users[request.sid]
-    username = user_info['username']
-    room = user_info.get('room', 'general')
-    message = data.get('message', '')
-    message_type = data.get('type', 'text')  # 'text' 或 'image'
-
-    MAX_MESSAGE_LENGTH = 500
-    if message_type == 'text' and len(message) > MAX_MESSAGE_LENGTH:
-        emit('error', {'message': f'消息太长，最多{MAX_MESSAGE_LENGTH}字符'})
+    room = online_users[request.sid].get('room', 'general')
+    emit('online_users_update', presence.snapshot(room))
+
+@socketio.on('load_history')
+def handle_load_history(data):
+    """按游标分页加载聊天记录：before 是已有的最早一条消息的 id，不传时从最新开始"""
+    if request.sid not in online_users:
         return
+    try:
+        room, before, limit = chat.history_request(request.sid, data)
+    except ChatError as e:
+        emit('error', {'message': str(e)})
+        return
+    emit('history_page', chat.history_page(room, before, limit,
+                                           chat_messages.page(room, before, limit)))
 
-    if message_type == 'text':
-        message = html.escape(message) 
-    # 创建消息对象
-    msg_data = {
-        'username': username,
-        'message': message,
-        'type': message_type,
-        'time': datetime.now().strftime('%H:%M:%S'),
-        'user_id': user_info['user_id']
-    }
+@socketio.on('send_message')
+def handle_message(data):
+    if request.sid not in online_users or rate_limited('send_message'):
+        return
+    try:
+        user_info, room, msg, reader = chat.new_message(request.sid, data)
+    except ChatError as e:
+        emit('error', {'message': str(e)})
+        return
     
-    # 如果是图片消息，验证图片数据
-    if message_type == 'image':
-        if not validate_image_data(message):
-            emit('error', {'message': 'too large'})
+    sid = request.sid
+
+    def publish(result, error):
+        if isinstance(error, (BlobTooLarge, ImageRejected)):
+            socketio.emit('error', {'message': 'invalid image'}, to=sid)
             return
-        print(f'{username} 发送了一张图片')
+        if error is not None:
+            raise error
+        if result is not None:
+            set_image(msg, result)
+        publish_message(room, user_info, msg)
+
+    # 同一房间的消息按发送顺序发布，前面的图片还在处理时后面的消息排队等待；
+    # data URL 图片的解码和保存在工作线程中进行
+    if reader is None:
+        message_pipeline.submit(room, publish)
     else:
-        print(f'{username}: {message}')
-    
-    # 存储消息（最多保留100条）
-    chat_messages.append(msg_data)
-    if(len(chat_messages) > 100):
-        chat_messages.pop(0)
-    
-    # 广播消息给房间内所有用户
-    emit('receive_message', msg_data, room=room)
+        message_pipeline.submit(room, publish, store_image, reader)
+
+def publish_message(room, user_info, msg):
+    """保存并广播一条消息"""
+    msg_data = chat.publish(room, user_info, msg)
+    # 广播消息给房间内所有用户（只编码一次）
+    chat_metrics.message_sent(room, broadcast(socketio, 'receive_message', msg_data, room))
 
 @socketio.on('typing')
 def handle_typing(data):
-    if request.sid not in online_users:
+    if request.sid not in online_users or rate_limited('typing'):
         return
-        
-    user_info = online_users[request.sid]
-    room = user_info.get('room', 'general')
-    
-    emit('user_typing', {
-        'username': user_info['username'],
-        'is_typing': data['is_typing']
-    }, room=room, include_self=False)
+    # 不再逐条转发：记录状态，按房间合并后定时广播，超时没有更新自动过期
+    chat.update_typing(request.sid, data)
+
+@app.route('/metrics')
+def metrics_page():
+    """Prometheus 文本格式的运行指标"""
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# 所有事件处理函数都已注册，加上计时和慢处理检测
+chat_metrics.instrument(socketio.server)
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
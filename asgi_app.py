@@ -0,0 +1,345 @@
+# asgi_app.py - asyncio 入口：在 socketio.AsyncServer 上运行聊天室（ASGI）
+#
+# 不使用 eventlet，也不打猴子补丁，可以用任何 asyncio 库。运行方式（需要安装 uvicorn）：
+#     uvicorn asgi_app:app --host 0.0.0.0 --port 5000 --loop uvloop
+#
+# 聊天逻辑和配置与 app.py 共用（chatcore.py），这里只负责收发事件和 HTTP。
+# 没有实现的部分：多进程消息队列、MessagePack 协商、WebSocket 压缩。
+import asyncio
+import json
+import logging
+import os
+
+import socketio
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from markupsafe import Markup
+
+import images
+from aio import (AsyncLoopLagMonitor, AsyncPresenceScheduler, AsyncRoomHistory, AsyncRoomPipeline,
+                 AsyncTypingAggregator, RequestStream)
+from blobstore import BlobStore, BlobTooLarge, CHUNK_SIZE
+from broadcast import async_broadcast
+from chatcore import (ChatError, ChatMetrics, ChatState, create_history_store, set_image,
+                      user_joined_event, user_left_event, BASE_DIR, ROOM_HISTORY_SIZES,
+                      RATE_LIMITS, RATE_LIMIT_ENABLED, LOG_LEVEL, LOG_JSON, LOG_SAMPLING,
+                      INITIAL_HISTORY_SIZE, MAX_IMAGE_SIZE, UPLOAD_FOLDER, IMAGE_CACHE_MAX_AGE,
+                      IMAGE_WORKERS, MESSAGE_PIPELINE_WORKERS)
+from chatlog import setup_logging, log_event
+from history import RoomHistory, DEFAULT_HISTORY_SIZE
+from images import ImageProcessor, ImageRejected
+from presence import DEFAULT_PRESENCE_WINDOW
+from ratelimit import RateLimiter
+from records import ChatMessage
+from typing_state import DEFAULT_TYPING_INTERVAL
+
+PRESENCE_BROADCAST_WINDOW = DEFAULT_PRESENCE_WINDOW
+TYPING_BROADCAST_INTERVAL = DEFAULT_TYPING_INTERVAL
+
+setup_logging(LOG_LEVEL, LOG_JSON, LOG_SAMPLING)
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
+
+chat_messages = AsyncRoomHistory(RoomHistory(DEFAULT_HISTORY_SIZE, ROOM_HISTORY_SIZES,
+                                             store=create_history_store(),
+                                             record=ChatMessage.from_dict))
+rate_limiter = RateLimiter(RATE_LIMITS)
+rate_limiter.enabled = RATE_LIMIT_ENABLED
+image_store = BlobStore(UPLOAD_FOLDER)
+image_processor = ImageProcessor(IMAGE_WORKERS)
+
+chat = ChatState(chat_messages, rate_limiter, lambda digest: image_store.meta(digest))
+online_users = chat.online_users
+room_members = chat.room_members
+presence = chat.presence = AsyncPresenceScheduler(sio, chat.room_roster, chat.room_size,
+                                                  PRESENCE_BROADCAST_WINDOW)
+typing_indicator = chat.typing = AsyncTypingAggregator(sio, TYPING_BROADCAST_INTERVAL)
+message_pipeline = AsyncRoomPipeline(MESSAGE_PIPELINE_WORKERS)
+
+chat_metrics = ChatMetrics(sio, sio, chat, chat_messages.history, message_pipeline,
+                           loop_monitor=AsyncLoopLagMonitor)
+
+templates = Environment(loader=FileSystemLoader(os.path.join(BASE_DIR, 'templates')),
+                        autoescape=select_autoescape(['html']))
+
+
+async def error(sid, e):
+    await sio.emit('error', {'message': str(e)}, to=sid)
+
+
+async def rate_limited(sid, event):
+    """连接的事件超出限流时返回 True（事件应该丢弃）"""
+    try:
+        return not chat.allow(sid, event)
+    except ChatError as e:
+        await error(sid, e)
+        return True
+
+
+def store_image(stream):
+    """把图片存入图片存储，返回图片引用（阻塞，在线程中调用）"""
+    return images.store_image(image_store, image_processor, stream, MAX_IMAGE_SIZE)
+
+
+@sio.event
+async def connect(sid, environ):
+    # 第一个连接到来时开始测量调度延迟
+    chat_metrics.loop_monitor.start()
+    log_event('connect', logging.DEBUG, sid=sid)
+
+
+@sio.event
+async def disconnect(sid):
+    user_info = chat.disconnect(sid)
+    if user_info is None:
+        log_event('disconnect', logging.DEBUG, sid=sid)
+        return
+    await sio.emit('user_left', user_left_event(user_info['username']),
+                   room=user_info.get('room', 'general'))
+
+
+@sio.event
+async def join(sid, data):
+    if await rate_limited(sid, 'join'):
+        return
+    user_info, previous_room = chat.join(sid, data)
+    room = user_info['room']
+    if previous_room is not None and previous_room != room:
+        sio.leave_room(sid, previous_room)
+    sio.enter_room(sid, room)
+    # 发消息前先把房间的记录加载到内存，之后的追加不再读存储
+    await chat_messages.load(room)
+
+    await sio.emit('user_joined', user_joined_event(user_info['username']), room=room)
+    await sio.emit('online_users_update', presence.snapshot(room), to=sid)
+
+
+@sio.event
+async def request_online_users(sid):
+    room = chat.room_of(sid)
+    if room is not None:
+        await sio.emit('online_users_update', presence.snapshot(room), to=sid)
+
+
+@sio.event
+async def load_history(sid, data):
+    """按游标分页加载聊天记录（同 app.handle_load_history）"""
+    if sid not in online_users:
+        return
+    try:
+        room, before, limit = chat.history_request(sid, data)
+    except ChatError as e:
+        await error(sid, e)
+        return
+    messages = await chat_messages.page(room, before, limit)
+    await sio.emit('history_page', chat.history_page(room, before, limit, messages), to=sid)
+
+
+@sio.event
+async def send_message(sid, data):
+    if sid not in online_users or await rate_limited(sid, 'send_message'):
+        return
+    try:
+        user_info, room, msg, reader = chat.new_message(sid, data)
+    except ChatError as e:
+        await error(sid, e)
+        return
+    await chat_messages.load(room)
+
+    async def publish(result, e):
+        if isinstance(e, (BlobTooLarge, ImageRejected)):
+            await error(sid, 'invalid image')
+            return
+        if e is not None:
+            raise e
+        if result is not None:
+            set_image(msg, result)
+        msg_data = chat.publish(room, user_info, msg)
+        chat_metrics.message_sent(room, await async_broadcast(sio, 'receive_message', msg_data, room))
+
+    # 同一房间的消息按发送顺序发布；data URL 图片在线程池中解码和保存
+    if reader is None:
+        await message_pipeline.submit(room, publish)
+    else:
+        await message_pipeline.submit(room, publish, store_image, reader)
+
+
+@sio.event
+async def typing(sid, data):
+    if sid not in online_users or await rate_limited(sid, 'typing'):
+        return
+    chat.update_typing(sid, data)
+
+
+# 所有事件处理函数都已注册，加上计时和慢处理检测
+chat_metrics.instrument(sio)
+
+# 渲染好的最近消息 {room: (版本号, HTML)}
+history_html_cache = {}
+
+
+def render_history(room):
+    """房间最近 INITIAL_HISTORY_SIZE 条消息的 HTML（按版本号缓存，房间需要已经加载）"""
+    version = chat_messages.version(room)
+    cached = history_html_cache.get(room)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    messages = chat_messages.recent(room, INITIAL_HISTORY_SIZE)
+    html_text = Markup(templates.get_template('messages.html').render(
+        messages=messages, has_more=len(messages) == INITIAL_HISTORY_SIZE))
+    history_html_cache[room] = (version, html_text)
+    return html_text
+
+
+async def respond(send, status, body=b'', content_type='text/plain; charset=utf-8',
+                  headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode()),
+                    (b'content-length', str(len(body)).encode())] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def respond_json(send, status, data):
+    await respond(send, status, json.dumps(data).encode(), 'application/json')
+
+
+def byte_range(header, size):
+    """解析 Range 请求头，返回 [start, end)
+
+    只支持单个范围（bytes=a-b、bytes=a-、bytes=-n），没有或不支持时返回 None，
+    范围超出文件时抛出 ValueError。
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    first, _, last = header[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            start, end = max(size - int(last), 0), size
+    except ValueError:
+        return None
+    end = min(end, size)
+    if start >= end:
+        raise ValueError(header)
+    return start, end
+
+
+async def index(scope, receive, send):
+    room = 'general'
+    await chat_messages.load(room)
+    page = templates.get_template('index.html').render(
+        room=room, history=lambda: render_history(room), msgpack=False)
+    await respond(send, 200, page.encode(), 'text/html; charset=utf-8')
+
+
+async def upload_image(scope, receive, send):
+    """上传图片，请求体为图片的二进制内容，返回图片引用"""
+    length = dict(scope['headers']).get(b'content-length', b'')
+    if length.isdigit() and int(length) > MAX_IMAGE_SIZE:
+        await respond_json(send, 413, {'error': 'too large'})
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        # 存储和转码是阻塞的，放到线程中执行；请求体边收边写入磁盘
+        ref = await loop.run_in_executor(None, store_image, RequestStream(receive, loop))
+    except BlobTooLarge:
+        await respond_json(send, 413, {'error': 'too large'})
+        return
+    except ImageRejected:
+        await respond_json(send, 400, {'error': 'invalid image'})
+        return
+    except ConnectionError:
+        # 客户端已经断开，不需要响应
+        return
+    await respond_json(send, 200, ref)
+
+
+async def serve_image(scope, receive, send, digest):
+    """按哈希返回上传的图片
+
+    哈希同时作为强 ETag，支持 If-None-Match（304）和单个范围的 Range 请求（206）。
+    文件在线程中按块读取、逐块发送，不整个读进内存。
+    """
+    meta = image_store.meta(digest)
+    if meta is None:
+        await respond(send, 404, b'Not Found')
+        return
+    request_headers = dict(scope['headers'])
+    etag = f'"{digest}"'.encode()
+    headers = [
+        (b'etag', etag),
+        (b'accept-ranges', b'bytes'),
+        (b'cache-control', f'public, max-age={IMAGE_CACHE_MAX_AGE}, immutable'.encode()),
+        (b'x-content-type-options', b'nosniff')
+    ]
+    if request_headers.get(b'if-none-match') == etag:
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    loop = asyncio.get_running_loop()
+    try:
+        f = await loop.run_in_executor(None, open, image_store.path(digest), 'rb')
+    except FileNotFoundError:
+        await respond(send, 404, b'Not Found')
+        return
+    try:
+        size = os.fstat(f.fileno()).st_size
+        status, start, end = 200, 0, size
+        # If-Range 与 ETag 不一致时忽略 Range，返回整个文件
+        if_range = request_headers.get(b'if-range')
+        if if_range is None or if_range == etag:
+            try:
+                requested = byte_range(request_headers.get(b'range', b'').decode('latin-1'), size)
+            except ValueError:
+                await respond(send, 416, headers=[(b'content-range', f'bytes */{size}'.encode())])
+                return
+            if requested is not None:
+                status, (start, end) = 206, requested
+                headers.append((b'content-range', f'bytes {start}-{end - 1}/{size}'.encode()))
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(b'content-type', meta['mime'].encode()),
+                        (b'content-length', str(end - start).encode())] + headers
+        })
+        if start:
+            f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await loop.run_in_executor(None, f.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        f.close()
+
+
+async def http_app(scope, receive, send):
+    """Socket.IO 和静态文件以外的 HTTP 请求"""
+    if scope['type'] != 'http':
+        return
+    path, method = scope['path'], scope['method']
+    if path == '/' and method == 'GET':
+        await index(scope, receive, send)
+    elif path == '/upload' and method == 'POST':
+        await upload_image(scope, receive, send)
+    elif path.startswith('/images/') and method == 'GET':
+        await serve_image(scope, receive, send, path[len('/images/'):])
+    elif path == '/metrics' and method == 'GET':
+        await respond(send, 200, chat_metrics.render().encode(),
+                      'text/plain; version=0.0.4; charset=utf-8')
+    else:
+        await respond(send, 404, b'Not Found')
+
+
+app = socketio.ASGIApp(sio, other_asgi_app=http_app,
+                       static_files={'/static': os.path.join(BASE_DIR, 'static')},
+                       on_shutdown=chat_messages.close)
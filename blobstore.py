@@ -0,0 +1,127 @@
+# blobstore.py - 本地磁盘上按内容寻址的文件存储
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+# 每次从请求体读取的块大小
+CHUNK_SIZE = 64 * 1024
+
+_DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class BlobTooLarge(Exception):
+    """写入的数据超过大小限制"""
+
+
+def new_hasher():
+    """内容哈希（BLAKE2b，16 字节摘要）"""
+    return hashlib.blake2b(digest_size=16)
+
+
+class BlobStore:
+    """按内容哈希保存文件，相同内容只保存一份
+
+    文件放在 root/<前两位>/<哈希> 下，元数据（MIME、尺寸等）
+    放在同名的 .json 文件里。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._meta = {}
+        # 原始内容哈希 -> 保存的文件哈希
+        self._aliases = {}
+
+    def path(self, digest):
+        """哈希对应的文件路径，不合法的哈希返回 None"""
+        if not _DIGEST_RE.match(digest or ''):
+            return None
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        path = self.path(digest)
+        return path is not None and os.path.exists(path)
+
+    def put_stream(self, stream, max_size):
+        """把流写入临时文件，边写边计算哈希
+
+        返回 (digest, size, temp_path)，调用方检查内容后用 commit()
+        放入存储或用 discard() 丢弃。超过 max_size 时抛出 BlobTooLarge。
+        """
+        os.makedirs(self.root, exist_ok=True)
+        hasher = new_hasher()
+        size = 0
+        fd, temp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_size:
+                        raise BlobTooLarge(size)
+                    hasher.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            self.discard(temp_path)
+            raise
+        return hasher.hexdigest(), size, temp_path
+
+    def commit(self, digest, temp_path, meta):
+        """把临时文件移动到哈希路径，已存在相同内容时直接丢弃临时文件"""
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.discard(temp_path)
+            return self.meta(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.json', 'w') as f:
+            json.dump(meta, f)
+        os.replace(temp_path, path)
+        self._meta[digest] = meta
+        return meta
+
+    def discard(self, temp_path):
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    def link(self, source, digest):
+        """记录原始内容哈希对应的文件（例如转码前后的图片）"""
+        path = self.path(source)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.ref', 'w') as f:
+            f.write(digest)
+        self._aliases[source] = digest
+
+    def resolve(self, source):
+        """原始内容哈希对应的文件哈希，没有记录时返回 None"""
+        digest = self._aliases.get(source)
+        if digest is None:
+            path = self.path(source)
+            if path is None:
+                return None
+            try:
+                with open(path + '.ref') as f:
+                    digest = f.read().strip()
+            except OSError:
+                return None
+            self._aliases[source] = digest
+        return digest if self.exists(digest) else None
+
+    def meta(self, digest):
+        """文件元数据，不存在时返回 None"""
+        meta = self._meta.get(digest)
+        if meta is None:
+            path = self.path(digest)
+            if path is None:
+                return None
+            try:
+                with open(path + '.json') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self._meta[digest] = meta
+        return meta
@@ -0,0 +1,103 @@
+# broadcast.py - 房间广播：消息只编码一次，所有成员共用同一个数据包
+import socketio
+from engineio import packet as eio_packet
+from socketio import packet
+from socketio.asyncio_pubsub_manager import AsyncPubSubManager
+
+
+def encode_event(event, data, namespace='/', packet_class=packet.Packet):
+    """把事件编码成 Engine.IO 数据包，编码结果缓存在数据包里"""
+    pkt = packet_class(packet.EVENT, data=[event, data], namespace=namespace)
+    eio_pkt = eio_packet.Packet(eio_packet.MESSAGE, data=pkt.encode())
+    if not eio_pkt.binary:
+        # 文本数据包第一次 encode() 后会缓存结果，之后每个连接直接复用
+        eio_pkt.encode()
+    return eio_pkt
+
+
+def _room_packets(server, event, data, room, namespace, skip_sid):
+    """房间内每个接收者的 (eio_sid, Engine.IO 数据包)，每种格式只编码一次"""
+    codecs = getattr(server, 'codecs', None)
+    # {是否使用 MessagePack: 编码好的数据包}
+    encoded = {}
+    for sid, eio_sid in server.manager.get_participants(namespace, room):
+        if sid == skip_sid:
+            continue
+        binary = codecs is not None and codecs.uses_msgpack(eio_sid)
+        eio_pkt = encoded.get(binary)
+        if eio_pkt is None:
+            packet_class = codecs.msgpack_class if binary else packet.Packet
+            eio_pkt = encoded[binary] = encode_event(event, data, namespace, packet_class)
+        if eio_pkt.binary:
+            # 二进制数据包的编码缓存不区分长轮询（base64）和 WebSocket，
+            # 每个连接单独包一层，共用编码好的 MessagePack 数据
+            yield eio_sid, eio_packet.Packet(eio_packet.MESSAGE, data=eio_pkt.data)
+        else:
+            yield eio_sid, eio_pkt
+
+
+def packet_size(eio_pkt):
+    """数据包正文的字节数（不含传输层的帧头）"""
+    data = eio_pkt.data
+    if isinstance(data, str):
+        return len(data.encode('utf-8'))
+    return len(data)
+
+
+class _Fanout:
+    """统计一次广播的接收者数和发送的字节数，每个编码好的数据包只计算一次大小"""
+
+    def __init__(self):
+        self.recipients = 0
+        self.bytes = 0
+        self._sizes = {}
+
+    def add(self, eio_pkt):
+        key = id(eio_pkt.data)
+        size = self._sizes.get(key)
+        if size is None:
+            size = self._sizes[key] = packet_size(eio_pkt)
+        self.recipients += 1
+        self.bytes += size
+
+
+def broadcast(sio, event, data, room, namespace='/', skip_sid=None):
+    """向房间广播事件，返回 (接收者数, 发送的字节数)
+
+    Socket.IO 的默认实现会为每个接收者重新生成并编码一次数据包，
+    这里每种格式（JSON / MessagePack）只编码一次，
+    同一个 Engine.IO 数据包放进每个成员的发送队列。
+    使用消息队列（多进程部署）时交给 Socket.IO 通过消息队列转发，
+    接收者在其他进程中，返回 None。
+    """
+    server = sio.server
+    manager = server.manager
+    if isinstance(manager, socketio.PubSubManager):
+        sio.emit(event, data, room=room, namespace=namespace, skip_sid=skip_sid)
+        return None
+    fanout = _Fanout()
+    if namespace not in manager.rooms:
+        return fanout.recipients, fanout.bytes
+
+    # 新版本的 Socket.IO 服务器（以及测试客户端）提供 _send_eio_packet
+    send = getattr(server, '_send_eio_packet', None) or server.eio.send_packet
+    for eio_sid, eio_pkt in _room_packets(server, event, data, room, namespace, skip_sid):
+        send(eio_sid, eio_pkt)
+        fanout.add(eio_pkt)
+    return fanout.recipients, fanout.bytes
+
+
+async def async_broadcast(sio, event, data, room, namespace='/', skip_sid=None):
+    """broadcast 的 asyncio 版本，sio 是 socketio.AsyncServer"""
+    manager = sio.manager
+    if isinstance(manager, AsyncPubSubManager):
+        await sio.emit(event, data, room=room, namespace=namespace, skip_sid=skip_sid)
+        return None
+    fanout = _Fanout()
+    if namespace not in manager.rooms:
+        return fanout.recipients, fanout.bytes
+
+    for eio_sid, eio_pkt in _room_packets(sio, event, data, room, namespace, skip_sid):
+        await sio.eio.send_packet(eio_sid, eio_pkt)
+        fanout.add(eio_pkt)
+    return fanout.recipients, fanout.bytes
@@ -0,0 +1,406 @@
+# chatcore.py - 聊天逻辑：app.py（Flask-SocketIO + eventlet）和 asgi_app.py（AsyncServer）共用
+#
+# 这里负责配置、校验、构造记录，以及在线用户、聊天记录、在线列表、正在输入状态的更新；
+# 不涉及传输方式：Socket.IO 的房间操作、发送事件和广播由两个入口各自完成。
+import base64
+import binascii
+import html
+import os
+import re
+import uuid
+from datetime import datetime
+
+import metrics
+from chatlog import log_event
+from history import SQLiteHistoryStore
+from images import DataURLReader, image_ref, sniff_image_type, SNIFF_BYTES
+from records import ChatMessage, UserInfo
+from segmentlog import SegmentLogStore
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 单独配置历史容量的房间 {room: 条数}，其他房间使用 DEFAULT_HISTORY_SIZE
+ROOM_HISTORY_SIZES = {}
+
+# 每个连接的限流 {事件名: (每秒个数, 突发上限)}，超出的事件直接丢弃；
+# 设置 CHAT_RATE_LIMIT=0 关闭
+RATE_LIMITS = {
+    'send_message': (5, 10),
+    'typing': (1, 3),
+    'join': (0.2, 3)
+}
+RATE_LIMIT_ENABLED = os.environ.get('CHAT_RATE_LIMIT', '1') != '0'
+
+# 日志由后台线程写出：CHAT_LOG_LEVEL 为级别（默认 INFO），CHAT_LOG_FORMAT 为 json（默认）或 text。
+# 高频事件按 {事件名: n} 每 n 条记录一条
+LOG_LEVEL = os.environ.get('CHAT_LOG_LEVEL', 'INFO')
+LOG_JSON = os.environ.get('CHAT_LOG_FORMAT', 'json') == 'json'
+LOG_SAMPLING = {'message': 10}
+
+# 分页加载聊天记录时每页的最大条数
+HISTORY_PAGE_SIZE = 50
+# 首页直接渲染的最近消息条数
+INITIAL_HISTORY_SIZE = 30
+
+# 文字消息的最大长度（字符）
+MAX_MESSAGE_LENGTH = 500
+# 只有这两种消息类型：其他类型的内容不会被转义，不能存进记录
+MESSAGE_TYPES = ('text', 'image')
+
+ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+
+# 上传图片的存储目录和大小限制
+UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
+MAX_IMAGE_SIZE = 5 * 1024 * 1024
+
+# 图片按内容寻址，浏览器可以一直缓存（秒）
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 3600
+
+# 转码图片的工作进程数，0 表示在当前进程中转码
+IMAGE_WORKERS = 2
+
+# 处理 data URL 图片消息的工作线程数（解码、哈希、写文件），同一房间的消息保持发送顺序
+MESSAGE_PIPELINE_WORKERS = 4
+
+# 房间名作为指标标签，超过 METRICS_MAX_ROOMS 个房间后新房间合并为 room="other"
+METRICS_MAX_ROOMS = 200
+
+# 单次处理超过 SLOW_HANDLER_THRESHOLD 秒的事件记录 slow_handler 警告；
+# 后台任务每 LOOP_LAG_INTERVAL 秒测一次调度延迟，超过 LOOP_LAG_WARN_THRESHOLD 秒时记录 loop_lag 警告
+SLOW_HANDLER_THRESHOLD = 0.05
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_WARN_THRESHOLD = 0.1
+
+# data URL 头部（data:image/xxx;base64）的最大长度
+MAX_DATA_URL_HEADER = 64
+# base64 正文：只允许标准字符，末尾最多两个补位
+BASE64_BODY_RE = re.compile(r'[A-Za-z0-9+/]*={0,2}')
+# 识别图片类型需要解码的字符数（4 的倍数）
+SNIFF_CHARS = (SNIFF_BYTES + 2) // 3 * 4
+
+
+def create_history_store(message_queue=None):
+    """根据环境变量创建聊天记录存储，返回 None 时只保存在内存中
+
+    CHAT_HISTORY_BACKEND：sqlite（默认）或 log（按房间分段的追加写日志）；
+    CHAT_HISTORY_DB：SQLite 数据库，设置为空字符串时只保存在内存中；
+    CHAT_HISTORY_LOG_DIR：分段日志的目录。
+    """
+    backend = os.environ.get('CHAT_HISTORY_BACKEND', 'sqlite')
+    if backend == 'log':
+        if message_queue:
+            # 分段日志的大小、条数和索引只记在写入进程的内存里，不能有多个进程同时追加
+            raise ValueError('history backend "log" does not support CHAT_MESSAGE_QUEUE, '
+                             'use "sqlite" for multi-process deployments')
+        return SegmentLogStore(os.environ.get('CHAT_HISTORY_LOG_DIR',
+                                              os.path.join(BASE_DIR, 'chat_log')))
+    if backend == 'sqlite':
+        path = os.environ.get('CHAT_HISTORY_DB', os.path.join(BASE_DIR, 'chat_history.db'))
+        return SQLiteHistoryStore(path) if path else None
+    raise ValueError(f'unsupported history backend: {backend}')
+
+
+def validate_image_data(image_data):
+    """验证图片数据
+
+    只根据编码长度判断大小，只解码开头几个字节判断类型，
+    不复制、不解码整个 data URL。
+    """
+    # 检查是否是base64编码的图片
+    if not isinstance(image_data, str) or not image_data.startswith('data:image/'):
+        return False
+
+    # 只在头部范围内查找逗号
+    comma = image_data.find(',', 0, MAX_DATA_URL_HEADER)
+    if comma < 0 or not image_data.endswith(';base64', 0, comma):
+        return False
+    start = comma + 1
+
+    # 根据编码长度计算解码后的大小，超限直接拒绝
+    encoded_length = len(image_data) - start
+    if encoded_length == 0 or encoded_length % 4:
+        return False
+    padding = 2 if image_data.endswith('==') else 1 if image_data.endswith('=') else 0
+    if encoded_length // 4 * 3 - padding > MAX_IMAGE_SIZE:
+        return False
+
+    # 原地检查字符集，不生成子串
+    if BASE64_BODY_RE.fullmatch(image_data, start) is None:
+        return False
+
+    # 检查图片格式
+    try:
+        head = base64.b64decode(image_data[start:start + SNIFF_CHARS])
+    except (binascii.Error, ValueError):
+        return False
+    return sniff_image_type(head) in ALLOWED_IMAGE_EXTENSIONS
+
+
+class ChatError(Exception):
+    """需要通过 error 事件告诉客户端的错误，参数是错误信息"""
+
+
+def public_user(user_info):
+    """在线列表中对外公开的用户字段"""
+    return {
+        'username': user_info['username'],
+        'user_id': user_info['user_id']
+    }
+
+
+def now():
+    return datetime.now().strftime('%H:%M:%S')
+
+
+def user_joined_event(username):
+    return {'username': username, 'message': f'{username} 加入了聊天室', 'time': now()}
+
+
+def user_left_event(username):
+    return {'username': username, 'message': f'{username} 離開了聊天室', 'time': now()}
+
+
+def set_image(msg, ref):
+    """历史记录和广播中只保留图片引用"""
+    msg.message = f"/images/{ref['hash']}"
+    msg.image = ref
+
+
+class ChatState:
+    """在线用户、房间成员索引和聊天事件的处理逻辑
+
+    history 是 RoomHistory（或 AsyncRoomHistory，调用方先加载房间），
+    image_meta(digest) 返回已上传图片的元数据，replicate(op, **data) 把变化同步给其他工作进程。
+    presence 和 typing 依赖 room_roster / room_size，创建之后再赋值。
+    """
+
+    def __init__(self, history, rate_limiter, image_meta, replicate=None):
+        self.history = history
+        self.rate_limiter = rate_limiter
+        self.image_meta = image_meta
+        self.replicate = replicate or (lambda op, **data: None)
+        self.presence = None
+        self.typing = None
+        # 存储在线用户 {sid: user_info}
+        self.online_users = {}
+        # 房间成员索引 {room: {sid: user_info}}，与 online_users 同步维护
+        self.room_members = {}
+
+    def room_of(self, sid):
+        """连接所在的房间，没有加入时为 None"""
+        user_info = self.online_users.get(sid)
+        return None if user_info is None else user_info.get('room', 'general')
+
+    def room_roster(self, room):
+        """房间在线用户列表"""
+        # 只遍历该房间的成员，不再扫描全部在线用户
+        return [public_user(user_info) for user_info in self.room_members.get(room, {}).values()]
+
+    def room_size(self, room):
+        """房间在线人数"""
+        return len(self.room_members.get(room, ()))
+
+    def remove_room_member(self, room, sid):
+        """从房间成员索引中移除连接，房间空了就删除"""
+        members = self.room_members.get(room)
+        if members is None:
+            return
+        members.pop(sid, None)
+        if not members:
+            del self.room_members[room]
+
+    def allow(self, sid, event):
+        """事件没有超出限流时返回 True
+
+        发送消息被限流时抛出 ChatError，只有发送消息需要告诉用户没有发出去。
+        """
+        if self.rate_limiter.allow(sid, event):
+            return True
+        if event == 'send_message':
+            raise ChatError('发送太频繁，请稍后再试')
+        return False
+
+    def _leave_room(self, room, sid, user_info):
+        self.remove_room_member(room, sid)
+        self.replicate('leave', room=room, sid=sid)
+        # 合并到下一次在线列表广播
+        self.presence.user_left(room, public_user(user_info))
+        self.typing.user_left(room, public_user(user_info))
+
+    def join(self, sid, data):
+        """登记用户加入房间，返回 (user_info, 原来的房间)
+
+        同一连接重复加入时先离开原来的房间（原来没有加入时为 None）。
+        调用方负责切换 Socket.IO 房间、发送 user_joined 和完整在线列表。
+        """
+        username = data['username']
+        room = data.get('room', 'general')
+
+        previous = self.online_users.get(sid)
+        previous_room = None
+        if previous is not None:
+            previous_room = previous.get('room', 'general')
+            self._leave_room(previous_room, sid, previous)
+
+        # 生成用户ID
+        user_info = UserInfo(username, str(uuid.uuid4())[:8], room)
+        self.online_users[sid] = user_info
+        self.room_members.setdefault(room, {})[sid] = user_info
+        self.replicate('join', room=room, sid=sid, user=user_info.to_dict())
+        self.presence.user_joined(room, public_user(user_info))
+        log_event('join', username=username, room=room)
+        return user_info, previous_room
+
+    def disconnect(self, sid):
+        """连接断开，返回离开的用户（没有加入房间时为 None）"""
+        self.rate_limiter.forget(sid)
+        user_info = self.online_users.pop(sid, None)
+        if user_info is not None:
+            room = user_info.get('room', 'general')
+            self._leave_room(room, sid, user_info)
+            log_event('leave', username=user_info['username'], room=room)
+        return user_info
+
+    def history_request(self, sid, data):
+        """检查分页请求，返回 (room, before, limit)
+
+        before 是已有的最早一条消息的 id，不传时从最新开始；只能加载自己所在房间的记录。
+        """
+        data = data or {}
+        room = self.room_of(sid)
+        if data.get('room', room) != room:
+            raise ChatError('not in room')
+        before = data.get('before')
+        limit = data.get('limit', HISTORY_PAGE_SIZE)
+        if (before is not None and not isinstance(before, int)) or not isinstance(limit, int):
+            raise ChatError('invalid history request')
+        return room, before, max(1, min(limit, HISTORY_PAGE_SIZE))
+
+    @staticmethod
+    def history_page(room, before, limit, messages):
+        """history_page 事件的内容"""
+        return {
+            'room': room,
+            'before': before,
+            'messages': [message.to_dict() for message in messages],
+            'has_more': len(messages) == limit
+        }
+
+    def new_message(self, sid, data):
+        """校验并构造一条消息，返回 (user_info, room, msg, reader)
+
+        已上传的图片直接写入引用；旧客户端的 data URL 图片返回 reader（DataURLReader），
+        调用方保存图片后用 set_image 写入引用，否则 reader 为 None。
+        """
+        user_info = self.online_users[sid]
+        room = user_info.get('room', 'general')
+        message = data.get('message', '')
+        message_type = data.get('type', 'text')  # 'text' 或 'image'
+
+        if message_type not in MESSAGE_TYPES or not isinstance(message, str):
+            raise ChatError('invalid message type')
+        if message_type == 'text' and len(message) > MAX_MESSAGE_LENGTH:
+            raise ChatError(f'消息太长，最多{MAX_MESSAGE_LENGTH}字符')
+
+        if message_type == 'text':
+            message = html.escape(message)
+        # 创建消息对象
+        msg = ChatMessage(
+            username=user_info['username'],
+            message=message,
+            type=message_type,
+            time=now(),
+            user_id=user_info['user_id']
+        )
+
+        reader = None
+        if message_type == 'image' and 'image' in data:
+            # 已通过 /upload 上传的图片，只转发引用
+            digest = data['image']
+            meta = self.image_meta(digest) if isinstance(digest, str) else None
+            if meta is None:
+                raise ChatError('image not found')
+            set_image(msg, image_ref(digest, meta))
+        elif message_type == 'image':
+            if not validate_image_data(message):
+                raise ChatError('too large')
+            # 旧客户端发送的 data URL 也存入图片存储，重复的图片只保存一份
+            reader = DataURLReader(message)
+        return user_info, room, msg, reader
+
+    def publish(self, room, user_info, msg):
+        """保存一条消息，返回要广播的内容"""
+        # 存储消息（每个房间只保留最近的记录）
+        self.history.append(room, msg)
+        log_event('message', username=msg.username, room=room, type=msg.type, id=msg.id)
+        msg_data = msg.to_dict()
+        self.replicate('message', room=room, message=msg_data)
+        # 发出消息后不再显示正在输入
+        self.typing.user_left(room, public_user(user_info))
+        return msg_data
+
+    def update_typing(self, sid, data):
+        """记录正在输入状态，按房间合并后定时广播，超时没有更新自动过期"""
+        user_info = self.online_users[sid]
+        room = user_info.get('room', 'general')
+        is_typing = bool((data or {}).get('is_typing', True))
+        user = public_user(user_info)
+        self.typing.update(room, user, is_typing)
+        self.replicate('typing', room=room, user=user, is_typing=is_typing)
+
+
+class ChatMetrics:
+    """运行指标，GET /metrics 以 Prometheus 文本格式输出
+
+    socketio 用来运行调度延迟的后台任务（loop_monitor 为 LoopLagMonitor 或它的 asyncio 版本），
+    history 是 RoomHistory，pipeline 是消息发布队列。入口自己的指标可以继续注册到 registry。
+    """
+
+    def __init__(self, socketio, server, chat, history, pipeline,
+                 loop_monitor=metrics.LoopLagMonitor):
+        registry = self.registry = metrics.MetricsRegistry()
+        self.event_latency = registry.histogram(
+            'chat_event_duration_seconds', 'Socket.IO 事件处理耗时', metrics.LATENCY_BUCKETS,
+            ('event',))
+        self.room_messages = registry.counter(
+            'chat_room_messages_total', '房间内广播的消息数', ('room',), METRICS_MAX_ROOMS)
+        self.room_bytes = registry.counter(
+            'chat_room_sent_bytes_total', '房间内消息广播发送的字节数（所有接收者合计）', ('room',),
+            METRICS_MAX_ROOMS)
+        self.broadcast_fanout = registry.histogram(
+            'chat_broadcast_recipients', '每条消息广播的接收者数', metrics.FANOUT_BUCKETS)
+        self.slow_handlers = registry.counter(
+            'chat_slow_handlers_total', f'处理超过 {SLOW_HANDLER_THRESHOLD} 秒的事件数', ('event',))
+        self.loop_lag = registry.histogram(
+            'chat_loop_lag_seconds', '调度延迟（后台任务实际醒来比预期晚的时间）',
+            metrics.LOOP_LAG_BUCKETS)
+        self.loop_monitor = loop_monitor(socketio, self.loop_lag, LOOP_LAG_INTERVAL,
+                                         LOOP_LAG_WARN_THRESHOLD)
+        registry.callback('chat_connected_sockets', '当前的 Engine.IO 连接数',
+                          lambda: len(server.eio.sockets))
+        registry.callback('chat_online_users', '已加入房间的用户数', lambda: len(chat.online_users))
+        registry.callback('chat_history_messages', '内存中保存的聊天记录条数', lambda: len(history))
+        registry.callback('chat_history_rooms', '聊天记录已加载到内存中的房间数',
+                          lambda: len(history.rooms()))
+        registry.callback('chat_pipeline_pending', '等待图片处理完成的消息数',
+                          lambda: pipeline.pending())
+        registry.callback('chat_rate_limited_total', '被限流丢弃的事件数',
+                          lambda: dict(chat.rate_limiter.dropped), ('event',), type='counter')
+        registry.callback('chat_loop_lag_max_seconds', '启动以来最大的调度延迟',
+                          lambda: self.loop_monitor.max)
+
+    def instrument(self, server):
+        """给所有事件处理函数加上计时和慢处理检测（在注册完之后调用）"""
+        metrics.instrument_handlers(server, self.event_latency, slow=SLOW_HANDLER_THRESHOLD,
+                                    slow_counter=self.slow_handlers)
+
+    def message_sent(self, room, fanout):
+        """记录一次消息广播，fanout 是 broadcast 返回的 (接收者数, 字节数)"""
+        self.room_messages.inc(room)
+        if fanout is not None:
+            recipients, sent_bytes = fanout
+            self.room_bytes.inc(room, amount=sent_bytes)
+            self.broadcast_fanout.observe(recipients)
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,116 @@
+# chatlog.py - 结构化日志：处理函数只把记录放进队列，后台系统线程负责写出
+import atexit
+import json
+import logging
+import logging.handlers
+import sys
+from datetime import datetime
+
+from history import _native_threading
+
+# 各模块使用 logging.getLogger('chat.xxx')，由 setup_logging 统一配置
+logger = logging.getLogger('chat')
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """记录一个事件，event 是事件名（如 'join'），fields 作为结构化字段输出"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
+
+
+class EventSampler(logging.Filter):
+    """按事件采样：rates 为 {事件名: n}，每 n 条只保留 1 条
+
+    在放进队列之前过滤，丢弃的记录不会占用后台线程。WARNING 及以上的记录不采样。
+    """
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self._counts = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        rate = self.rates.get(event, 1)
+        if rate <= 1 or record.levelno >= logging.WARNING:
+            return True
+        seen = self._counts.get(event, 0)
+        self._counts[event] = seen + 1
+        return seen % rate == 0
+
+
+class StructuredFormatter(logging.Formatter):
+    """JSON（一行一条）或 key=value 文本格式"""
+
+    def __init__(self, json_output=True):
+        super().__init__()
+        self.json_output = json_output
+
+    def format(self, record):
+        fields = getattr(record, 'fields', {})
+        time = datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds')
+        if self.json_output:
+            data = {'time': time, 'level': record.levelname, 'logger': record.name}
+            event = getattr(record, 'event', None)
+            if event is None:
+                data['message'] = record.getMessage()
+            else:
+                data['event'] = event
+            data.update(fields)
+            return json.dumps(data, ensure_ascii=False, default=str)
+        parts = [time, record.levelname, record.getMessage()]
+        parts.extend(f'{key}={value}' for key, value in fields.items())
+        return ' '.join(parts)
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """每次写出时使用当前的 sys.stdout（测试时会被替换）"""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+
+class NativeQueueListener(logging.handlers.QueueListener):
+    """在系统线程中写日志，eventlet 打了补丁时写 stdout 也不会卡住 hub"""
+
+    def start(self):
+        threading, _ = _native_threading()
+        self._thread = threading.Thread(target=self._monitor, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+def setup_logging(level=logging.INFO, json_output=True, sampling=None, stream=None):
+    """配置 chat 日志，返回后台写线程（QueueListener）
+
+    sampling 为 {事件名: n}，见 EventSampler。stream 默认是 sys.stdout。
+    重复调用时替换之前的配置。
+    """
+    for handler in list(logger.handlers):
+        if isinstance(handler, logging.handlers.QueueHandler):
+            logger.removeHandler(handler)
+            handler.listener.stop()
+
+    _, queue = _native_threading()
+    log_queue = queue.SimpleQueue()
+    output = logging.StreamHandler(stream) if stream is not None else _StdoutHandler()
+    output.setFormatter(StructuredFormatter(json_output))
+    listener = NativeQueueListener(log_queue, output)
+
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(EventSampler(sampling))
+    handler.listener = listener
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,156 @@
+# cluster.py - 多进程部署：消息队列和工作进程之间的状态同步
+import logging
+import pickle
+import uuid
+
+import socketio
+
+logger = logging.getLogger('chat.cluster')
+
+
+class LocalBroker:
+    """进程内的发布/订阅，用于测试和单进程运行多个服务实例
+
+    消息和真正的消息队列一样经过序列化，每个订阅者拿到独立的副本。
+    """
+
+    _brokers = {}
+
+    def __init__(self):
+        self._subscribers = {}
+        self._counters = {}
+
+    @classmethod
+    def get(cls, url):
+        """同一地址返回同一个实例"""
+        broker = cls._brokers.get(url)
+        if broker is None:
+            broker = cls._brokers[url] = cls()
+        return broker
+
+    def publish(self, channel, message):
+        payload = pickle.dumps(message)
+        for queue in self._subscribers.get(channel, ()):
+            queue.put(pickle.loads(payload))
+
+    def next_id(self, key, floor=1):
+        """key 对应的计数器加一并返回，结果不小于 floor"""
+        value = max(self._counters.get(key, 0) + 1, floor)
+        self._counters[key] = value
+        return value
+
+    def listen(self, channel, create_queue):
+        """订阅频道，返回逐条产生消息的迭代器（调用时立即订阅）"""
+        queue = create_queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        return iter(queue.get, None)
+
+
+class RedisBroker:
+    """基于 Redis 发布/订阅的消息队列（需要安装 redis）"""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('Redis package is not installed '
+                               '(Run "pip install redis" in your virtualenv).')
+        self.redis = redis.Redis.from_url(url)
+
+    def publish(self, channel, message):
+        self.redis.publish(channel, pickle.dumps(message))
+
+    def next_id(self, key, floor=1):
+        """key 对应的计数器加一并返回（INCR，所有进程共用），结果不小于 floor"""
+        value = self.redis.incr(key)
+        if value < floor:
+            # 第一次使用时计数器从数据库中已有的最大 id 之后开始；
+            # INCRBY 是原子的，多个进程同时补齐也不会拿到相同的值
+            value = self.redis.incrby(key, floor - value)
+        return value
+
+    def listen(self, channel, create_queue=None):
+        """订阅频道，返回逐条产生消息的迭代器（调用时立即订阅）"""
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return (pickle.loads(item['data']) for item in pubsub.listen()
+                if item['type'] == 'message')
+
+
+def create_broker(url):
+    """根据地址创建消息队列：local://名称 或 redis://、rediss://、unix://"""
+    if url.startswith('local://'):
+        return LocalBroker.get(url)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBroker(url)
+    raise ValueError(f'unsupported message queue: {url}')
+
+
+class LocalPubSubManager(socketio.PubSubManager):
+    """在 LocalBroker 上转发 Socket.IO 广播的客户端管理器"""
+
+    name = 'local'
+
+    def __init__(self, broker, channel='flask-socketio', write_only=False):
+        super().__init__(channel=channel, write_only=write_only)
+        self.broker = broker
+        self._initialized = False
+
+    def initialize(self):
+        # 只启动一个监听任务（测试客户端每次创建都会调用 initialize）
+        if not self._initialized:
+            self._initialized = True
+            super().initialize()
+
+    def _publish(self, data):
+        self.broker.publish(self.channel, data)
+
+    def _listen(self):
+        return self.broker.listen(self.channel, self.server.eio.create_queue)
+
+
+def create_client_manager(url, channel='flask-socketio'):
+    """Socket.IO 广播使用的客户端管理器"""
+    if url.startswith('local://'):
+        return LocalPubSubManager(LocalBroker.get(url), channel=channel)
+    return socketio.RedisManager(url, channel=channel)
+
+
+class StateReplicator:
+    """通过消息队列把在线用户和聊天记录的变化同步到其他工作进程
+
+    每条消息是 {'op': 名称, 'host_id': 发送方, ...}，
+    收到自己发出的消息时直接忽略。
+    """
+
+    def __init__(self, broker, channel='chat-state'):
+        self.broker = broker
+        self.channel = channel
+        self.host_id = uuid.uuid4().hex
+        self._handlers = {}
+
+    def on(self, op, handler):
+        """注册处理其他进程消息的函数 handler(message)"""
+        self._handlers[op] = handler
+
+    def publish(self, op, **data):
+        data['op'] = op
+        data['host_id'] = self.host_id
+        self.broker.publish(self.channel, data)
+
+    def start(self, socketio):
+        """订阅频道，在后台任务中处理其他进程的消息"""
+        messages = self.broker.listen(self.channel, socketio.server.eio.create_queue)
+        socketio.start_background_task(self._dispatch, messages)
+
+    def _dispatch(self, messages):
+        for message in messages:
+            if message.get('host_id') == self.host_id:
+                continue
+            handler = self._handlers.get(message.get('op'))
+            if handler is None:
+                continue
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error('同步消息处理失败 %s: %s', message.get('op'), e)
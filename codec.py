@@ -0,0 +1,82 @@
+# codec.py - 按连接协商 Socket.IO 数据包的序列化格式（JSON / MessagePack）
+from socketio import packet
+
+
+def msgpack_packet_class():
+    """MessagePack 数据包类（需要安装 msgpack）"""
+    try:
+        from socketio.msgpack_packet import MsgPackPacket
+    except ImportError:
+        raise RuntimeError('msgpack package is not installed '
+                           '(Run "pip install msgpack" in your virtualenv).')
+    return MsgPackPacket
+
+
+class NegotiatedPacket(packet.Packet):
+    """按收到的数据判断格式：文本帧是 JSON，二进制帧是 MessagePack
+
+    JSON 客户端的二进制帧只会是附件，服务器在调用数据包类之前就处理掉了，
+    所以能到这里的二进制帧一定是 MessagePack 客户端发来的数据包。
+    """
+
+    msgpack_class = None
+
+    def __new__(cls, *args, encoded_packet=None, **kwargs):
+        if isinstance(encoded_packet, bytes):
+            return cls.msgpack_class(encoded_packet=encoded_packet)
+        return packet.Packet(*args, encoded_packet=encoded_packet, **kwargs)
+
+
+class CodecNegotiator:
+    """让 MessagePack 客户端和 JSON 客户端连接同一个服务器
+
+    客户端第一个数据包（CONNECT）用什么格式发送，之后发给它的数据包
+    就用什么格式编码。旧客户端什么都不用改，继续使用 JSON。
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.msgpack_class = msgpack_packet_class()
+        # 使用 MessagePack 的 Engine.IO 连接
+        self.binary_clients = set()
+
+        server.packet_class = type('NegotiatedPacket', (NegotiatedPacket,),
+                                   {'msgpack_class': self.msgpack_class})
+        self._handle_eio_message = server._handle_eio_message
+        self._handle_eio_disconnect = server._handle_eio_disconnect
+        self._send_packet = server._send_packet
+        server._handle_eio_message = self.handle_eio_message
+        server._send_packet = self.send_packet
+        # Engine.IO 在创建 Socket.IO 服务器时就记下了原来的处理函数
+        server.eio.on('message', self.handle_eio_message)
+        server.eio.on('disconnect', self.handle_eio_disconnect)
+        server.codecs = self
+
+    def uses_msgpack(self, eio_sid):
+        return eio_sid in self.binary_clients
+
+    def handle_eio_message(self, eio_sid, data):
+        if isinstance(data, bytes) and eio_sid not in self.server._binary_packet:
+            self.binary_clients.add(eio_sid)
+        self._handle_eio_message(eio_sid, data)
+
+    def handle_eio_disconnect(self, eio_sid):
+        try:
+            self._handle_eio_disconnect(eio_sid)
+        finally:
+            self.binary_clients.discard(eio_sid)
+
+    def to_msgpack(self, pkt):
+        """把 JSON 数据包转换成 MessagePack 数据包（二进制数据直接放在包里）"""
+        packet_type = pkt.packet_type
+        if packet_type == packet.BINARY_EVENT:
+            packet_type = packet.EVENT
+        elif packet_type == packet.BINARY_ACK:
+            packet_type = packet.ACK
+        return self.msgpack_class(packet_type, data=pkt.data,
+                                  namespace=pkt.namespace or '/', id=pkt.id)
+
+    def send_packet(self, eio_sid, pkt):
+        if eio_sid in self.binary_clients and not isinstance(pkt, self.msgpack_class):
+            pkt = self.to_msgpack(pkt)
+        self._send_packet(eio_sid, pkt)
@@ -0,0 +1,171 @@
+# compression.py - WebSocket permessage-deflate 压缩：大小阈值、上下文接管和压缩统计
+
+
+class CompressionStats:
+    """发送的 WebSocket 数据帧统计（只统计数据帧，不含控制帧）"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # 压缩的帧：原始字节数和实际发送的字节数
+        self.compressed_frames = 0
+        self.compressed_in = 0
+        self.compressed_out = 0
+        # 小于阈值没有压缩的帧
+        self.skipped_frames = 0
+        self.skipped_bytes = 0
+
+    def record_compressed(self, raw_size, wire_size):
+        self.compressed_frames += 1
+        self.compressed_in += raw_size
+        self.compressed_out += wire_size
+
+    def record_skipped(self, size):
+        self.skipped_frames += 1
+        self.skipped_bytes += size
+
+    @property
+    def ratio(self):
+        """压缩帧的压缩比（发送字节数 / 原始字节数），没有压缩过时为 1"""
+        if not self.compressed_in:
+            return 1.0
+        return self.compressed_out / self.compressed_in
+
+    def snapshot(self):
+        return {
+            'compressed_frames': self.compressed_frames,
+            'compressed_in': self.compressed_in,
+            'compressed_out': self.compressed_out,
+            'skipped_frames': self.skipped_frames,
+            'skipped_bytes': self.skipped_bytes,
+            'ratio': self.ratio
+        }
+
+
+class DeflateOptions:
+    """permessage-deflate 配置
+
+    threshold: 小于这个字节数的帧不压缩（RFC 7692 允许逐帧决定是否压缩）
+    context_takeover: 为 False 时每条消息使用新的压缩器，压缩率低一些但不占用常驻内存
+    window_bits: 服务器端压缩窗口（8-15），越小每个连接占用的内存越少
+    """
+
+    def __init__(self, enabled=True, threshold=256, context_takeover=True, window_bits=15):
+        if not 8 <= window_bits <= 15:
+            raise ValueError('window_bits must be between 8 and 15')
+        self.enabled = enabled
+        self.threshold = threshold
+        self.context_takeover = context_takeover
+        self.window_bits = window_bits
+
+    def negotiate(self, offer):
+        """根据客户端提出的参数（eventlet 协商的结果）生成服务器的响应参数"""
+        if not self.enabled or offer is None:
+            return None
+        config = dict(offer)
+        if not self.context_takeover:
+            # RFC 7692 允许服务器在响应中加上这两个参数，即使客户端没有提出
+            config['server_no_context_takeover'] = True
+            config['client_no_context_takeover'] = True
+        if self.window_bits < config.get('server_max_window_bits', 15):
+            config['server_max_window_bits'] = self.window_bits
+        return config
+
+
+def _frame_header_size(length):
+    if length > 65535:
+        return 10
+    if length > 125:
+        return 4
+    return 2
+
+
+class _CountingCompressor:
+    """包装压缩器，记下交给它压缩的字节数"""
+
+    __slots__ = ('compressor', 'websocket')
+
+    def __init__(self, compressor, websocket):
+        self.compressor = compressor
+        self.websocket = websocket
+
+    def compress(self, data):
+        self.websocket._raw_size += len(data)
+        return self.compressor.compress(data)
+
+    def flush(self, mode):
+        return self.compressor.flush(mode)
+
+
+def make_websocket_class(base, options, stats):
+    """基于 Engine.IO 的 eventlet WebSocketWSGI 生成带压缩配置的版本
+
+    base 是 engineio.async_drivers.eventlet.WebSocketWSGI。
+    """
+    from eventlet.websocket import RFC6455WebSocket
+
+    class DeflateWebSocket(RFC6455WebSocket):
+        _skip_compression = False
+        # 本帧压缩前的字节数，由 _CountingCompressor 在父类编码后记下
+        _raw_size = 0
+
+        def _get_permessage_deflate_enc(self):
+            if self._skip_compression:
+                return None
+            compressor = super()._get_permessage_deflate_enc()
+            if compressor is None:
+                return None
+            return _CountingCompressor(compressor, self)
+
+        def _pack_message(self, message, masked=False, continuation=False, final=True,
+                          control_code=None):
+            if control_code or 'permessage-deflate' not in self.extensions:
+                return super()._pack_message(message, masked, continuation, final, control_code)
+            # UTF-8 编码后不会比字符数少：字符数已经达到阈值的帧不需要先编码一次来量大小，
+            # 父类只编码一次（广播时每个接收者都要走一遍这里）
+            size = len(message)
+            if size < options.threshold and isinstance(message, str):
+                # 短文本编码的开销很小，按字节数判断
+                size = len(message.encode('utf-8'))
+            if size < options.threshold:
+                # 小帧压缩省不了多少字节，直接发送
+                self._skip_compression = True
+                try:
+                    packed = super()._pack_message(message, masked, continuation, final)
+                finally:
+                    self._skip_compression = False
+                stats.record_skipped(size)
+                return packed
+            self._raw_size = 0
+            packed = super()._pack_message(message, masked, continuation, final)
+            size = self._raw_size
+            stats.record_compressed(size + _frame_header_size(size), len(packed))
+            return packed
+
+    class DeflateWebSocketWSGI(base):
+        def _negotiate_permessage_deflate(self, extensions):
+            return options.negotiate(super()._negotiate_permessage_deflate(extensions))
+
+        def _handle_hybi_request(self, environ):
+            ws = super()._handle_hybi_request(environ)
+            return DeflateWebSocket(ws.socket, environ, ws.version, protocol=ws.protocol,
+                                    extensions=ws.extensions,
+                                    max_frame_length=ws.max_frame_length)
+
+    return DeflateWebSocketWSGI
+
+
+def install(server, options, stats):
+    """让 Engine.IO 服务器使用带压缩配置的 WebSocket（只支持 eventlet）
+
+    长轮询的 HTTP 响应使用 Engine.IO 自带的压缩，阈值相同。
+    """
+    eio = server.eio
+    eio.http_compression = options.enabled
+    eio.compression_threshold = options.threshold
+    if eio.async_mode != 'eventlet':
+        return False
+    eio._async = dict(eio._async, websocket=make_websocket_class(
+        eio._async['websocket'], options, stats))
+    return True
@@ -0,0 +1,345 @@
+# history.py - 按房间保存的聊天记录
+import atexit
+import json
+import logging
+import sqlite3
+import time
+from collections import deque
+from itertools import count, islice
+
+from records import as_dict
+
+logger = logging.getLogger('chat.history')
+
+# 每个房间默认保留的消息条数
+DEFAULT_HISTORY_SIZE = 100
+
+
+def _native_threading():
+    """返回没有被 eventlet 打补丁的 threading 和 queue 模块
+
+    后台写线程必须是真正的系统线程，fsync 时才不会卡住 hub。
+    """
+    try:
+        from eventlet import patcher
+    except ImportError:
+        import threading
+        import queue
+        return threading, queue
+    return patcher.original('threading'), patcher.original('queue')
+
+
+class RoomHistory:
+    """按房间分开的环形消息缓冲区
+
+    每个房间一个有界 deque，追加和淘汰旧消息都是 O(1)，
+    热门房间不会再把其他房间的记录挤掉。
+    配置了持久化存储时，内存中的缓冲区只是缓存：房间第一次被访问时
+    才从存储中加载最近的消息，新消息同时交给存储在后台写入。
+    每条消息带有房间内递增的 id，分页加载时作为游标。
+    指定 record 时，从存储加载的和追加进来的 dict 都用它转换成记录对象。
+    多个进程写同一个房间时，通过 ids(room, floor) 从共享的计数器分配 id
+    （返回不小于 floor 的新 id），不指定时在本进程内递增。
+    """
+
+    def __init__(self, default_capacity=DEFAULT_HISTORY_SIZE, capacities=None, store=None,
+                 record=None, ids=None):
+        self.default_capacity = default_capacity
+        # 单独配置容量的房间 {room: capacity}
+        self.capacities = dict(capacities or {})
+        self.store = store
+        self.record = record
+        self.ids = ids
+        self._rooms = {}
+        # 每个房间下一条消息的 id
+        self._next_ids = {}
+        # 每个房间的版本号，内容变化时更新（用于渲染结果的缓存）
+        self._versions = {}
+        self._changes = count(1)
+
+    def version(self, room):
+        """房间的版本号，追加或清空消息后会变成一个新的值"""
+        return self._versions.get(room, 0)
+
+    def capacity(self, room):
+        """返回房间的消息容量"""
+        return self.capacities.get(room, self.default_capacity)
+
+    def set_capacity(self, room, capacity):
+        """修改房间容量，已有记录只保留最新的部分"""
+        if capacity <= 0:
+            raise ValueError('capacity must be positive')
+        self.capacities[room] = capacity
+        if room in self._rooms:
+            self._rooms[room] = deque(self._rooms[room], maxlen=capacity)
+            self._versions[room] = next(self._changes)
+
+    def _buffer(self, room):
+        """房间的缓冲区，第一次访问时从存储中加载"""
+        buffer = self._rooms.get(room)
+        if buffer is None:
+            capacity = self.capacity(room)
+            recent = self.store.load_recent(room, capacity) if self.store else ()
+            buffer = self._rooms[room] = deque(self._records(recent), maxlen=capacity)
+            self._next_ids[room] = buffer[-1].get('id', 0) + 1 if buffer else 1
+        return buffer
+
+    def append(self, room, message, persist=True):
+        """追加一条消息，超出容量时自动丢弃最旧的
+
+        没有 id 的消息会分配一个房间内递增的 id（直接写入 message），
+        返回保存的消息。persist=False 时只更新缓存（例如其他进程已经写入存储的消息）。
+        """
+        buffer = self._buffer(room)
+        if self.record is not None and isinstance(message, dict):
+            message = self.record(message)
+        if 'id' not in message:
+            floor = self._next_ids[room]
+            message['id'] = self.ids(room, floor) if self.ids is not None else floor
+        self._next_ids[room] = max(self._next_ids[room], message['id'] + 1)
+        if buffer and message['id'] < buffer[-1]['id']:
+            # 其他进程先分配了 id、后送到的消息，按 id 插入，分页时缓冲区保持有序
+            self._insert(buffer, message)
+        else:
+            buffer.append(message)
+        self._versions[room] = next(self._changes)
+        if persist and self.store is not None:
+            self.store.append(room, as_dict(message))
+        return message
+
+    @staticmethod
+    def _insert(buffer, message):
+        position = len(buffer)
+        while position > 0 and buffer[position - 1]['id'] > message['id']:
+            position -= 1
+        if len(buffer) == buffer.maxlen:
+            if position == 0:
+                # 比缓冲区里所有消息都旧，只留在存储中
+                return
+            buffer.popleft()
+            position -= 1
+        buffer.insert(position, message)
+
+    def recent(self, room, limit=None):
+        """返回房间最近的消息（从旧到新）"""
+        buffer = self._buffer(room)
+        if limit is None or limit >= len(buffer):
+            return list(buffer)
+        # 从尾部反向取 limit 条，避免复制整个缓冲区
+        page = list(islice(reversed(buffer), limit))
+        page.reverse()
+        return page
+
+    def page(self, room, before=None, limit=50):
+        """id 小于 before 的最近 limit 条消息（从旧到新），before 为 None 时从最新开始
+
+        先从内存缓冲区中取，不够时再从存储中读取更早的消息。
+        """
+        page = self.buffered(room, before, limit)
+        if len(page) < limit and self.store is not None:
+            oldest = page[0]['id'] if page else before
+            page = self._records(self.store.load_before(room, oldest, limit - len(page))) + page
+        return page
+
+    def buffered(self, room, before=None, limit=50):
+        """只从内存缓冲区中取 page 的结果，不读存储"""
+        buffer = self._buffer(room)
+        newer = (m for m in reversed(buffer) if before is None or m['id'] < before)
+        page = list(islice(newer, limit))
+        page.reverse()
+        return page
+
+    def _records(self, messages):
+        if self.record is None:
+            return list(messages)
+        return [self.record(message) for message in messages]
+
+    def rooms(self):
+        """已加载到内存中的房间"""
+        return list(self._rooms)
+
+    def clear(self, room=None):
+        """清空指定房间，不传房间时清空全部（包括持久化存储）"""
+        changed = set(self._rooms) | set(self._versions) if room is None else {room}
+        for name in changed:
+            self._versions[name] = next(self._changes)
+        if room is None:
+            self._rooms.clear()
+            self._next_ids.clear()
+        else:
+            self._rooms.pop(room, None)
+            self._next_ids.pop(room, None)
+        if self.store is not None:
+            self.store.clear(room)
+
+    def __getitem__(self, room):
+        return self._buffer(room)
+
+    def __contains__(self, room):
+        return room in self._rooms
+
+    def __len__(self):
+        """内存中所有房间的消息总数"""
+        return sum(len(buffer) for buffer in self._rooms.values())
+
+
+class BackgroundWriter:
+    """在后台系统线程中批量执行写操作
+
+    调用方只把操作放进队列；后台线程攒一小段时间，把这期间的操作
+    交给 _write_batch 一次处理（一次事务 / 一次 fsync）。
+    子类实现 _write_batch，需要时实现 _start_writer / _stop_writer。
+    """
+
+    def __init__(self, batch_size=256, flush_interval=0.05, name='history-writer'):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        threading, queue = _native_threading()
+        self._queue = queue.Queue()
+        self._empty = queue.Empty
+        self._writer = threading.Thread(target=self._write_loop, name=name, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _submit(self, op):
+        self._queue.put(op)
+
+    def flush(self):
+        """等待队列中的写入全部完成"""
+        self._queue.join()
+
+    def close(self):
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _start_writer(self):
+        pass
+
+    def _stop_writer(self):
+        pass
+
+    def _write_batch(self, batch):
+        raise NotImplementedError
+
+    def _write_loop(self):
+        self._start_writer()
+        while True:
+            batch = [self._queue.get()]
+            # 攒一小段时间，把这期间的写入合并成一批
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except self._empty:
+                    break
+            stopping = None in batch
+            try:
+                self._write_batch([op for op in batch if op is not None])
+            except Exception as e:
+                logger.error('聊天记录写入失败: %s', e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if stopping:
+                self._stop_writer()
+                return
+
+
+class SQLiteHistoryStore(BackgroundWriter):
+    """SQLite（WAL 模式）聊天记录存储
+
+    写入只是放进队列，由后台线程攒成一批在一个事务里提交，
+    调用方不会等待 fsync。读取最近消息和按游标分页都使用 (room, seq) 索引
+    （seq 即消息 id；多个进程写入时写入时间的先后不一定和 id 一致）。
+    """
+
+    def __init__(self, path, batch_size=256, flush_interval=0.05):
+        self.path = path
+        self._reader = None
+
+        conn = self._connect()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                room TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                seq INTEGER,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_room_time
+                ON messages (room, timestamp);
+        ''')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(messages)')]
+        if 'seq' not in columns:
+            # 旧数据库没有消息 id，按写入顺序补上
+            with conn:
+                conn.execute('ALTER TABLE messages ADD COLUMN seq INTEGER')
+                conn.execute('UPDATE messages SET seq = id')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_room_seq ON messages (room, seq)')
+        conn.close()
+        super().__init__(batch_size, flush_interval)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在检查点时 fsync，崩溃也不会损坏数据库
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def append(self, room, message):
+        """放入写队列，立即返回"""
+        self._submit(('append', room, time.time(), message.get('id'),
+                      json.dumps(message, ensure_ascii=False)))
+
+    def clear(self, room=None):
+        """删除记录，等待写入完成后再返回（之后加载的记录不会包含已删除的消息）"""
+        self._submit(('clear', room))
+        self.flush()
+
+    def _query(self, sql, params):
+        if self._reader is None:
+            self._reader = self._connect()
+        rows = self._reader.execute(sql, params).fetchall()
+        messages = []
+        for seq, data in reversed(rows):
+            message = json.loads(data)
+            message.setdefault('id', seq)
+            messages.append(message)
+        return messages
+
+    def load_recent(self, room, limit):
+        """房间最近的 limit 条消息（从旧到新）"""
+        return self._query(
+            'SELECT seq, data FROM messages WHERE room = ? '
+            'ORDER BY seq DESC, id DESC LIMIT ?', (room, limit))
+
+    def load_before(self, room, before, limit):
+        """id 小于 before 的最近 limit 条消息（从旧到新），before 为 None 时从最新开始"""
+        if before is None:
+            return self._query(
+                'SELECT seq, data FROM messages WHERE room = ? '
+                'ORDER BY seq DESC LIMIT ?', (room, limit))
+        return self._query(
+            'SELECT seq, data FROM messages WHERE room = ? AND seq < ? '
+            'ORDER BY seq DESC LIMIT ?', (room, before, limit))
+
+    def _start_writer(self):
+        self._conn = self._connect()
+
+    def _stop_writer(self):
+        self._conn.close()
+
+    def _write_batch(self, batch):
+        with self._conn:
+            for op in batch:
+                if op[0] == 'append':
+                    self._conn.execute(
+                        'INSERT INTO messages (room, timestamp, seq, data) VALUES (?, ?, ?, ?)', op[1:])
+                elif op[1] is None:
+                    self._conn.execute('DELETE FROM messages')
+                else:
+                    self._conn.execute('DELETE FROM messages WHERE room = ?', (op[1],))
@@ -0,0 +1,282 @@
+# images.py - 图片转码和缩略图
+import base64
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from blobstore import CHUNK_SIZE, new_hasher
+
+# Pillow 格式名 -> MIME
+IMAGE_MIME_TYPES = {
+    'PNG': 'image/png',
+    'JPEG': 'image/jpeg',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+}
+
+# 转码后图片的最大边长、缩略图边长、允许的最大像素数（防解压炸弹）
+MAX_IMAGE_DIMENSION = 2048
+THUMBNAIL_SIZE = 320
+MAX_IMAGE_PIXELS = 40 * 1000 * 1000
+JPEG_QUALITY = 85
+
+# 文件头魔数 -> 图片类型（与 ALLOWED_IMAGE_EXTENSIONS 的写法一致）
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+)
+# 识别类型需要的最少字节数
+SNIFF_BYTES = 12
+
+# 打了猴子补丁时轮询转码结果的间隔（秒）
+POLL_INTERVAL = 0.01
+
+
+class ImageRejected(Exception):
+    """不是支持的图片，或者像素数超过限制"""
+
+
+def sniff_image_type(head):
+    """根据开头的几个字节判断图片类型，无法识别时返回 None"""
+    for signature, image_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return image_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class DataURLReader:
+    """把 data URL 的 base64 正文当作二进制流按块解码读取
+
+    只在读取时解码当前的一小段，不会生成整张图片的副本。
+    调用前需要先用 validate_image_data 检查过格式。
+    """
+
+    def __init__(self, data_url):
+        self.data = data_url
+        self.pos = data_url.index(',') + 1
+
+    def read(self, size):
+        # 每 4 个字符解码成 3 个字节
+        chars = max(size // 3, 1) * 4
+        piece = self.data[self.pos:self.pos + chars]
+        self.pos += len(piece)
+        return base64.b64decode(piece)
+
+
+def file_digest(path):
+    """计算文件的内容哈希"""
+    hasher = new_hasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _has_alpha(img):
+    return img.mode in ('RGBA', 'LA', 'PA') or (
+        img.mode == 'P' and 'transparency' in img.info)
+
+
+def _save(img, path, keep_alpha):
+    """保存为 PNG（有透明通道）或 JPEG，返回 MIME"""
+    if keep_alpha:
+        img.save(path, 'PNG', optimize=True)
+        return 'image/png'
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    img.save(path, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return 'image/jpeg'
+
+
+def _output(path, mime, size):
+    return {
+        'path': path,
+        'hash': file_digest(path),
+        'mime': mime,
+        'width': size[0],
+        'height': size[1],
+        'size': os.path.getsize(path)
+    }
+
+
+def transcode_image(path, max_dimension=MAX_IMAGE_DIMENSION,
+                    thumb_size=THUMBNAIL_SIZE, max_pixels=MAX_IMAGE_PIXELS):
+    """解码并重新编码图片，同时生成缩略图（在工作进程中运行）
+
+    返回 {'image': {...}, 'thumb': {...}}，每项包含输出文件路径、
+    哈希、MIME、尺寸和字节数。动图保留原文件，只生成首帧缩略图。
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', Image.DecompressionBombWarning)
+        try:
+            img = Image.open(path)
+        except (OSError, Image.DecompressionBombWarning, Image.DecompressionBombError) as e:
+            raise ImageRejected(str(e))
+
+        with img:
+            mime = IMAGE_MIME_TYPES.get(img.format)
+            if mime is None:
+                raise ImageRejected(f'unsupported format {img.format}')
+            # 先用文件头里的尺寸判断，避免解码超大图片
+            if img.width * img.height > max_pixels:
+                raise ImageRejected(f'too many pixels {img.width}x{img.height}')
+
+            try:
+                if getattr(img, 'is_animated', False):
+                    # 动图直接保留原文件
+                    result = {'image': _output(path, mime, img.size)}
+                    img.seek(0)
+                    frame = img.convert('RGBA')
+                else:
+                    frame = ImageOps.exif_transpose(img)
+                    frame.thumbnail((max_dimension, max_dimension))
+                    out_path = path + '.img'
+                    out_mime = _save(frame, out_path, _has_alpha(frame))
+                    result = {'image': _output(out_path, out_mime, frame.size)}
+
+                thumb = frame.copy()
+                thumb.thumbnail((thumb_size, thumb_size))
+                thumb_path = path + '.thumb'
+                thumb_mime = _save(thumb, thumb_path, _has_alpha(thumb))
+                result['thumb'] = _output(thumb_path, thumb_mime, thumb.size)
+            except (OSError, ValueError, Image.DecompressionBombWarning) as e:
+                raise ImageRejected(str(e))
+    return result
+
+
+class ImageProcessor:
+    """在进程池中转码图片，避免阻塞 eventlet hub
+
+    workers 为 0 时在当前进程中直接转码。
+    """
+
+    def __init__(self, workers=2, async_mode=None, **limits):
+        self.workers = workers
+        self.async_mode = async_mode
+        self.limits = limits
+        self._pool = None
+
+    def process(self, path):
+        """转码图片，返回 transcode_image 的结果"""
+        if self.workers <= 0:
+            return transcode_image(path, **self.limits)
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        future = self._pool.submit(transcode_image, path, **self.limits)
+        if self.async_mode == 'eventlet':
+            return _eventlet_wait(future)
+        return future.result()
+
+    def blocking(self, func, *args):
+        """执行读写文件、计算哈希这类阻塞但不用锁的步骤
+
+        打了猴子补丁时 store_image 在绿色线程中执行（转码结果只能在 hub 里等待），
+        阻塞的步骤放到 tpool 的系统线程中，不占用 hub；其他情况下调用方已经在工作线程中，直接执行。
+        """
+        if self.async_mode == 'eventlet' and green_patched():
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        return func(*args)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def green_patched():
+    """threading 是否被 eventlet 打了猴子补丁（多进程部署时 app.py 会打补丁）"""
+    try:
+        from eventlet import patcher
+    except ImportError:
+        return False
+    return patcher.is_monkey_patched('thread')
+
+
+def _eventlet_wait(future):
+    """等待进程池的结果，hub 可以继续处理其他连接"""
+    import eventlet
+    if green_patched():
+        # 打了补丁后 future 内部的 Condition 是绿色的，只能在 hub 线程里等待，
+        # 放到 tpool 的系统线程中等待会切换失败
+        while not future.done():
+            eventlet.sleep(POLL_INTERVAL)
+        return future.result()
+    # 在 tpool 的系统线程中等待结果
+    from eventlet import tpool
+    return tpool.execute(future.result)
+
+
+def blob_meta(output):
+    """转码输出保存到存储中的元数据"""
+    return {
+        'mime': output['mime'],
+        'width': output['width'],
+        'height': output['height'],
+        'size': output['size']
+    }
+
+
+def image_ref(digest, meta):
+    """消息中携带的图片引用"""
+    ref = {
+        'hash': digest,
+        'mime': meta['mime'],
+        'width': meta['width'],
+        'height': meta['height']
+    }
+    if 'thumb' in meta:
+        ref['thumb'] = meta['thumb']
+    return ref
+
+
+def store_image(store, processor, stream, max_size):
+    """把图片存入按内容寻址的存储（BlobStore），返回图片引用
+
+    相同的原始内容只保存、转码一次。超过大小限制时抛出 BlobTooLarge，
+    不是有效图片时抛出 ImageRejected。读写存储的步骤通过 processor.blocking 执行，
+    等待转码结果的步骤通过 processor.process 执行。
+    """
+    # 边读边写入磁盘并计算哈希，不在内存中保留整张图片
+    source, size, temp_path = processor.blocking(store.put_stream, stream, max_size)
+    try:
+        if size == 0:
+            raise ImageRejected('empty image')
+
+        # 同样的图片之前已经保存过，直接返回已有的引用
+        ref = processor.blocking(_stored_ref, store, source)
+        if ref is not None:
+            return ref
+
+        # 解码、检查像素数、缩小并重新编码，同时生成缩略图
+        result = processor.process(temp_path)
+        return processor.blocking(_commit_image, store, source, result)
+    finally:
+        # 已放入存储的文件已被移走，这里只清理剩下的临时文件
+        for path in (temp_path, temp_path + '.img', temp_path + '.thumb'):
+            store.discard(path)
+
+
+def _stored_ref(store, source):
+    """原始内容已经保存过时返回图片引用，否则返回 None"""
+    digest = store.resolve(source)
+    if digest is None:
+        return None
+    return image_ref(digest, store.meta(digest))
+
+
+def _commit_image(store, source, result):
+    """把转码结果和缩略图放入存储，返回图片引用"""
+    image, thumb = result['image'], result['thumb']
+    thumb_meta = store.commit(thumb['hash'], thumb['path'], blob_meta(thumb))
+    meta = blob_meta(image)
+    meta['thumb'] = image_ref(thumb['hash'], thumb_meta)
+    meta = store.commit(image['hash'], image['path'], meta)
+    store.link(source, image['hash'])
+    return image_ref(image['hash'], meta)
@@ -0,0 +1,354 @@
+# metrics.py - 运行指标：计数器和直方图，按 Prometheus 文本格式输出
+import inspect
+import json
+import logging
+import time
+import types
+from bisect import bisect_left
+from functools import wraps
+
+from chatlog import log_event
+
+# 事件处理耗时的桶上限（秒）
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# hub 调度延迟的桶上限（秒）
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# 一次广播的接收者数的桶上限
+FANOUT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+# 超过上限的新标签值合并成这个值，避免房间名这类标签无限增长
+OVERFLOW_LABEL = 'other'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.type}'
+        yield from self.samples()
+
+    def samples(self):
+        return ()
+
+
+class Counter(Metric):
+    """累加计数，labels 为标签名；max_series 限制不同标签值的个数"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), max_series=None):
+        super().__init__(name, help, labels)
+        self.max_series = max_series
+        # {标签值: 计数}
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        values = self._values
+        if labels not in values:
+            if self.max_series is not None and len(values) >= self.max_series:
+                labels = (OVERFLOW_LABEL,) * len(labels)
+            values.setdefault(labels, 0)
+        values[labels] += amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield f'{self.name}{_labels(self.labels, labels)} {_number(value)}'
+
+    def reset(self):
+        self._values.clear()
+
+
+class Histogram(Metric):
+    """分桶统计，每个标签值的桶在第一次出现时分配，之后只做一次二分查找和加法"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # {标签值: [每个桶的计数..., 超过最大桶的计数, 总和]}
+        self._series = {}
+
+    def observe(self, value, *labels):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0
+
+    def samples(self):
+        for labels, series in self._series.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series):
+                total += count
+                le = (('le', _number(bound)),)
+                yield f'{self.name}_bucket{_labels(self.labels, labels, le)} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, labels)} {_number(series[-1])}'
+            yield f'{self.name}_count{_labels(self.labels, labels)} {total}'
+
+    def reset(self):
+        self._series.clear()
+
+
+class Callback(Metric):
+    """输出时才读取的指标，func 返回一个数，或者 {标签值: 数}"""
+
+    def __init__(self, name, help, func, labels=(), type='gauge'):
+        super().__init__(name, help, labels)
+        self.func = func
+        self.type = type
+
+    def samples(self):
+        value = self.func()
+        if not isinstance(value, dict):
+            yield f'{self.name} {_number(value)}'
+            return
+        for labels, number in value.items():
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            yield f'{self.name}{_labels(self.labels, labels)} {_number(number)}'
+
+
+class MetricsRegistry:
+    """指标集合
+
+    计数都在 hub 线程里更新，热路径上只有字典查找和加法，不加锁。
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), max_series=None):
+        return self.register(Counter(name, help, labels, max_series))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def callback(self, name, help, func, labels=(), type='gauge'):
+        return self.register(Callback(name, help, func, labels, type))
+
+    def render(self):
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.lines())
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        for metric in self._metrics:
+            if hasattr(metric, 'reset'):
+                metric.reset()
+
+
+def instrument_handlers(server, latency, namespace='/', slow=None, slow_counter=None,
+                        clock=time.perf_counter):
+    """给已注册的 Socket.IO 事件处理函数加上计时，耗时记录到 latency（按事件名）
+
+    slow 为秒数：处理函数自己的运行时间超过它时记录一条 slow_handler 警告
+    （事件名、运行时间、总耗时、参数大小），并在 slow_counter 中计数。
+    在所有 @socketio.on 注册之后调用。
+
+    latency 记录从调用到返回的总耗时（客户端看到的延迟）。运行时间只计处理函数自己执行的时间：
+    协程按每一步 send 计时，await 等待的时间不计入；eventlet 下用 greenlet.settrace
+    记录切换，切换出去让其他绿色线程运行的时间不计入。这样一个处理函数卡住 hub 时，
+    只有它自己会被记为慢处理，同时被挂起的其他处理函数不会。
+    其他模式（threading）下每个处理函数有自己的线程，运行时间按总耗时计算。
+    """
+    runtime = None
+    if getattr(server, 'async_mode', None) == 'eventlet':
+        runtime = GreenletRunTime(clock)
+    handlers = server.handlers.get(namespace, {})
+    for event, handler in list(handlers.items()):
+        handlers[event] = _timed(event, handler, latency, slow, slow_counter, clock, runtime)
+
+
+def payload_size(event, args):
+    """事件参数（不含 sid）按 JSON 编码的字节数，只在处理过慢时计算"""
+    # connect 的参数是 (sid, environ, auth)，environ 不是客户端发送的数据
+    payload = args[2:] if event == 'connect' else args[1:]
+    if not payload:
+        return 0
+    return len(json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+class GreenletRunTime:
+    """累计绿色线程自己运行的时间
+
+    用 greenlet.settrace 记录每次切换，切换出去等待 I/O 或让给其他绿色线程的时间不计入。
+    只跟踪调用了 start() 的绿色线程，其他切换只多一次字典查找。
+    settrace 只对当前系统线程生效，需要在 hub 所在的线程中创建。
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        import greenlet
+        self._getcurrent = greenlet.getcurrent
+        self.clock = clock
+        # {greenlet: [已累计的运行时间, 最近一次切换进来的时间]}
+        self._running = {}
+        self._previous = greenlet.settrace(self._trace)
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            timing = self._running.get(origin)
+            if timing is not None:
+                timing[0] += self.clock() - timing[1]
+            timing = self._running.get(target)
+            if timing is not None:
+                timing[1] = self.clock()
+        if self._previous is not None:
+            self._previous(event, args)
+
+    def start(self):
+        self._running[self._getcurrent()] = [0.0, self.clock()]
+
+    def stop(self):
+        """停止跟踪当前绿色线程，返回 start() 以来的运行时间"""
+        spent, resumed = self._running.pop(self._getcurrent())
+        return spent + self.clock() - resumed
+
+
+@types.coroutine
+def _run_steps(coro, clock, spent):
+    """逐步驱动协程，把每一步实际执行的时间累加到 spent[0]（await 等待的时间不计入）"""
+    send, value = coro.send, None
+    while True:
+        start = clock()
+        try:
+            signal = send(value)
+        except StopIteration as e:
+            return e.value
+        finally:
+            spent[0] += clock() - start
+        try:
+            value = yield signal
+            send = coro.send
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            # 取消等异常转交给处理函数
+            value = e
+            send = coro.throw
+
+
+def _timed(event, handler, latency, slow, slow_counter, clock, runtime=None):
+    def record(start, running, args):
+        elapsed = clock() - start
+        latency.observe(elapsed, event)
+        if running is None:
+            running = elapsed
+        if slow is not None and running >= slow:
+            if slow_counter is not None:
+                slow_counter.inc(event)
+            log_event('slow_handler', logging.WARNING, handler=event,
+                      duration_ms=round(running * 1000, 1), wall_ms=round(elapsed * 1000, 1),
+                      payload_bytes=payload_size(event, args))
+
+    if inspect.iscoroutinefunction(handler):
+        # AsyncServer 的处理函数：总耗时计到协程执行完，运行时间只计每一步
+        @wraps(handler)
+        async def timed_async(*args):
+            start = clock()
+            spent = [0.0]
+            try:
+                return await _run_steps(handler(*args), clock, spent)
+            finally:
+                record(start, spent[0], args)
+        return timed_async
+
+    @wraps(handler)
+    def timed(*args):
+        start = clock()
+        if runtime is not None:
+            runtime.start()
+        try:
+            return handler(*args)
+        finally:
+            record(start, runtime.stop() if runtime is not None else None, args)
+    return timed
+
+
+class LoopLagMonitor:
+    """测量 hub 的调度延迟
+
+    后台任务每隔 interval 睡眠一次，实际醒来的时间比预期晚多少就是延迟：
+    有处理函数长时间不让出 hub 时，所有连接都要等这么久。
+    延迟记录到 histogram，超过 warn_threshold 时记录一条 loop_lag 警告。
+    """
+
+    def __init__(self, socketio, histogram, interval=0.1, warn_threshold=0.1,
+                 clock=time.monotonic):
+        self.socketio = socketio
+        self.histogram = histogram
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.clock = clock
+        # 最近一次和启动以来最大的延迟（秒）
+        self.last = 0.0
+        self.max = 0.0
+        self._task = None
+        self._running = False
+
+    def start(self):
+        """启动后台任务（只启动一次）"""
+        if self._task is None:
+            self._running = True
+            self._task = self.socketio.start_background_task(self._run)
+
+    def stop(self):
+        self._running = False
+
+    def _run(self):
+        while self._running:
+            self.sample()
+
+    def sample(self):
+        """睡眠一个间隔，返回这一次的延迟"""
+        start = self.clock()
+        self.socketio.sleep(self.interval)
+        return self._record(start)
+
+    def _record(self, start):
+        lag = max(0.0, self.clock() - start - self.interval)
+        self.last = lag
+        self.max = max(self.max, lag)
+        self.histogram.observe(lag)
+        if self.warn_threshold is not None and lag >= self.warn_threshold:
+            log_event('loop_lag', logging.WARNING, lag_ms=round(lag * 1000, 1))
+        return lag
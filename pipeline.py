@@ -0,0 +1,147 @@
+# pipeline.py - 按房间保持顺序的消息发布：耗时的准备工作在工作线程池中执行
+import logging
+import threading
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from images import green_patched
+
+logger = logging.getLogger('chat.pipeline')
+
+# 默认工作线程数
+DEFAULT_PIPELINE_WORKERS = 4
+
+
+class _Entry:
+    __slots__ = ('publish', 'done', 'result', 'error')
+
+    def __init__(self, publish):
+        self.publish = publish
+        self.done = False
+        self.result = None
+        self.error = None
+
+
+class RoomPipeline:
+    """按房间排队发布消息
+
+    需要准备的消息（例如解码、保存图片）把 prepare 放到有上限的线程池中执行，
+    hub 可以继续处理其他连接；准备完成后按提交顺序调用 publish(result, error)。
+    同一个房间里，后发的文字消息不会超过前面还在处理的图片。
+    房间没有排队的消息时，不需要准备的消息直接发布。
+
+    线程池只适合释放 GIL 的工作（文件读写、哈希）；解码像素这类纯 CPU 的工作
+    仍然交给 ImageProcessor 的进程池。
+    """
+
+    def __init__(self, socketio, workers=DEFAULT_PIPELINE_WORKERS):
+        self.socketio = socketio
+        self.workers = workers
+        # {room: deque(_Entry)}
+        self._rooms = {}
+        # 正在按顺序发布的房间，同一个房间同时只有一个任务在发布
+        self._draining = set()
+        self._slots = None
+        self._executor = None
+        # threading 模式下 prepare 完成后在不同的系统线程中发布，检查和修改队列要加锁；
+        # eventlet 下只在 hub 切换时交错，不能用系统锁（持锁切换出去会卡住整个 hub）
+        if getattr(socketio, 'async_mode', None) == 'threading':
+            self._lock = threading.Lock()
+        else:
+            self._lock = nullcontext()
+
+    def submit(self, room, publish, prepare=None, *args):
+        with self._lock:
+            queue = self._rooms.get(room)
+            if prepare is None and not queue and room not in self._draining:
+                # 房间空闲，直接发布；发布期间到达的消息排队，由这里接着发布
+                self._draining.add(room)
+                entry = None
+            else:
+                entry = _Entry(publish)
+                if queue is None:
+                    queue = self._rooms[room] = deque()
+                queue.append(entry)
+                if prepare is None:
+                    entry.done = True
+        if entry is None:
+            try:
+                publish(None, None)
+            finally:
+                self._drain(room, owner=True)
+        elif prepare is not None:
+            self.socketio.start_background_task(self._prepare, room, entry, prepare, args)
+
+    def pending(self, room=None):
+        """排队中的消息数"""
+        if room is not None:
+            return len(self._rooms.get(room, ()))
+        return sum(len(queue) for queue in self._rooms.values())
+
+    def wait(self, interval=0.01):
+        """等待所有排队的消息发布完成"""
+        while self._rooms:
+            self.socketio.sleep(interval)
+
+    def _prepare(self, room, entry, prepare, args):
+        try:
+            entry.result = self._call(prepare, *args)
+        except Exception as e:
+            entry.error = e
+        entry.done = True
+        self._drain(room)
+
+    def _call(self, func, *args):
+        if self.socketio.async_mode == 'eventlet':
+            from eventlet import tpool
+            from eventlet.semaphore import Semaphore
+            # 信号量限制同时处理的消息数
+            if self._slots is None:
+                self._slots = Semaphore(self.workers)
+            with self._slots:
+                if green_patched():
+                    # 打了猴子补丁后等待转码的 future 是绿色的，不能在系统线程中等待；
+                    # prepare 在当前绿色线程中执行，由它自己把阻塞的步骤放到 tpool
+                    # （见 ImageProcessor.blocking）
+                    return func(*args)
+                # tpool 在系统线程中执行
+                return tpool.execute(func, *args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='pipeline')
+        return self._executor.submit(func, *args).result()
+
+    def _drain(self, room, owner=False):
+        """按顺序发布房间队首已经准备好的消息
+
+        owner 为 True 时调用方已经占用了这个房间（见 submit 的直接发布）。
+        """
+        with self._lock:
+            if not owner:
+                if room in self._draining:
+                    # 正在发布的任务会接着检查队首
+                    return
+                self._draining.add(room)
+        try:
+            while True:
+                with self._lock:
+                    queue = self._rooms.get(room)
+                    if not queue or not queue[0].done:
+                        # 检查队首和释放房间在同一次加锁中完成，之后入队的消息由它自己的任务发布
+                        if queue is not None and not queue:
+                            del self._rooms[room]
+                        self._draining.discard(room)
+                        return
+                    entry = queue.popleft()
+                try:
+                    entry.publish(entry.result, entry.error)
+                except Exception:
+                    logger.exception('消息发布失败')
+        except BaseException:
+            with self._lock:
+                self._draining.discard(room)
+            raise
+
+    def reset(self):
+        self._rooms.clear()
+        self._draining.clear()
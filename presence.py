@@ -0,0 +1,105 @@
+# presence.py - 在线用户列表广播调度
+# 默认合并窗口（秒）
+DEFAULT_PRESENCE_WINDOW = 0.25
+
+
+class PresenceScheduler:
+    """按房间合并成员变化，每个窗口最多广播一次增量
+
+    窗口内的加入/离开只记录下来，窗口结束时发送一条带版本号的
+    online_users_delta（只含增删的用户）。客户端发现版本号不连续时
+    再请求完整列表。完整列表按房间缓存到下一个版本：缓存之后的变化
+    都会出现在下一条增量里，客户端按 user_id 应用增量，重复的增删没有影响。
+    """
+
+    def __init__(self, socketio, roster, count, window=DEFAULT_PRESENCE_WINDOW):
+        self.socketio = socketio
+        # roster(room) 返回房间当前成员 [{'username', 'user_id'}, ...]
+        self.roster = roster
+        # count(room) 返回房间人数，发送增量时不必构造完整列表
+        self.count = count
+        self.window = window
+        # {room: {'added': {user_id: user}, 'removed': {user_id: user}}}
+        self._pending = {}
+        self._versions = {}
+        # 完整列表缓存 {room: snapshot}
+        self._snapshots = {}
+
+    def version(self, room):
+        return self._versions.get(room, 0)
+
+    def user_joined(self, room, user):
+        changes = self._changes(room)
+        changes['removed'].pop(user['user_id'], None)
+        changes['added'][user['user_id']] = user
+        self._schedule(room)
+
+    def user_left(self, room, user):
+        changes = self._changes(room)
+        # 即使是窗口内刚加入的用户也要发送移除，
+        # 期间拿到完整列表的客户端可能已经显示了他
+        changes['added'].pop(user['user_id'], None)
+        changes['removed'][user['user_id']] = user
+        self._schedule(room)
+
+    def snapshot(self, room):
+        """房间的完整在线列表及其版本号"""
+        snapshot = self._snapshots.get(room)
+        if snapshot is None:
+            users = self.roster(room)
+            snapshot = self._snapshots[room] = {
+                'users': users,
+                'count': len(users),
+                'version': self.version(room)
+            }
+        return snapshot
+
+    def _changes(self, room):
+        changes = self._pending.get(room)
+        if changes is None:
+            changes = self._pending[room] = {'added': {}, 'removed': {}}
+            changes['scheduled'] = False
+        return changes
+
+    def _schedule(self, room):
+        if self.window <= 0:
+            self.flush(room)
+            return
+        changes = self._pending[room]
+        if not changes['scheduled']:
+            changes['scheduled'] = True
+            self.socketio.start_background_task(self._flush_later, room)
+
+    def _flush_later(self, room):
+        self.socketio.sleep(self.window)
+        self.flush(room)
+
+    def flush(self, room=None):
+        """立即发送待处理的增量，不传房间时发送全部"""
+        rooms = list(self._pending) if room is None else [room]
+        for name in rooms:
+            changes = self._pending.pop(name, None)
+            if changes is None:
+                continue
+            if not changes['added'] and not changes['removed']:
+                continue
+            self._emit(name, changes)
+
+    def _emit(self, room, changes):
+        version = self._versions.get(room, 0) + 1
+        self._versions[room] = version
+        self._snapshots.pop(room, None)
+        # 版本号只在本进程内连续，增量只发给连接到本进程的客户端，
+        # 多进程部署时其他进程会根据同步过去的成员变化自己发送
+        self.socketio.emit('online_users_delta', {
+            'added': list(changes['added'].values()),
+            'removed': [user['user_id'] for user in changes['removed'].values()],
+            'count': self.count(room),
+            'version': version
+        }, room=room, ignore_queue=True)
+
+    def reset(self):
+        """丢弃所有待处理的增量、版本号和缓存"""
+        self._pending.clear()
+        self._versions.clear()
+        self._snapshots.clear()
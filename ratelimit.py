@@ -0,0 +1,59 @@
+# ratelimit.py - 按连接、按事件类型的令牌桶限流
+import collections
+import time
+
+
+class TokenBucket:
+    """令牌桶：按 rate（个/秒）补充令牌，最多存 burst 个"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    """每个连接每种事件一个令牌桶
+
+    limits 是 {事件名: (rate, burst)}，没有配置的事件不限流。
+    每个连接只保存配置了的几个桶，连接断开时调用 forget 释放。
+    """
+
+    def __init__(self, limits, clock=time.monotonic):
+        self.limits = dict(limits)
+        self.clock = clock
+        self.enabled = True
+        # {sid: {事件名: TokenBucket}}
+        self._buckets = {}
+        # 每种事件被丢弃的次数
+        self.dropped = collections.Counter()
+
+    def allow(self, sid, event):
+        """消耗一个令牌，令牌不够时返回 False 并计数"""
+        limit = self.limits.get(event)
+        if limit is None or not self.enabled:
+            return True
+        rate, burst = limit
+        now = self.clock()
+        buckets = self._buckets.get(sid)
+        if buckets is None:
+            buckets = self._buckets[sid] = {}
+        bucket = buckets.get(event)
+        if bucket is None:
+            bucket = buckets[event] = TokenBucket(burst, now)
+        else:
+            bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            self.dropped[event] += 1
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def forget(self, sid):
+        self._buckets.pop(sid, None)
+
+    def reset(self):
+        self._buckets.clear()
+        self.dropped.clear()
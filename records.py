@@ -0,0 +1,91 @@
+# records.py - 聊天消息和在线用户的紧凑记录
+import sys
+
+
+def _intern(value):
+    # 客户端传来的值不一定是字符串
+    return sys.intern(value) if type(value) is str else value
+
+
+class Record:
+    """使用 __slots__ 保存字段的记录，比 dict 省内存
+
+    支持 record['key']、record.get('key') 和 'key' in record，
+    原来按 dict 读取的代码不用修改。只在发送给客户端、写入存储
+    或同步到其他进程时才用 to_dict() 转换成 dict。
+    OPTIONAL 中的字段为 None 时不出现在 to_dict() 的结果里。
+    """
+
+    __slots__ = ()
+    OPTIONAL = ()
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def to_dict(self):
+        data = {}
+        for key in self.__slots__:
+            value = getattr(self, key)
+            if value is not None or key not in self.OPTIONAL:
+                data[key] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{key: data[key] for key in cls.__slots__ if key in data})
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+class ChatMessage(Record):
+    """一条聊天消息，用户名、用户 ID 和类型使用驻留字符串"""
+
+    __slots__ = ('username', 'message', 'type', 'time', 'user_id', 'image', 'id')
+    OPTIONAL = ('image', 'id')
+
+    def __init__(self, username='', message='', type='text', time='', user_id='',
+                 image=None, id=None):
+        self.username = _intern(username)
+        self.message = message
+        self.type = _intern(type)
+        self.time = time
+        self.user_id = _intern(user_id)
+        # 图片消息的引用 {hash, mime, width, height, thumb}
+        self.image = image
+        self.id = id
+
+
+class UserInfo(Record):
+    """一个在线连接的用户信息"""
+
+    __slots__ = ('username', 'user_id', 'room')
+
+    def __init__(self, username, user_id, room='general'):
+        self.username = _intern(username)
+        self.user_id = _intern(user_id)
+        self.room = _intern(room)
+
+
+def as_dict(record):
+    """记录转换成 dict，本来就是 dict 时原样返回"""
+    return record.to_dict() if isinstance(record, Record) else record
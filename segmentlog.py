@@ -0,0 +1,296 @@
+# segmentlog.py - 按房间分段的追加写消息日志
+import bisect
+import contextlib
+import json
+import mmap
+import os
+import shutil
+import struct
+
+from history import BackgroundWriter, _native_threading
+
+# 每条记录：4 字节长度 + 8 字节消息 id（大端）+ JSON 正文
+RECORD_HEADER = struct.Struct('>IQ')
+# 稀疏索引项：(序号, 文件偏移, 消息 id)
+INDEX_ENTRY = struct.Struct('>QQQ')
+
+# 单个分段的大小上限，超过后切换到新分段
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+# 每隔多少条记录写一个索引项
+DEFAULT_INDEX_INTERVAL = 64
+# 每个房间最多保留的消息条数，更早的分段整段删除
+DEFAULT_RETENTION = 100000
+
+
+class Segment:
+    """一个分段文件：base 是第一条记录的序号"""
+
+    __slots__ = ('base', 'path', 'size', 'count', 'index')
+
+    def __init__(self, base, path):
+        self.base = base
+        self.path = path
+        self.size = 0
+        self.count = 0
+        # [(序号, 偏移, 消息 id)]，按序号递增
+        self.index = []
+
+    @property
+    def end(self):
+        return self.base + self.count
+
+    @property
+    def index_path(self):
+        return self.path[:-len('.log')] + '.idx'
+
+    def snapshot(self):
+        """读取用的副本，写线程之后追加的记录不会影响它"""
+        copy = Segment(self.base, self.path)
+        copy.size, copy.count, copy.index = self.size, self.count, list(self.index)
+        return copy
+
+
+def _scan(buf, offset, size):
+    """从 offset 开始逐条遍历完整的记录，产生 (消息 id, 正文起点, 正文终点)"""
+    while offset + RECORD_HEADER.size <= size:
+        length, message_id = RECORD_HEADER.unpack_from(buf, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > size:
+            break
+        yield message_id, start, start + length
+        offset = start + length
+
+
+class SegmentLogStore(BackgroundWriter):
+    """追加写的分段日志聊天记录存储
+
+    每个房间一个目录，消息按顺序追加到 <起始序号>.log 分段中，
+    分段写满后切换到新文件，超过保留条数的旧分段整段删除。
+    每隔 index_interval 条记录在 .idx 中记下 (序号, 偏移, 消息 id)，
+    读取时先二分查找索引，再通过 mmap 从该位置顺序解析。
+    写入由后台线程批量完成，每批每个分段只 fsync 一次。
+    分段的大小、条数和索引记在内存中，同一个目录只能有一个写入进程。
+    """
+
+    def __init__(self, root, segment_size=DEFAULT_SEGMENT_SIZE,
+                 index_interval=DEFAULT_INDEX_INTERVAL, retention=DEFAULT_RETENTION,
+                 batch_size=256, flush_interval=0.05):
+        self.root = root
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+        self.retention = retention
+        # {room: [Segment]}，第一次访问房间时从磁盘恢复
+        self._rooms = {}
+        threading, _ = _native_threading()
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        super().__init__(batch_size, flush_interval, name='segment-log-writer')
+
+    def _room_dir(self, room):
+        # 房间名可能包含任意字符，目录名用十六进制编码
+        return os.path.join(self.root, room.encode('utf-8').hex())
+
+    def _segments(self, room):
+        """房间的分段列表（调用方持有锁）"""
+        segments = self._rooms.get(room)
+        if segments is None:
+            segments = self._rooms[room] = self._recover(self._room_dir(room))
+        return segments
+
+    def _recover(self, directory):
+        """扫描目录恢复分段：读取稀疏索引，只解析最后一个索引项之后的记录"""
+        segments = []
+        try:
+            names = sorted(name for name in os.listdir(directory) if name.endswith('.log'))
+        except FileNotFoundError:
+            return segments
+        for name in names:
+            segment = Segment(int(name[:-len('.log')]), os.path.join(directory, name))
+            try:
+                with open(segment.index_path, 'rb') as f:
+                    data = f.read()
+                usable = len(data) - len(data) % INDEX_ENTRY.size
+                segment.index = [entry for entry in INDEX_ENTRY.iter_unpack(data[:usable])]
+            except FileNotFoundError:
+                pass
+            size = os.path.getsize(segment.path)
+            # 索引指向文件末尾之外（崩溃时没写完）的项丢弃
+            while segment.index and segment.index[-1][1] >= size:
+                segment.index.pop()
+            seq, offset, _ = segment.index[-1] if segment.index else (segment.base, 0, 0)
+            if size:
+                with open(segment.path, 'rb') as f, \
+                        mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as buf:
+                    for _, _, end in _scan(buf, offset, size):
+                        seq, offset = seq + 1, end
+            if offset < size:
+                # 截掉崩溃时写了一半的记录
+                with open(segment.path, 'r+b') as f:
+                    f.truncate(offset)
+            segment.size, segment.count = offset, seq - segment.base
+            segments.append(segment)
+        return segments
+
+    def append(self, room, message):
+        """放入写队列，立即返回"""
+        self._submit(('append', room, message.get('id', 0),
+                      json.dumps(message, ensure_ascii=False).encode('utf-8')))
+
+    def clear(self, room=None):
+        """删除记录，等待写入完成后再返回"""
+        self._submit(('clear', room))
+        self.flush()
+
+    def load_recent(self, room, limit):
+        """房间最近的 limit 条消息（从旧到新）"""
+        with self._lock:
+            segments = [segment.snapshot() for segment in self._segments(room)]
+        if not segments or limit <= 0:
+            return []
+        return self._read_range(segments, segments[-1].end - limit, segments[-1].end)
+
+    def load_before(self, room, before, limit):
+        """id 小于 before 的最近 limit 条消息（从旧到新），before 为 None 时从最新开始"""
+        with self._lock:
+            segments = [segment.snapshot() for segment in self._segments(room)]
+        if not segments or limit <= 0:
+            return []
+        stop = segments[-1].end if before is None else self._locate(segments, before)
+        return self._read_range(segments, stop - limit, stop)
+
+    def _locate(self, segments, before):
+        """第一条 id >= before 的记录的序号"""
+        # 每个分段的第一个索引项就是它的第一条记录
+        segment = None
+        for candidate in reversed(segments):
+            if candidate.index and candidate.index[0][2] < before:
+                segment = candidate
+                break
+        if segment is None:
+            return segments[0].base
+        ids = [entry[2] for entry in segment.index]
+        seq, offset, _ = segment.index[bisect.bisect_left(ids, before) - 1]
+        with self._map(segment) as buf:
+            if buf is None:
+                return segment.base
+            for message_id, _, _ in _scan(buf, offset, segment.size):
+                if seq >= segment.end or message_id >= before:
+                    break
+                seq += 1
+        return seq
+
+    def _read_range(self, segments, start, stop):
+        """读取序号在 [start, stop) 之间的记录"""
+        start = max(start, segments[0].base)
+        messages = []
+        for segment in segments:
+            if segment.end > start and segment.base < stop:
+                messages.extend(self._read(segment, max(start, segment.base), min(stop, segment.end)))
+        return messages
+
+    @contextlib.contextmanager
+    def _map(self, segment):
+        """只读映射分段文件，文件已被压缩删除时产生 None"""
+        try:
+            f = open(segment.path, 'rb')
+        except FileNotFoundError:
+            yield None
+            return
+        with f, mmap.mmap(f.fileno(), segment.size, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+    def _read(self, segment, start, stop):
+        """通过 mmap 读取分段中序号在 [start, stop) 之间的记录"""
+        if not segment.count:
+            return []
+        # 找到不超过 start 的最后一个索引项，从那里开始解析
+        pos = bisect.bisect_right(segment.index, (start, float('inf')))
+        seq, offset, _ = segment.index[pos - 1] if pos else (segment.base, 0, 0)
+        messages = []
+        with self._map(segment) as buf:
+            if buf is None:
+                return messages
+            # 跳过的记录只读长度头，需要的记录才切出正文交给 json 解析
+            for _, body_start, body_end in _scan(buf, offset, segment.size):
+                if seq >= stop:
+                    break
+                if seq >= start:
+                    messages.append(json.loads(buf[body_start:body_end]))
+                seq += 1
+        return messages
+
+    def _write_batch(self, batch):
+        touched = {}
+        for op in batch:
+            if op[0] == 'append':
+                _, room, message_id, data = op
+                self._write_record(room, message_id, data, touched)
+            else:
+                self._clear(op[1], touched)
+        # 每个文件只 fsync 一次
+        for f in touched.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        for room in {room for room, _ in touched}:
+            self._compact(room)
+
+    def _write_record(self, room, message_id, data, touched):
+        with self._lock:
+            segments = self._segments(room)
+            if not segments or segments[-1].size >= self.segment_size:
+                # 分段写满，切换到新文件
+                os.makedirs(self._room_dir(room), exist_ok=True)
+                base = segments[-1].end if segments else 0
+                segments.append(Segment(base, os.path.join(self._room_dir(room), f'{base:020d}.log')))
+            segment = segments[-1]
+        log = self._open(touched, room, segment.path)
+        if segment.count % self.index_interval == 0:
+            entry = (segment.end, segment.size, message_id)
+            self._open(touched, room, segment.index_path).write(INDEX_ENTRY.pack(*entry))
+        else:
+            entry = None
+        log.write(RECORD_HEADER.pack(len(data), message_id))
+        log.write(data)
+        # 写入文件后再更新元数据，读取时只会看到完整的记录
+        log.flush()
+        with self._lock:
+            if entry is not None:
+                segment.index.append(entry)
+            segment.size += RECORD_HEADER.size + len(data)
+            segment.count += 1
+
+    @staticmethod
+    def _open(touched, room, path):
+        f = touched.get((room, path))
+        if f is None:
+            f = touched[(room, path)] = open(path, 'ab')
+        return f
+
+    def _clear(self, room, touched):
+        for key in [key for key in touched if room is None or key[0] == room]:
+            touched.pop(key).close()
+        with self._lock:
+            if room is None:
+                self._rooms.clear()
+                for name in os.listdir(self.root):
+                    shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            else:
+                self._rooms.pop(room, None)
+                shutil.rmtree(self._room_dir(room), ignore_errors=True)
+
+    def _compact(self, room):
+        """删除超出保留条数的旧分段（最新的分段总是保留）"""
+        with self._lock:
+            segments = self._rooms.get(room)
+            if not segments:
+                return
+            expired = []
+            while len(segments) > 1 and segments[-1].end - segments[1].base >= self.retention:
+                expired.append(segments.pop(0))
+        for segment in expired:
+            for path in (segment.path, segment.index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
@@ -1,8 +1,14 @@
-const socket = io();
+// 优先使用 WebSocket：多进程部署时单个连接始终落在同一个工作进程上
+// 服务器开启 MessagePack 时页面会加载 msgpack-parser.js，否则使用默认的 JSON
+const socket = io(Object.assign(
+    { transports: ['websocket', 'polling'] },
+    window.msgpackParser ? { parser: window.msgpackParser } : {}
+));
 window.socket = socket; 
 let currentUsername = '';
 let isConnected = false;
-let typingTimer;
+// 上次发送 typing 的时间（毫秒）
+let lastTypingSent = 0;
 
 // DOM 元素
 let usernameContainer;
@@ -20,7 +26,18 @@ let usersPanel;
 let usersPanelOverlay;
 let usersList;
 
-let onlineUsers = [];
+// 在线用户 user_id -> 列表中的 DOM 元素
+let onlineUsers = new Map();
+// 当前在线列表的版本号，用来发现丢失的增量
+let presenceVersion = 0;
+let awaitingSnapshot = false;
+
+// 聊天记录分页：已显示的最早消息 id，是否还有更早的记录
+let oldestMessageId = null;
+let hasMoreHistory = true;
+let loadingHistory = false;
+// 已显示的消息 id，避免加入时实时收到的消息和第一页重复
+let displayedMessageIds = new Set();
 
 // 初始化 DOM 元素
 function initializeElements() {
@@ -52,10 +69,20 @@ function joinChat() {
     }
 
     currentUsername = username;
+    // 加入后服务器会发送新的完整列表
+    presenceVersion = 0;
     socket.emit('join', {
         username: username,
         room: 'general'
     });
+    // 页面里已经渲染了最近的消息，加入后再加载一页补上之后的新消息，
+    // 更早的在滚动到顶部时再加载
+    const rendered = messagesDiv.querySelectorAll('.message[data-id]');
+    displayedMessageIds = new Set(Array.from(rendered, el => Number(el.dataset.id)));
+    oldestMessageId = rendered.length > 0 ? Number(rendered[0].dataset.id) : null;
+    hasMoreHistory = true;
+    loadingHistory = false;
+    requestHistory(null);
 
     // 扩展聊天窗口
     console.log('开始扩展窗口');
@@ -93,6 +120,8 @@ function sendMessage() {
     messageInput.value = '';
     messageInput.style.height = 'auto'; // 重置高度
     messageInput.focus();
+    // 服务器收到消息后会清除正在输入状态，下次输入立即重新发送
+    lastTypingSent = 0;
 }
 
 // 处理图片选择
@@ -101,8 +130,8 @@ function handleImageSelect() {
 }
 
 // 压缩图片
-function compressImage(file, maxWidth = 10000, maxHeight = 10000, quality = 0.8) {
-    return new Promise((resolve) => {
+function compressImage(file, maxWidth = 2048, maxHeight = 2048, quality = 0.8) {
+    return new Promise((resolve, reject) => {
         const canvas = document.createElement('canvas');
         const ctx = canvas.getContext('2d');
         const img = new Image();
@@ -117,15 +146,35 @@ function compressImage(file, maxWidth = 10000, maxHeight = 10000, quality = 0.8)
             // 绘制压缩后的图片
             ctx.drawImage(img, 0, 0, width, height);
             
-            // 转换为base64
-            const compressedDataUrl = canvas.toDataURL('image/jpeg', quality);
-            resolve(compressedDataUrl);
+            // 转换为二进制，直接上传，不再编码成base64
+            canvas.toBlob(blob => {
+                if (blob) {
+                    resolve(blob);
+                } else {
+                    reject(new Error('toBlob failed'));
+                }
+            }, 'image/jpeg', quality);
         };
+        img.onerror = reject;
         
         img.src = URL.createObjectURL(file);
     });
 }
 
+// 上传图片，返回服务器生成的图片引用
+async function uploadImage(blob) {
+    const response = await fetch('/upload', {
+        method: 'POST',
+        headers: { 'Content-Type': blob.type },
+        body: blob
+    });
+    const data = await response.json();
+    if (!response.ok) {
+        throw new Error(data.error || 'upload failed');
+    }
+    return data;
+}
+
 // 计算新的图片尺寸
 function calculateNewDimensions(originalWidth, originalHeight, maxWidth, maxHeight) {
     let width = originalWidth;
@@ -164,12 +213,13 @@ async function handleImageFile(file) {
         imageButton.style.opacity = '0.5';
         imageButton.style.pointerEvents = 'none';
         
-        // 压缩图片
+        // 压缩并上传图片
         const compressedImage = await compressImage(file);
+        const imageRef = await uploadImage(compressedImage);
         
-        // 发送图片消息
+        // 消息中只发送图片的哈希
         socket.emit('send_message', {
-            message: compressedImage,
+            image: imageRef.hash,
             type: 'image'
         });
         
@@ -187,66 +237,112 @@ async function handleImageFile(file) {
     }
 }
 
-// 显示消息
-function displayMessage(data, isOwn = false, isSystem = false) {
+// 请求下一页（更早的）聊天记录
+function loadHistory() {
+    if (oldestMessageId === null) return;
+    requestHistory(oldestMessageId);
+}
+
+function requestHistory(before) {
+    if (loadingHistory || !hasMoreHistory) return;
+    loadingHistory = true;
+    socket.emit('load_history', { room: 'general', before: before });
+}
+
+// 把一页聊天记录插入到消息列表中
+function prependHistory(data) {
+    loadingHistory = false;
+    hasMoreHistory = data.has_more;
+    const messages = data.messages.filter(message => !displayedMessageIds.has(message.id));
+    messages.forEach(message => displayedMessageIds.add(message.id));
+    if (data.messages.length > 0 && (oldestMessageId === null || data.messages[0].id < oldestMessageId)) {
+        oldestMessageId = data.messages[0].id;
+    }
+
+    if (data.before === null) {
+        // 第一页：按 id 插到已渲染的消息之间，然后滚到底部
+        messages.forEach(message => {
+            const next = Array.from(messagesDiv.querySelectorAll('.message[data-id]'))
+                .find(el => Number(el.dataset.id) > message.id);
+            messagesDiv.insertBefore(createMessageElement(message, message.username === currentUsername), next || null);
+        });
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+        return;
+    }
+
+    // 更早的记录插到顶部，保持当前的滚动位置
+    const previousHeight = messagesDiv.scrollHeight;
+    const fragment = document.createDocumentFragment();
+    messages.forEach(message => {
+        fragment.appendChild(createMessageElement(message, message.username === currentUsername));
+    });
+    messagesDiv.insertBefore(fragment, messagesDiv.firstChild);
+    messagesDiv.scrollTop += messagesDiv.scrollHeight - previousHeight;
+}
+
+// 创建一条用户消息的元素
+function createMessageElement(data, isOwn) {
     const messageDiv = document.createElement('div');
-    messageDiv.className = `message ${isOwn ? 'own' : (isSystem ? 'system' : 'other')}`;
+    messageDiv.className = `message ${isOwn ? 'own' : 'other'}`;
+    if (data.id !== undefined) {
+        messageDiv.dataset.id = data.id;
+    }
+    const messageInfo = isOwn ? `您 ${data.time}` : `${data.username} ${data.time}`;
+
+    if (data.type === 'image') {
+        // 创建图片元素
+        const img = document.createElement('img');
+        img.src = data.message;
+        if (data.image) {
+            // 聊天流中只显示缩略图，点击后再加载原图
+            const thumb = data.image.thumb || data.image;
+            img.src = `/images/${thumb.hash}`;
+            // 提前占好图片的位置
+            img.width = thumb.width;
+            img.height = thumb.height;
+        }
+        img.className = 'chat-image';
+        img.alt = '聊天圖片';
+        img.onclick = () => openImageModal(data.message);
+
+        messageDiv.innerHTML = `<div class="message-info">${messageInfo}</div>`;
+        messageDiv.appendChild(img);
+    } else {
+        // 文字消息
+        messageDiv.innerHTML = `
+            <div class="message-info">${messageInfo}</div>
+            <div class="message-content">${data.message}</div>
+        `;
+    }
+    return messageDiv;
+}
 
+// 显示消息
+function displayMessage(data, isOwn = false, isSystem = false) {
     if (isSystem) {
+        const messageDiv = document.createElement('div');
+        messageDiv.className = 'message system';
         messageDiv.innerHTML = `<div class="message-content">${data.message}</div>`;
         messagesDiv.appendChild(messageDiv);
         messagesDiv.scrollTop = messagesDiv.scrollHeight;
     } else {
-        const messageInfo = isOwn ? `您 ${data.time}` : `${data.username} ${data.time}`;
-        
-        // let contentHtml = '';
-        // if (data.type === 'image') {
-        //     contentHtml = `<img src="${data.message}" class="chat-image" onclick="openImageModal('${data.message}')" alt="聊天图片">`;
-        // } else {
-        //     contentHtml = `<div class="message-content">${data.message}</div>`;
-        // }
-        
-        // messageDiv.innerHTML = `
-        //     <div class="message-info">${messageInfo}</div>
-        //     ${contentHtml}
-        // `;
-
-        if (data.type === 'image') {
-            // 创建图片元素
-            const img = document.createElement('img');
-            img.src = data.message;
-            img.className = 'chat-image';
-            img.alt = '聊天圖片';
-            img.onclick = () => openImageModal(data.message);
-            
-            // 先添加消息框架
-            messageDiv.innerHTML = `<div class="message-info">${messageInfo}</div>`;
-            messageDiv.appendChild(img);
-            messagesDiv.appendChild(messageDiv);
-            
-            // 立即滚动一次（滚动到消息框架位置）
-            messagesDiv.scrollTop = messagesDiv.scrollHeight;
-            
-            // 监听图片加载完成事件 - 一完成就滚动！
+        if (data.id !== undefined) {
+            displayedMessageIds.add(data.id);
+        }
+        const messageDiv = createMessageElement(data, isOwn);
+        messagesDiv.appendChild(messageDiv);
+        messagesDiv.scrollTop = messagesDiv.scrollHeight;
+
+        const img = messageDiv.querySelector('img');
+        if (img) {
+            // 图片加载完成（或失败）后再滚动一次
             img.addEventListener('load', () => {
                 messagesDiv.scrollTop = messagesDiv.scrollHeight;
             });
-            
-            // 如果图片加载失败，也要滚动
             img.addEventListener('error', () => {
                 messagesDiv.scrollTop = messagesDiv.scrollHeight;
             });
-            
-        } else {
-            // 文字消息
-            messageDiv.innerHTML = `
-                <div class="message-info">${messageInfo}</div>
-                <div class="message-content">${data.message}</div>
-            `;
-            messagesDiv.appendChild(messageDiv);
-            messagesDiv.scrollTop = messagesDiv.scrollHeight;
         }
-    
     }
 }
 
@@ -273,28 +369,65 @@ function openImageModal(imageSrc) {
 }
 
 
-function updateOnlineUsers(users, count) {
-    onlineUsers = users;
-    onlineCount.textContent = count;
+// 创建在线用户列表项
+function createUserItem(user) {
+    const userItem = document.createElement('div');
+    userItem.className = 'user-item';
+    
+    const isCurrentUser = user.username === currentUsername;
     
-    // 更新用户列表
+    userItem.innerHTML = `
+        <div class="user-avatar">${user.username.charAt(0).toUpperCase()}</div>
+        <div class="user-info">
+            <div class="user-name">${user.username}${isCurrentUser ? ' (你)' : ''}</div>
+            <div class="user-status">在線中</div>
+        </div>
+    `;
+    return userItem;
+}
+
+function addOnlineUser(user) {
+    if (onlineUsers.has(user.user_id)) return;
+    const userItem = createUserItem(user);
+    onlineUsers.set(user.user_id, userItem);
+    usersList.appendChild(userItem);
+}
+
+function removeOnlineUser(userId) {
+    const userItem = onlineUsers.get(userId);
+    if (!userItem) return;
+    userItem.remove();
+    onlineUsers.delete(userId);
+}
+
+// 用完整列表重建（加入时或版本号不连续时）
+function updateOnlineUsers(users, count, version) {
+    awaitingSnapshot = false;
+    // 比当前版本旧的列表直接忽略
+    if (version < presenceVersion) return;
+    
+    onlineUsers.clear();
     usersList.innerHTML = '';
-    users.forEach(user => {
-        const userItem = document.createElement('div');
-        userItem.className = 'user-item';
-        
-        const isCurrentUser = user.username === currentUsername;
-        
-        userItem.innerHTML = `
-            <div class="user-avatar">${user.username.charAt(0).toUpperCase()}</div>
-            <div class="user-info">
-                <div class="user-name">${user.username}${isCurrentUser ? ' (你)' : ''}</div>
-                <div class="user-status">在線中</div>
-            </div>
-        `;
-        
-        usersList.appendChild(userItem);
-    });
+    users.forEach(addOnlineUser);
+    presenceVersion = version;
+    onlineCount.textContent = count;
+}
+
+// 应用增量，只改动有变化的列表项
+function applyOnlineUsersDelta(data) {
+    if (awaitingSnapshot || data.version <= presenceVersion) return;
+    
+    if (data.version !== presenceVersion + 1) {
+        // 丢失了中间的增量，重新请求完整列表
+        awaitingSnapshot = true;
+        socket.emit('request_online_users');
+        return;
+    }
+    
+    data.removed.forEach(removeOnlineUser);
+    data.added.forEach(addOnlineUser);
+    presenceVersion = data.version;
+    onlineCount.textContent = data.count;
 }
 
 function toggleUsersPanel() {
@@ -320,14 +453,15 @@ function closeUsersPanel() {
     document.body.style.overflow = ''; // 恢复滚动
 }
 
+// 输入时定期告诉服务器，停止输入后服务器会自动让状态过期
+const TYPING_SEND_INTERVAL = 2000;
+
 // 更新正在输入状态
 function updateTyping() {
-    clearTimeout(typingTimer);
+    const now = Date.now();
+    if (now - lastTypingSent < TYPING_SEND_INTERVAL) return;
+    lastTypingSent = now;
     socket.emit('typing', { is_typing: true });
-    
-    typingTimer = setTimeout(() => {
-        socket.emit('typing', { is_typing: false });
-    }, 1000);
 }
 
 function autoResizeTextarea() {
@@ -392,6 +526,15 @@ function bindEventListeners() {
         });
     }
 
+    // 滚动到顶部时加载更早的聊天记录
+    if (messagesDiv) {
+        messagesDiv.addEventListener('scroll', function() {
+            if (messagesDiv.scrollTop < 50) {
+                loadHistory();
+            }
+        });
+    }
+
     // 发送按钮事件 (可以通过全局函数调用)
     window.sendMessage = sendMessage;
     window.joinChat = joinChat;
@@ -417,7 +560,13 @@ function setupSocketEvents() {
         displayMessage(data, false, true);
     });
     socket.on('online_users_update', function(data) {
-        updateOnlineUsers(data.users, data.count);
+        updateOnlineUsers(data.users, data.count, data.version);
+    });
+    socket.on('online_users_delta', function(data) {
+        applyOnlineUsersDelta(data);
+    });
+    socket.on('history_page', function(data) {
+        prependHistory(data);
     });
     // 接收消息
     socket.on('receive_message', function(data) {
@@ -426,9 +575,12 @@ function setupSocketEvents() {
     });
 
     // 正在输入提示
-    socket.on('user_typing', function(data) {
-        if (data.is_typing) {
-            typingIndicator.textContent = `${data.username} 正在输入...`;
+    socket.on('users_typing', function(data) {
+        const names = data.users
+            .filter(user => user.username !== currentUsername)
+            .map(user => user.username);
+        if (names.length) {
+            typingIndicator.textContent = `${names.join('、')} 正在输入...`;
             typingIndicator.style.display = 'block';
         } else {
             typingIndicator.style.display = 'none';
@@ -0,0 +1,225 @@
+// Socket.IO 的 MessagePack 解析器（与服务器的 MsgPackPacket 格式一致）
+// 每个 Socket.IO 数据包编码成一个 {type, data, nsp, id} 的 MessagePack 二进制帧，
+// 二进制数据（Uint8Array / ArrayBuffer）直接放在包里，不需要附件。
+(function () {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    // ---- 编码 ----
+    function encode(value) {
+        const bytes = [];
+        write(value, bytes);
+        return new Uint8Array(bytes).buffer;
+    }
+
+    function pushUint(bytes, value, size) {
+        for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            bytes.push(Math.floor(value / Math.pow(2, shift)) & 0xff);
+        }
+    }
+
+    function pushFloat64(bytes, value) {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setFloat64(0, value);
+        bytes.push(0xcb, ...new Uint8Array(view.buffer));
+    }
+
+    function pushLength(bytes, length, fix, fixMax, codes) {
+        if (fix !== null && length <= fixMax) {
+            bytes.push(fix | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            bytes.push(codes[0], length);
+        } else if (length < 0x10000) {
+            bytes.push(codes[1]);
+            pushUint(bytes, length, 2);
+        } else {
+            bytes.push(codes[2]);
+            pushUint(bytes, length, 4);
+        }
+    }
+
+    function write(value, bytes) {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false) {
+            bytes.push(0xc2);
+        } else if (value === true) {
+            bytes.push(0xc3);
+        } else if (typeof value === 'number') {
+            if (!Number.isInteger(value) || Math.abs(value) > 0xffffffff) {
+                pushFloat64(bytes, value);
+            } else if (value >= 0) {
+                if (value < 0x80) bytes.push(value);
+                else if (value < 0x100) bytes.push(0xcc, value);
+                else if (value < 0x10000) { bytes.push(0xcd); pushUint(bytes, value, 2); }
+                else { bytes.push(0xce); pushUint(bytes, value, 4); }
+            } else if (value >= -0x20) {
+                bytes.push(value & 0xff);
+            } else if (value >= -0x80) {
+                bytes.push(0xd0, value & 0xff);
+            } else if (value >= -0x8000) {
+                bytes.push(0xd1);
+                pushUint(bytes, value & 0xffff, 2);
+            } else if (value >= -0x80000000) {
+                bytes.push(0xd2);
+                pushUint(bytes, value >>> 0, 4);
+            } else {
+                pushFloat64(bytes, value);
+            }
+        } else if (typeof value === 'string') {
+            const utf8 = textEncoder.encode(value);
+            pushLength(bytes, utf8.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+            for (let i = 0; i < utf8.length; i++) bytes.push(utf8[i]);
+        } else if (value instanceof ArrayBuffer || ArrayBuffer.isView(value)) {
+            const data = value instanceof ArrayBuffer
+                ? new Uint8Array(value)
+                : new Uint8Array(value.buffer, value.byteOffset, value.byteLength);
+            pushLength(bytes, data.length, null, 0, [0xc4, 0xc5, 0xc6]);
+            for (let i = 0; i < data.length; i++) bytes.push(data[i]);
+        } else if (Array.isArray(value)) {
+            pushLength(bytes, value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+            value.forEach(item => write(item, bytes));
+        } else if (typeof value === 'object') {
+            const keys = Object.keys(value).filter(key => value[key] !== undefined);
+            pushLength(bytes, keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+            keys.forEach(key => {
+                write(key, bytes);
+                write(value[key], bytes);
+            });
+        } else {
+            throw new Error(`msgpack: unsupported type ${typeof value}`);
+        }
+    }
+
+    // ---- 解码 ----
+    function decode(buffer) {
+        const bytes = buffer instanceof ArrayBuffer ? new Uint8Array(buffer) : buffer;
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let pos = 0;
+
+        function str(length) {
+            const value = textDecoder.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+
+        function bin(length) {
+            const value = bytes.slice(pos, pos + length);
+            pos += length;
+            return value;
+        }
+
+        function array(length) {
+            const value = new Array(length);
+            for (let i = 0; i < length; i++) value[i] = read();
+            return value;
+        }
+
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function next(size, getter) {
+            const value = view[getter](pos);
+            pos += size;
+            return value;
+        }
+
+        function read() {
+            const code = bytes[pos++];
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(next(1, 'getUint8'));
+                case 0xc5: return bin(next(2, 'getUint16'));
+                case 0xc6: return bin(next(4, 'getUint32'));
+                case 0xca: return next(4, 'getFloat32');
+                case 0xcb: return next(8, 'getFloat64');
+                case 0xcc: return next(1, 'getUint8');
+                case 0xcd: return next(2, 'getUint16');
+                case 0xce: return next(4, 'getUint32');
+                case 0xcf: return Number(next(8, 'getBigUint64'));
+                case 0xd0: return next(1, 'getInt8');
+                case 0xd1: return next(2, 'getInt16');
+                case 0xd2: return next(4, 'getInt32');
+                case 0xd3: return Number(next(8, 'getBigInt64'));
+                case 0xd9: return str(next(1, 'getUint8'));
+                case 0xda: return str(next(2, 'getUint16'));
+                case 0xdb: return str(next(4, 'getUint32'));
+                case 0xdc: return array(next(2, 'getUint16'));
+                case 0xdd: return array(next(4, 'getUint32'));
+                case 0xde: return map(next(2, 'getUint16'));
+                case 0xdf: return map(next(4, 'getUint32'));
+            }
+            throw new Error(`msgpack: unsupported code 0x${code.toString(16)}`);
+        }
+
+        return read();
+    }
+
+    // ---- Socket.IO 解析器接口 ----
+    class Emitter {
+        constructor() {
+            this.listeners = {};
+        }
+        on(event, fn) {
+            (this.listeners[event] = this.listeners[event] || []).push(fn);
+            return this;
+        }
+        off(event, fn) {
+            if (!event) {
+                this.listeners = {};
+            } else if (!fn) {
+                delete this.listeners[event];
+            } else {
+                this.listeners[event] = (this.listeners[event] || []).filter(f => f !== fn);
+            }
+            return this;
+        }
+        emit(event, ...args) {
+            (this.listeners[event] || []).slice().forEach(fn => fn.apply(this, args));
+            return this;
+        }
+    }
+
+    class Encoder {
+        encode(packet) {
+            return [encode(packet)];
+        }
+    }
+
+    class Decoder extends Emitter {
+        add(data) {
+            const packet = decode(data);
+            if (typeof packet !== 'object' || packet === null || typeof packet.type !== 'number') {
+                throw new Error('msgpack: invalid packet');
+            }
+            if (packet.nsp === undefined || packet.nsp === null) {
+                packet.nsp = '/';
+            }
+            this.emit('decoded', packet);
+        }
+        destroy() {
+            this.off();
+        }
+    }
+
+    window.msgpackParser = {
+        protocol: 5,
+        Encoder: Encoder,
+        Decoder: Decoder,
+        encode: encode,
+        decode: decode
+    };
+})();
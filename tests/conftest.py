@@ -11,6 +11,12 @@ from selenium.webdriver.chrome.options import Options
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# 测试使用单独的聊天记录数据库
+import tempfile
+os.environ.setdefault('CHAT_HISTORY_DB', os.path.join(tempfile.mkdtemp(), 'test_history.db'))
+# 测试会在一个循环里快速发送大量事件，限流由专门的测试打开
+os.environ.setdefault('CHAT_RATE_LIMIT', '0')
+
 @pytest.fixture(scope="session")
 def server_url():
     """服务器URL fixture"""
@@ -49,18 +55,28 @@ def browser():
 def clean_test_data():
     """每次测试前清理数据"""
     try:
-        from app import online_users, chat_messages
+        from app import (online_users, room_members, chat_messages, presence, typing_indicator,
+                         message_pipeline)
         online_users.clear()
+        room_members.clear()
         chat_messages.clear()
+        presence.reset()
+        typing_indicator.reset()
+        message_pipeline.reset()
     except ImportError:
         pass
     
     yield
     
     try:
-        from app import online_users, chat_messages
+        from app import (online_users, room_members, chat_messages, presence, typing_indicator,
+                         message_pipeline)
         online_users.clear()
+        room_members.clear()
         chat_messages.clear()
+        presence.reset()
+        typing_indicator.reset()
+        message_pipeline.reset()
     except ImportError:
         pass
 
@@ -77,6 +93,21 @@ def sample_image_base64():
     """测试图片数据fixture"""
     return "data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8/5+hHgAHggJ/PchI7wAAAABJRU5ErkJggg=="
 
+@pytest.fixture
+def sample_image_bytes(sample_image_base64):
+    """测试图片二进制数据fixture"""
+    import base64
+    return base64.b64decode(sample_image_base64.split(',', 1)[1])
+
+@pytest.fixture
+def image_store(tmp_path, monkeypatch):
+    """临时图片存储fixture"""
+    import app as app_module
+    from blobstore import BlobStore
+    store = BlobStore(str(tmp_path / 'uploads'))
+    monkeypatch.setattr(app_module, 'image_store', store)
+    return store
+
 @pytest.fixture
 def socketio_client():
     """SocketIO客户端fixture"""
@@ -0,0 +1,299 @@
+# tests/test_asgi.py - asyncio（AsyncServer + ASGI）入口测试
+import pytest
+import sys
+import os
+import asyncio
+import json
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import asgi_app
+from asgi_app import sio, chat_messages, presence, typing_indicator, message_pipeline
+from blobstore import BlobStore
+
+
+@pytest.fixture
+def sent():
+    """记录服务器发出的事件 [(eio_sid, 事件名, 参数)]"""
+    sent = []
+
+    def record(eio_sid, data):
+        if isinstance(data, str) and data.startswith('2'):
+            event, *args = json.loads(data[1:])
+            sent.append((eio_sid, event, args[0] if args else None))
+
+    async def send(eio_sid, data):
+        record(eio_sid, data)
+
+    async def send_packet(eio_sid, pkt):
+        record(eio_sid, pkt.data)
+
+    original = sio.eio.send, sio.eio.send_packet
+    sio.eio.send, sio.eio.send_packet = send, send_packet
+    # 事件处理函数直接执行完再返回，不放到后台任务
+    sio.async_handlers = False
+    yield sent
+    sio.async_handlers = True
+    sio.eio.send, sio.eio.send_packet = original
+    for state in (asgi_app.online_users, asgi_app.room_members):
+        state.clear()
+    presence.reset()
+    typing_indicator.reset()
+    message_pipeline.reset()
+    chat_messages.history.clear()
+
+
+async def connect(eio_sid):
+    await sio._handle_eio_connect(eio_sid, {})
+    await sio._handle_eio_message(eio_sid, '0')
+
+
+async def emit(eio_sid, event, data=None):
+    await sio._handle_eio_message(eio_sid, '2' + json.dumps([event, data]))
+    # 让后台任务（在线列表、正在输入的广播）有机会执行
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def image_store(tmp_path, monkeypatch):
+    """临时图片存储fixture"""
+    store = BlobStore(str(tmp_path / 'uploads'))
+    monkeypatch.setattr(asgi_app, 'image_store', store)
+    return store
+
+
+def request(method, path, chunks=(b'',), headers=(), on_receive=None):
+    """直接调用 http_app，返回 (状态码, 响应头, 按块收到的响应体列表, 读取请求体的次数)
+
+    on_receive(n) 在第 n 次读取请求体时调用。
+    """
+    pending = list(chunks)
+    responses = []
+    reads = []
+
+    async def receive():
+        reads.append(1)
+        if on_receive is not None:
+            on_receive(len(reads))
+        body = pending.pop(0)
+        return {'type': 'http.request', 'body': body, 'more_body': bool(pending)}
+
+    async def send(message):
+        responses.append(message)
+
+    scope = {'type': 'http', 'path': path, 'method': method, 'headers': list(headers)}
+    asyncio.run(asgi_app.http_app(scope, receive, send))
+    start, *bodies = responses
+    return (start['status'], dict(start['headers']),
+            [body['body'] for body in bodies if body['body']], len(reads))
+
+
+def events(sent, eio_sid, name):
+    return [args for sid, event, args in sent if sid == eio_sid and event == name]
+
+
+class TestAsyncChat:
+    """AsyncServer 上的聊天事件"""
+
+    def test_join_and_message(self, sent):
+        """测试加入房间后发送消息，房间内所有人收到同一条消息"""
+        async def scenario():
+            for name in ('a', 'b'):
+                await connect(name)
+                await emit(name, 'join', {'username': f'异步用户{name}', 'room': 'aio'})
+            presence.flush()
+            await emit('a', 'send_message', {'message': '<b>你好</b>', 'type': 'text'})
+            await sio._handle_eio_disconnect('b')
+
+        asyncio.run(scenario())
+
+        for name in ('a', 'b'):
+            messages = events(sent, name, 'receive_message')
+            assert [m['message'] for m in messages] == ['&lt;b&gt;你好&lt;/b&gt;']
+        assert events(sent, 'b', 'online_users_update')
+        delta, = events(sent, 'a', 'online_users_delta')
+        assert delta['count'] == 2
+        assert events(sent, 'a', 'user_left')[0]['username'] == '异步用户b'
+        assert [m['id'] for m in chat_messages.recent('aio')] == [1]
+        print("✅ 异步入口：加入和发送消息")
+
+    def test_load_history(self, sent):
+        """测试分页加载聊天记录"""
+        async def scenario():
+            await connect('a')
+            await emit('a', 'join', {'username': '翻页用户', 'room': 'aio-history'})
+            for i in range(5):
+                await emit('a', 'send_message', {'message': f'消息{i}', 'type': 'text'})
+            await emit('a', 'load_history', {'before': 4, 'limit': 2})
+            await emit('a', 'load_history', {'room': 'other'})
+
+        asyncio.run(scenario())
+
+        page, = events(sent, 'a', 'history_page')
+        assert [m['message'] for m in page['messages']] == ['消息1', '消息2']
+        assert page['has_more']
+        assert events(sent, 'a', 'error') == [{'message': 'not in room'}]
+        print("✅ 异步入口：分页加载")
+
+    def test_typing_is_aggregated(self, sent):
+        """测试正在输入状态汇总广播，发送消息后清除"""
+        async def scenario():
+            for name in ('a', 'b'):
+                await connect(name)
+                await emit(name, 'join', {'username': f'输入{name}', 'room': 'aio-typing'})
+            await emit('a', 'typing', {'is_typing': True})
+            await emit('a', 'typing', {'is_typing': True})
+            typing_indicator.flush()
+            await emit('a', 'send_message', {'message': '好了', 'type': 'text'})
+            typing_indicator.flush()
+            await asyncio.sleep(0)
+
+        asyncio.run(scenario())
+
+        updates = events(sent, 'b', 'users_typing')
+        assert [[u['username'] for u in update['users']] for update in updates] == [['输入a'], []]
+        print("✅ 异步入口：正在输入汇总")
+
+    def test_index_page(self, sent):
+        """测试首页直接渲染最近的消息"""
+        chat_messages.append('general', {'username': '首页', 'message': '最近的消息',
+                                         'type': 'text', 'time': '12:00:00', 'user_id': 'x'})
+        responses = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            responses.append(message)
+
+        scope = {'type': 'http', 'path': '/', 'method': 'GET', 'headers': []}
+        asyncio.run(asgi_app.http_app(scope, receive, send))
+
+        assert responses[0]['status'] == 200
+        assert '最近的消息' in responses[1]['body'].decode()
+        print("✅ 异步入口：首页渲染")
+
+    def test_pipeline_publish_is_not_reentered(self):
+        """测试等待发布期间提交的消息排在后面"""
+        from aio import AsyncRoomPipeline
+        pipeline = AsyncRoomPipeline()
+        order = []
+
+        async def second(result, error):
+            order.append(2)
+
+        async def first(result, error):
+            order.append(1)
+            await pipeline.submit('r', second)
+            await asyncio.sleep(0)
+            order.append(3)
+
+        asyncio.run(pipeline.submit('r', first))
+        assert order == [1, 3, 2]
+        print("✅ 异步入口：发布顺序")
+
+
+class TestAsyncImages:
+    """异步入口的图片上传和下载"""
+
+    def test_upload_is_streamed(self, image_store, sample_image_bytes):
+        """测试上传的请求体按块交给图片存储，返回图片引用"""
+        half = len(sample_image_bytes) // 2
+        partial = []
+
+        def on_receive(n):
+            # 读取第二块时第一块已经在写入临时文件
+            if n == 2:
+                partial.extend(name for name in os.listdir(image_store.root) if name.endswith('.part'))
+
+        status, _, bodies, reads = request('POST', '/upload',
+                                           [sample_image_bytes[:half], sample_image_bytes[half:]],
+                                           on_receive=on_receive)
+
+        assert status == 200
+        ref = json.loads(b''.join(bodies))
+        assert image_store.exists(ref['hash'])
+        assert reads == 2
+        assert len(partial) == 1
+        print("✅ 异步入口：流式上传")
+
+    def test_upload_too_large(self, image_store, monkeypatch):
+        """测试请求体超过限制时返回 413，只读取到超出为止"""
+        monkeypatch.setattr(asgi_app, 'MAX_IMAGE_SIZE', 100)
+        status, _, _, reads = request('POST', '/upload', [b'x' * 60] * 5)
+        assert status == 413
+        assert reads == 2
+
+        status, _, _, reads = request('POST', '/upload', headers=[(b'content-length', b'1000')])
+        assert status == 413
+        assert reads == 0
+        print("✅ 异步入口：上传大小限制")
+
+    def test_image_is_served_in_chunks(self, image_store):
+        """测试图片按块发送，支持 ETag 和 Range 请求"""
+        import io
+        from blobstore import CHUNK_SIZE
+        data = os.urandom(CHUNK_SIZE * 2 + 100)
+        digest, size, temp_path = image_store.put_stream(io.BytesIO(data), len(data))
+        image_store.commit(digest, temp_path, {'mime': 'image/png', 'size': size})
+        path = f'/images/{digest}'
+
+        status, headers, bodies, _ = request('GET', path)
+        assert status == 200
+        assert [len(body) for body in bodies] == [CHUNK_SIZE, CHUNK_SIZE, 100]
+        assert b''.join(bodies) == data
+        assert headers[b'content-length'] == str(len(data)).encode()
+
+        status, headers, bodies, _ = request('GET', path, headers=[(b'range', b'bytes=10-19')])
+        assert status == 206
+        assert bodies == [data[10:20]]
+        assert headers[b'content-range'] == f'bytes 10-19/{len(data)}'.encode()
+
+        status, _, bodies, _ = request('GET', path, headers=[(b'range', b'bytes=-5')])
+        assert (status, bodies) == (206, [data[-5:]])
+
+        status, _, _, _ = request('GET', path, headers=[(b'range', f'bytes={len(data)}-'.encode())])
+        assert status == 416
+
+        # If-Range 不是当前的 ETag 时返回整个文件
+        status, _, _, _ = request('GET', path, headers=[(b'range', b'bytes=0-1'),
+                                                         (b'if-range', b'"old"')])
+        assert status == 200
+
+        status, _, bodies, _ = request('GET', path, headers=[(b'if-none-match', f'"{digest}"'.encode())])
+        assert (status, bodies) == (304, [])
+        print("✅ 异步入口：按块发送和 Range 请求")
+
+    def test_data_url_message(self, sent, image_store, sample_image_base64):
+        """测试旧客户端的 data URL 图片也存入图片存储，按顺序广播引用"""
+        async def scenario():
+            await connect('a')
+            await emit('a', 'join', {'username': '旧客户端', 'room': 'aio-image'})
+            await emit('a', 'send_message', {'message': sample_image_base64, 'type': 'image'})
+            await emit('a', 'send_message', {'message': '图片之后', 'type': 'text'})
+            await message_pipeline.wait()
+
+        asyncio.run(scenario())
+
+        image, text = events(sent, 'a', 'receive_message')
+        assert image_store.exists(image['image']['hash'])
+        assert image['message'] == f"/images/{image['image']['hash']}"
+        assert text['message'] == '图片之后'
+        print("✅ 异步入口：data URL 图片")
+
+    def test_metrics(self, sent):
+        """测试 /metrics 记录异步事件的耗时和房间消息数"""
+        async def scenario():
+            await connect('a')
+            await emit('a', 'join', {'username': '指标', 'room': 'aio-metrics'})
+            await emit('a', 'send_message', {'message': '计数', 'type': 'text'})
+
+        asyncio.run(scenario())
+
+        status, _, bodies, _ = request('GET', '/metrics')
+        text = b''.join(bodies).decode()
+        assert status == 200
+        assert 'chat_event_duration_seconds_count{event="send_message"}' in text
+        assert 'chat_room_messages_total{room="aio-metrics"} 1' in text
+        print("✅ 异步入口：运行指标")
@@ -2,11 +2,21 @@
 import pytest
 import sys
 import os
+import base64
 
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app, socketio, validate_image_data, online_users, chat_messages
+from app import app, socketio, validate_image_data, online_users, room_members, chat_messages, presence, render_history, typing_indicator, message_pipeline
+from history import RoomHistory, SQLiteHistoryStore
+from records import ChatMessage, UserInfo
+from segmentlog import SegmentLogStore
+from typing_state import TypingAggregator
+from images import ImageProcessor, ImageRejected
+from PIL import Image
+import io
+import time
+import types
 
 class TestImageValidation:
     """图片验证测试"""
@@ -24,6 +34,174 @@ class TestImageValidation:
         """测试超大图片"""
         large_data = "data:image/jpeg;base64," + "A" * (150 * 1024 * 1024)
         assert validate_image_data(large_data) == False
+    
+    def test_size_limit_uses_encoded_length(self):
+        """测试按编码长度判断大小限制（5MB）"""
+        limit = 5 * 1024 * 1024
+        png = b'\x89PNG\r\n\x1a\n' + b'\0' * (limit - 8)
+        at_limit = "data:image/png;base64," + base64.b64encode(png).decode()
+        over_limit = "data:image/png;base64," + base64.b64encode(png + b'\0').decode()
+        assert validate_image_data(at_limit) == True
+        assert validate_image_data(over_limit) == False
+    
+    def test_sniffs_image_types(self):
+        """测试根据文件头识别图片类型"""
+        for head in (b'\xff\xd8\xff\xe0' + b'\0' * 8, b'GIF89a' + b'\0' * 6,
+                     b'RIFF\0\0\0\0WEBPVP8 '):
+            data = "data:image/png;base64," + base64.b64encode(head).decode()
+            assert validate_image_data(data) == True
+    
+    def test_rejects_malformed_base64(self, sample_image_base64):
+        """测试非法base64字符和缺少补位"""
+        assert validate_image_data(sample_image_base64 + "!!!!") == False
+        assert validate_image_data(sample_image_base64[:-1]) == False
+        assert validate_image_data(sample_image_base64.replace(';base64', '')) == False
+
+class TestImageUpload:
+    """图片上传测试"""
+    
+    def test_upload_returns_image_ref(self, image_store, sample_image_bytes):
+        """测试上传图片返回哈希和尺寸"""
+        response = app.test_client().post('/upload', data=sample_image_bytes,
+                                          content_type='image/png')
+        assert response.status_code == 200
+        ref = response.get_json()
+        assert ref['mime'] == 'image/png'
+        assert (ref['width'], ref['height']) == (1, 1)
+        assert image_store.exists(ref['hash'])
+        
+        # 相同内容只保存一份
+        again = app.test_client().post('/upload', data=sample_image_bytes,
+                                       content_type='image/png')
+        assert again.get_json()['hash'] == ref['hash']
+    
+    def test_repeated_upload_is_not_transcoded_again(self, image_store, sample_image_bytes, monkeypatch):
+        """测试重复上传的图片直接复用已保存的文件"""
+        import app as app_module
+        first = app.test_client().post('/upload', data=sample_image_bytes,
+                                       content_type='image/png').get_json()
+        
+        def fail(path):
+            raise AssertionError('重复的图片不应该再次转码')
+        monkeypatch.setattr(app_module.image_processor, 'process', fail)
+        
+        again = app.test_client().post('/upload', data=sample_image_bytes,
+                                       content_type='image/png').get_json()
+        assert again == first
+    
+    def test_data_url_image_is_stored_by_hash(self, image_store, sample_image_base64,
+                                              sample_image_bytes, test_user_data):
+        """测试旧客户端的data URL图片也只广播引用，并与上传的图片去重"""
+        ref = app.test_client().post('/upload', data=sample_image_bytes,
+                                     content_type='image/png').get_json()
+        
+        client = socketio.test_client(app)
+        client.emit('join', test_user_data)
+        client.get_received()
+        client.emit('send_message', {'type': 'image', 'message': sample_image_base64})
+        # 图片在工作线程中保存，完成后才广播
+        message_pipeline.wait()
+        
+        message = client.get_received()[0]['args'][0]
+        assert message['message'] == f"/images/{ref['hash']}"
+        assert message['image'] == ref
+        assert chat_messages['general'][-1]['message'] == message['message']
+        client.disconnect()
+    
+    def test_image_route_caching_headers(self, image_store, sample_image_bytes):
+        """测试图片的缓存头、304和Range请求"""
+        client = app.test_client()
+        ref = client.post('/upload', data=sample_image_bytes,
+                          content_type='image/png').get_json()
+        url = f"/images/{ref['hash']}"
+        
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers['ETag'] == f'"{ref["hash"]}"'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert 'max-age=31536000' in response.headers['Cache-Control']
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        body = response.data
+        
+        cached = client.get(url, headers={'If-None-Match': f'"{ref["hash"]}"'})
+        assert cached.status_code == 304
+        assert cached.data == b''
+        
+        partial = client.get(url, headers={'Range': 'bytes=0-3'})
+        assert partial.status_code == 206
+        assert partial.data == body[:4]
+        
+        assert client.get('/images/' + '0' * 32).status_code == 404
+        assert client.get('/images/..%2Fapp.py').status_code == 404
+    
+    def test_upload_rejects_invalid_image(self, image_store):
+        """测试上传非图片内容"""
+        response = app.test_client().post('/upload', data=b'<?php echo 1; ?>',
+                                          content_type='image/png')
+        assert response.status_code == 400
+    
+    def test_upload_rejects_oversized_body(self, image_store):
+        """测试上传超大文件"""
+        response = app.test_client().post('/upload', data=b'A' * (6 * 1024 * 1024),
+                                          content_type='image/png')
+        assert response.status_code == 413
+    
+    def test_image_message_carries_reference(self, image_store, sample_image_bytes, test_user_data):
+        """测试图片消息只携带引用"""
+        ref = app.test_client().post('/upload', data=sample_image_bytes,
+                                     content_type='image/png').get_json()
+        
+        client = socketio.test_client(app)
+        client.emit('join', test_user_data)
+        client.get_received()
+        client.emit('send_message', {'type': 'image', 'image': ref['hash']})
+        
+        message = client.get_received()[0]['args'][0]
+        assert message['message'] == f"/images/{ref['hash']}"
+        assert message['image'] == ref
+        
+        response = app.test_client().get(message['message'])
+        assert response.status_code == 200
+        assert response.mimetype == ref['mime']
+        client.disconnect()
+    
+    def test_upload_is_downscaled_with_thumbnail(self, image_store):
+        """测试大图被缩小并生成缩略图"""
+        buffer = io.BytesIO()
+        Image.new('RGB', (4000, 3000), 'red').save(buffer, 'JPEG')
+        
+        ref = app.test_client().post('/upload', data=buffer.getvalue(),
+                                     content_type='image/jpeg').get_json()
+        assert (ref['width'], ref['height']) == (2048, 1536)
+        assert ref['thumb']['width'] == 320
+        assert image_store.exists(ref['thumb']['hash'])
+        
+        with Image.open(image_store.path(ref['hash'])) as img:
+            assert img.size == (2048, 1536)
+    
+    def test_upload_rejects_decompression_bomb(self, image_store, monkeypatch):
+        """测试像素数超过限制的图片被拒绝"""
+        import app as app_module
+        monkeypatch.setattr(app_module, 'image_processor',
+                            ImageProcessor(0, max_pixels=100 * 100))
+        buffer = io.BytesIO()
+        Image.new('RGB', (200, 200)).save(buffer, 'PNG')
+        
+        response = app.test_client().post('/upload', data=buffer.getvalue(),
+                                          content_type='image/png')
+        assert response.status_code == 400
+        assert os.listdir(image_store.root) == []
+    
+    def test_image_message_unknown_hash(self, image_store, test_user_data):
+        """测试引用不存在的图片"""
+        client = socketio.test_client(app)
+        client.emit('join', test_user_data)
+        client.get_received()
+        client.emit('send_message', {'type': 'image', 'image': '0' * 32})
+        
+        received = client.get_received()
+        assert received[0]['name'] == 'error'
+        client.disconnect()
 
 class TestSocketEvents:
     """Socket事件测试"""
@@ -74,6 +252,74 @@ class TestSocketEvents:
         
         client.disconnect()
         assert len(online_users) == 0
+        assert room_members == {}
+    
+    def test_online_users_only_lists_room_members(self):
+        """测试在线列表只包含本房间成员"""
+        client1 = socketio.test_client(app)
+        client2 = socketio.test_client(app)
+        client1.emit('join', {'username': '房间A用户', 'room': 'room_a'})
+        client2.emit('join', {'username': '房间B用户', 'room': 'room_b'})
+        
+        assert set(room_members) == {'room_a', 'room_b'}
+        
+        # 加入时直接收到完整列表
+        snapshots = [e for e in client2.get_received() if e['name'] == 'online_users_update']
+        assert snapshots[-1]['args'][0]['users'][0]['username'] == '房间B用户'
+        assert snapshots[-1]['args'][0]['count'] == 1
+        
+        client1.disconnect()
+        assert set(room_members) == {'room_b'}
+        client2.disconnect()
+    
+    def test_online_users_deltas_are_coalesced(self):
+        """测试窗口内的多次加入只广播一次增量"""
+        clients = [socketio.test_client(app) for _ in range(3)]
+        for i, client in enumerate(clients):
+            client.emit('join', {'username': f'合并用户{i}', 'room': 'burst'})
+        
+        # 窗口结束前不广播增量
+        received = clients[0].get_received()
+        assert not [e for e in received if e['name'] == 'online_users_delta']
+        
+        socketio.sleep(presence.window + 0.1)
+        received = clients[0].get_received()
+        deltas = [e['args'][0] for e in received if e['name'] == 'online_users_delta']
+        assert len(deltas) == 1
+        assert deltas[0]['count'] == 3
+        assert len(deltas[0]['added']) == 3
+        assert deltas[0]['removed'] == []
+        assert deltas[0]['version'] == 1
+        
+        # 离开只发送被移除的 user_id
+        clients[2].disconnect()
+        presence.flush()
+        deltas = [e['args'][0] for e in clients[0].get_received() if e['name'] == 'online_users_delta']
+        assert len(deltas) == 1
+        assert len(deltas[0]['removed']) == 1
+        assert deltas[0]['version'] == 2
+        
+        for client in clients[:2]:
+            client.disconnect()
+    
+    def test_request_online_users_snapshot(self):
+        """测试版本号不连续时请求完整列表"""
+        client1 = socketio.test_client(app)
+        client2 = socketio.test_client(app)
+        client1.emit('join', {'username': '快照用户1', 'room': 'snap'})
+        client2.emit('join', {'username': '快照用户2', 'room': 'snap'})
+        presence.flush()
+        client1.get_received()
+        
+        client1.emit('request_online_users')
+        snapshots = [e['args'][0] for e in client1.get_received() if e['name'] == 'online_users_update']
+        assert len(snapshots) == 1
+        assert snapshots[0]['count'] == 2
+        assert snapshots[0]['version'] == presence.version('snap')
+        assert {u['username'] for u in snapshots[0]['users']} == {'快照用户1', '快照用户2'}
+        
+        client1.disconnect()
+        client2.disconnect()
 
 class TestMessageStorage:
     """消息存储测试"""
@@ -96,11 +342,298 @@ class TestMessageStorage:
             client.get_received()
         
         # 验证只保留100条消息
-        assert len(chat_messages) == 100
+        history = chat_messages['general']
+        assert len(history) == 100
         
         # 验证最旧的消息被删除（应该从消息5开始）
-        assert chat_messages[0]['message'] == '测试消息5'
-        assert chat_messages[-1]['message'] == '测试消息104'
+        assert history[0]['message'] == '测试消息5'
+        assert history[-1]['message'] == '测试消息104'
+    
+    def test_history_is_per_room(self):
+        """测试每个房间的记录互不影响"""
+        client1 = socketio.test_client(app)
+        client2 = socketio.test_client(app)
+        client1.emit('join', {'username': '热门房间用户', 'room': 'hot'})
+        client2.emit('join', {'username': '安静房间用户', 'room': 'quiet'})
+        
+        client2.emit('send_message', {'message': '安静的消息', 'type': 'text'})
+        for i in range(150):
+            client1.emit('send_message', {'message': f'刷屏{i}', 'type': 'text'})
+        
+        # 热门房间刷屏不会挤掉其他房间的记录
+        assert len(chat_messages['hot']) == 100
+        assert [m['message'] for m in chat_messages['quiet']] == ['安静的消息']
+        
+        client1.disconnect()
+        client2.disconnect()
+    
+    def test_room_capacity_is_configurable(self):
+        """测试单独配置房间容量"""
+        history = RoomHistory(default_capacity=3, capacities={'small': 2})
+        for i in range(5):
+            history.append('small', {'message': i})
+            history.append('other', {'message': i})
+        
+        def texts(messages):
+            return [m['message'] for m in messages]
+        
+        assert texts(history['small']) == [3, 4]
+        assert texts(history['other']) == [2, 3, 4]
+        assert texts(history.recent('other', limit=2)) == [3, 4]
+        
+        # 缩小容量时保留最新的消息
+        history.set_capacity('other', 1)
+        assert texts(history['other']) == [4]
+
+class TestRecords:
+    """消息和用户记录测试"""
+    
+    def test_message_record_is_compact(self):
+        """测试消息记录没有 __dict__，用户名是驻留字符串"""
+        first = ChatMessage(username=''.join(['张', '三']), message='你好', user_id='abc')
+        second = ChatMessage(username=''.join(['张', '三']), message='再见', user_id='abc')
+        assert not hasattr(first, '__dict__')
+        assert first.username is second.username
+        
+        # 兼容按 dict 读取，转换时省略为空的可选字段
+        assert first['message'] == '你好'
+        assert first.get('image') is None
+        assert 'id' not in first
+        assert first.to_dict() == {'username': '张三', 'message': '你好', 'type': 'text',
+                                   'time': '', 'user_id': 'abc'}
+        assert ChatMessage.from_dict(first.to_dict()) == first
+    
+    def test_records_converted_at_boundary(self):
+        """测试内存中保存记录，发送给客户端的是 dict"""
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '记录用户', 'room': 'general'})
+        client.get_received()
+        client.emit('send_message', {'message': '你好', 'type': 'text'})
+        
+        assert isinstance(next(iter(online_users.values())), UserInfo)
+        assert isinstance(chat_messages['general'][-1], ChatMessage)
+        payload = client.get_received()[0]['args'][0]
+        assert payload['message'] == '你好'
+        assert payload['id'] == chat_messages['general'][-1].id
+
+
+class TestHistoryPersistence:
+    """聊天记录持久化测试"""
+    
+    def test_history_survives_restart(self, tmp_path):
+        """测试重启后按房间加载最近的消息"""
+        path = str(tmp_path / 'history.db')
+        store = SQLiteHistoryStore(path)
+        history = RoomHistory(default_capacity=3, store=store)
+        for i in range(5):
+            history.append('general', {'message': f'消息{i}'})
+        history.append('other', {'message': '其他房间'})
+        store.flush()
+        store.close()
+        
+        # 新的进程：房间第一次被访问时才从数据库加载
+        restarted = RoomHistory(default_capacity=3, store=SQLiteHistoryStore(path))
+        assert restarted.rooms() == []
+        assert [m['message'] for m in restarted['general']] == ['消息2', '消息3', '消息4']
+        assert restarted.rooms() == ['general']
+        assert [m['message'] for m in restarted.recent('other')] == ['其他房间']
+    
+    def test_database_uses_wal(self, tmp_path):
+        """测试数据库使用WAL模式和(room, timestamp)索引"""
+        store = SQLiteHistoryStore(str(tmp_path / 'history.db'))
+        conn = store._connect()
+        assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        indexes = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index'").fetchall()
+        assert any('room, timestamp' in sql for (sql,) in indexes)
+        store.close()
+    
+    def test_clear_removes_persisted_messages(self, tmp_path):
+        """测试清空记录同时删除数据库中的消息"""
+        store = SQLiteHistoryStore(str(tmp_path / 'history.db'))
+        history = RoomHistory(store=store)
+        history.append('general', {'message': '旧消息'})
+        history.clear()
+        assert list(history['general']) == []
+        store.close()
+
+class TestSegmentLog:
+    """分段日志存储测试"""
+    
+    def test_log_survives_restart(self, tmp_path):
+        """测试重启后从分段日志加载最近的消息"""
+        store = SegmentLogStore(str(tmp_path / 'log'))
+        history = RoomHistory(default_capacity=3, store=store)
+        for i in range(5):
+            history.append('general', {'message': f'消息{i}'})
+        history.append('其他房间', {'message': '其他'})
+        store.flush()
+        store.close()
+        
+        restarted = RoomHistory(default_capacity=3, store=SegmentLogStore(str(tmp_path / 'log')))
+        assert [m['message'] for m in restarted['general']] == ['消息2', '消息3', '消息4']
+        assert [m['message'] for m in restarted.recent('其他房间')] == ['其他']
+    
+    def test_rotation_and_sparse_index(self, tmp_path):
+        """测试分段切换后仍能跨分段读取，索引是稀疏的"""
+        root = str(tmp_path / 'log')
+        store = SegmentLogStore(root, segment_size=200, index_interval=4)
+        for i in range(30):
+            store.append('general', {'message': f'消息{i}'})
+        store.flush()
+        
+        segments = store._rooms['general']
+        assert len(segments) > 1
+        assert all(len(s.index) <= s.count // 4 + 1 for s in segments)
+        expected = [f'消息{i}' for i in range(19, 30)]
+        assert [m['message'] for m in store.load_recent('general', 11)] == expected
+        store.close()
+        
+        # 重新打开时从索引和文件恢复
+        reopened = SegmentLogStore(root, segment_size=200, index_interval=4)
+        assert [m['message'] for m in reopened.load_recent('general', 11)] == expected
+        reopened.close()
+    
+    def test_compaction_drops_old_segments(self, tmp_path):
+        """测试超出保留条数的旧分段被删除"""
+        store = SegmentLogStore(str(tmp_path / 'log'), segment_size=100, retention=10)
+        for i in range(50):
+            store.append('general', {'message': f'消息{i}'})
+        store.flush()
+        
+        segments = store._rooms['general']
+        assert segments[-1].end - segments[1].base < 10
+        assert len(os.listdir(os.path.dirname(segments[0].path))) == 2 * len(segments)
+        messages = store.load_recent('general', 100)
+        assert len(messages) >= 10
+        assert messages[-1]['message'] == '消息49'
+        store.close()
+    
+    def test_torn_write_is_truncated(self, tmp_path):
+        """测试崩溃时写了一半的记录在恢复时被截掉"""
+        root = str(tmp_path / 'log')
+        store = SegmentLogStore(root)
+        store.append('general', {'message': '完整的消息'})
+        store.flush()
+        path = store._rooms['general'][-1].path
+        store.close()
+        with open(path, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00{"message"')
+        
+        reopened = SegmentLogStore(root)
+        assert reopened.load_recent('general', 10) == [{'message': '完整的消息'}]
+        reopened.append('general', {'message': '新消息'})
+        reopened.flush()
+        assert [m['message'] for m in reopened.load_recent('general', 10)] == ['完整的消息', '新消息']
+        reopened.close()
+    
+    def test_clear_removes_segments(self, tmp_path):
+        """测试清空房间删除分段文件"""
+        store = SegmentLogStore(str(tmp_path / 'log'))
+        history = RoomHistory(store=store)
+        history.append('general', {'message': '旧消息'})
+        history.clear('general')
+        assert store.load_recent('general', 10) == []
+        assert list(history['general']) == []
+        store.close()
+
+
+class TestHistoryPagination:
+    """聊天记录分页加载测试"""
+    
+    @pytest.mark.parametrize('make_store', [
+        lambda tmp_path: SQLiteHistoryStore(str(tmp_path / 'history.db')),
+        lambda tmp_path: SegmentLogStore(str(tmp_path / 'log'), segment_size=300, index_interval=4),
+    ], ids=['sqlite', 'log'])
+    def test_page_reads_past_buffer(self, tmp_path, make_store):
+        """测试分页超出内存缓冲区时从存储中读取更早的消息"""
+        store = make_store(tmp_path)
+        history = RoomHistory(default_capacity=5, store=store)
+        for i in range(30):
+            history.append('general', {'message': f'消息{i}'})
+        store.flush()
+        
+        # 消息 id 从 1 开始递增
+        assert [m['id'] for m in history['general']] == [26, 27, 28, 29, 30]
+        first = history.page('general', limit=10)
+        assert [m['id'] for m in first] == list(range(21, 31))
+        second = history.page('general', before=first[0]['id'], limit=10)
+        assert [m['message'] for m in second] == [f'消息{i}' for i in range(10, 20)]
+        last = history.page('general', before=3, limit=10)
+        assert [m['id'] for m in last] == [1, 2]
+        store.close()
+    
+    def test_ids_continue_after_restart(self, tmp_path):
+        """测试重启后消息 id 接着之前的继续递增"""
+        store = SegmentLogStore(str(tmp_path / 'log'))
+        history = RoomHistory(store=store)
+        history.append('general', {'message': '第一条'})
+        store.flush()
+        store.close()
+        
+        restarted = RoomHistory(store=SegmentLogStore(str(tmp_path / 'log')))
+        message = {'message': '第二条'}
+        restarted.append('general', message)
+        assert message['id'] == 2
+    
+    def test_load_history_event(self):
+        """测试通过 load_history 事件按页加载"""
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '翻页用户', 'room': 'general'})
+        for i in range(5):
+            client.emit('send_message', {'message': f'消息{i}', 'type': 'text'})
+        client.get_received()
+        
+        client.emit('load_history', {'room': 'general', 'limit': 3})
+        pages = [e['args'][0] for e in client.get_received() if e['name'] == 'history_page']
+        assert [m['message'] for m in pages[0]['messages']] == ['消息2', '消息3', '消息4']
+        assert pages[0]['has_more'] is True
+        
+        client.emit('load_history', {'room': 'general', 'before': pages[0]['messages'][0]['id'], 'limit': 3})
+        page = [e['args'][0] for e in client.get_received() if e['name'] == 'history_page'][0]
+        assert [m['message'] for m in page['messages']] == ['消息0', '消息1']
+        assert page['has_more'] is False
+        print("✅ 聊天记录分页加载正常")
+    
+    def test_load_history_other_room_rejected(self):
+        """测试不能加载其他房间的记录"""
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '用户', 'room': 'general'})
+        client.get_received()
+        
+        client.emit('load_history', {'room': 'secret'})
+        received = client.get_received()
+        assert [e['name'] for e in received] == ['error']
+
+
+class TestIndexPage:
+    """首页渲染测试"""
+    
+    def test_index_streams_recent_messages(self):
+        """测试首页流式输出并包含最近的消息"""
+        chat_messages.append('general', {'username': '用户', 'message': '&lt;b&gt;你好', 'type': 'text', 'time': '12:00:00'})
+        response = app.test_client().get('/')
+        assert response.is_streamed
+        body = response.get_data(as_text=True)
+        assert 'data-id="1"' in body
+        # 消息在服务器收到时已经转义，渲染时不再重复转义
+        assert '&lt;b&gt;你好' in body
+        assert body.index('id="usernameInput"') < body.index('&lt;b&gt;你好')
+        print("✅ 首页包含最近的消息")
+    
+    def test_rendered_history_is_cached(self):
+        """测试渲染结果按房间缓存，有新消息时失效"""
+        chat_messages.append('general', {'username': '用户', 'message': '第一条', 'type': 'text', 'time': '12:00:00'})
+        first = render_history('general')
+        assert render_history('general') is first
+        
+        chat_messages.append('general', {'username': '用户', 'message': '第二条', 'type': 'text', 'time': '12:00:01'})
+        second = render_history('general')
+        assert second is not first
+        assert '第二条' in second
+        
+        chat_messages.clear()
+        assert '第一条' not in render_history('general')
+
 
 class TestMultipleUsers:
     """多用户测试"""
@@ -136,4 +669,210 @@ class TestMultipleUsers:
         
         # 验证消息内容
         assert received1[0]['args'][0]['message'] == '来自用户1'
-        assert received2[0]['args'][0]['message'] == '来自用户1'
\ No newline at end of file
+        assert received2[0]['args'][0]['message'] == '来自用户1'    
+    def test_broadcast_encodes_once(self, monkeypatch):
+        """测试广播时所有接收者共用同一个编码好的数据包"""
+        clients = [socketio.test_client(app) for _ in range(3)]
+        for i, client in enumerate(clients):
+            client.emit('join', {'username': f'用户{i}', 'room': 'general'})
+            client.get_received()
+        
+        sent = []
+        send = socketio.server._send_eio_packet
+        def record(eio_sid, eio_pkt):
+            sent.append(eio_pkt)
+            send(eio_sid, eio_pkt)
+        monkeypatch.setattr(socketio.server, '_send_eio_packet', record)
+        
+        clients[0].emit('send_message', {'message': '广播', 'type': 'text'})
+        
+        # 之前测试留下的连接也可能还在房间里
+        assert len(sent) >= 3
+        assert all(pkt is sent[0] for pkt in sent)
+        assert sent[0].encode_cache is not None
+        for client in clients:
+            messages = [e for e in client.get_received() if e['name'] == 'receive_message']
+            assert messages[0]['args'][0]['message'] == '广播'
+
+
+class TestTypingIndicator:
+    """正在输入状态的汇总广播"""
+
+    def test_typing_is_aggregated_per_room(self):
+        """测试多人多次输入在一个间隔内只广播一次汇总集合"""
+        clients = [socketio.test_client(app) for _ in range(3)]
+        for i, client in enumerate(clients):
+            client.emit('join', {'username': f'输入用户{i}', 'room': 'typing'})
+        for _ in range(5):
+            for client in clients:
+                client.emit('typing', {'is_typing': True})
+        clients[0].get_received()
+
+        socketio.sleep(typing_indicator.interval * 2 + 0.1)
+        events = [e['args'][0] for e in clients[0].get_received() if e['name'] == 'users_typing']
+        assert len(events) == 1
+        assert {u['username'] for u in events[0]['users']} == {'输入用户0', '输入用户1', '输入用户2'}
+
+        for client in clients:
+            client.disconnect()
+        typing_indicator.flush()
+
+    def test_sending_message_clears_typing(self):
+        """测试发送消息后不再显示正在输入"""
+        client1 = socketio.test_client(app)
+        client2 = socketio.test_client(app)
+        client1.emit('join', {'username': '发送者', 'room': 'typing'})
+        client2.emit('join', {'username': '观察者', 'room': 'typing'})
+        client1.emit('typing', {'is_typing': True})
+        typing_indicator.flush()
+        client2.get_received()
+
+        client1.emit('send_message', {'message': '好了', 'type': 'text'})
+        typing_indicator.flush()
+        events = [e['args'][0] for e in client2.get_received() if e['name'] == 'users_typing']
+        assert events == [{'users': []}]
+
+        client1.disconnect()
+        client2.disconnect()
+
+    def test_idle_typing_expires(self):
+        """测试超过 ttl 没有更新的输入状态自动过期"""
+        now = [100.0]
+        emitted = []
+        fake_socketio = type('FakeSocketIO', (), {
+            'emit': lambda self, event, data, **kwargs: emitted.append(data['users'])
+        })()
+        aggregator = TypingAggregator(fake_socketio, interval=0, ttl=3, clock=lambda: now[0])
+
+        aggregator.update('room', {'username': 'a', 'user_id': '1'})
+        aggregator.update('room', {'username': 'b', 'user_id': '2'})
+        now[0] += 2
+        aggregator.update('room', {'username': 'b', 'user_id': '2'})
+        # 集合没有变化时不重复广播
+        assert len(emitted) == 2
+
+        now[0] += 1.5
+        assert aggregator.flush('room')
+        assert emitted[-1] == [{'username': 'b', 'user_id': '2'}]
+        now[0] += 2
+        assert not aggregator.flush('room')
+        assert emitted[-1] == []
+        assert aggregator.typing_users('room') == []
+
+class TestMessagePipeline:
+    """图片消息在工作线程中处理，同一房间保持发送顺序"""
+
+    def test_room_order_is_kept(self, monkeypatch, sample_image_base64):
+        """测试图片处理完成前，同一房间后发的消息排队，其他房间不受影响"""
+        import app as app_module
+        ref = {'hash': 'a' * 32, 'mime': 'image/png', 'width': 1, 'height': 1}
+
+        def slow_store_image(stream):
+            time.sleep(0.2)
+            return ref
+        monkeypatch.setattr(app_module, 'store_image', slow_store_image)
+
+        sender = socketio.test_client(app)
+        other = socketio.test_client(app)
+        sender.emit('join', {'username': '发图片', 'room': 'pipeline'})
+        other.emit('join', {'username': '其他房间', 'room': 'elsewhere'})
+        sender.get_received()
+        other.get_received()
+
+        sender.emit('send_message', {'type': 'image', 'message': sample_image_base64})
+        sender.emit('send_message', {'type': 'text', 'message': '图片后面的文字'})
+        other.emit('send_message', {'type': 'text', 'message': '不用等'})
+
+        # 其他房间的消息立即广播，本房间的消息还在排队
+        assert [e['args'][0]['message'] for e in other.get_received()
+                if e['name'] == 'receive_message'] == ['不用等']
+        assert message_pipeline.pending('pipeline') == 2
+        assert not sender.get_received()
+
+        message_pipeline.wait()
+        messages = [e['args'][0] for e in sender.get_received() if e['name'] == 'receive_message']
+        assert [m['type'] for m in messages] == ['image', 'text']
+        assert messages[0]['image'] == ref
+        assert [m['id'] for m in chat_messages.recent('pipeline')] == [m['id'] for m in messages]
+
+        sender.disconnect()
+        other.disconnect()
+
+    def test_publish_is_not_reentered(self):
+        """测试发布期间提交的消息排在后面，不会插到正在发布的消息中间"""
+        from pipeline import RoomPipeline
+        pipeline = RoomPipeline(types.SimpleNamespace(async_mode='threading'))
+        order = []
+
+        def first(result, error):
+            order.append('1 开始')
+            pipeline.submit('r', lambda result, error: order.extend(['2 开始', '2 结束']))
+            order.append('1 结束')
+
+        pipeline.submit('r', first)
+        assert order == ['1 开始', '1 结束', '2 开始', '2 结束']
+        assert pipeline.pending() == 0
+
+    def test_threading_mode_keeps_order(self):
+        """测试 threading 模式下多个线程同时完成准备，每个房间仍按提交顺序发布，不会丢消息"""
+        import threading
+        from pipeline import RoomPipeline
+
+        def start(target, *args):
+            thread = threading.Thread(target=target, args=args)
+            thread.start()
+            return thread
+
+        def ready():
+            return None
+
+        # 缩短线程切换间隔，让检查和修改队列之间更容易被打断
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for _ in range(10):
+                pipeline = RoomPipeline(types.SimpleNamespace(async_mode='threading',
+                                                              start_background_task=start), 16)
+                published = {room: [] for room in 'ab'}
+
+                def publisher(room, i):
+                    return lambda result, error: published[room].append(i)
+
+                for i in range(200):
+                    for room in published:
+                        if i % 2:
+                            pipeline.submit(room, publisher(room, i), ready)
+                        else:
+                            pipeline.submit(room, publisher(room, i), time.sleep, 0.0001)
+                # 丢掉的消息会让队列一直不空，不能用 wait()
+                deadline = time.time() + 5
+                while pipeline.pending() and time.time() < deadline:
+                    time.sleep(0.01)
+
+                assert pipeline.pending() == 0
+                for messages in published.values():
+                    assert messages == list(range(200))
+        finally:
+            sys.setswitchinterval(interval)
+
+    def test_failed_image_does_not_block_room(self, monkeypatch, sample_image_base64):
+        """测试图片处理失败只通知发送者，后面的消息照常发布"""
+        import app as app_module
+
+        def reject(stream):
+            raise ImageRejected('bad image')
+        monkeypatch.setattr(app_module, 'store_image', reject)
+
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '坏图片', 'room': 'pipeline'})
+        client.get_received()
+        client.emit('send_message', {'type': 'image', 'message': sample_image_base64})
+        client.emit('send_message', {'type': 'text', 'message': '还能发'})
+        message_pipeline.wait()
+
+        received = client.get_received()
+        assert [(e['name'], e['args'][0]['message']) for e in received
+                if e['name'] in ('error', 'receive_message')] == [
+            ('error', 'invalid image'), ('receive_message', '还能发')]
+        assert len(chat_messages.recent('pipeline')) == 1
+        client.disconnect()
@@ -0,0 +1,87 @@
+# tests/test_chatlog.py - 结构化日志测试
+import pytest
+import sys
+import os
+import io
+import json
+import logging
+import logging.handlers
+import threading
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from chatlog import setup_logging, log_event, logger
+
+
+@pytest.fixture
+def output():
+    """日志写到内存中，测试结束后恢复默认配置"""
+    stream = io.StringIO()
+    yield stream
+    setup_logging()
+
+
+def lines(listener, stream):
+    # 停止后台线程，确保队列中的记录都已经写出
+    listener.stop()
+    return stream.getvalue().splitlines()
+
+
+class TestStructuredLogging:
+    """队列 + 后台线程写出的日志"""
+
+    def test_json_output(self, output):
+        """测试事件和字段输出为一行 JSON"""
+        listener = setup_logging(stream=output)
+        log_event('join', username='日志用户', room='general')
+        logging.getLogger('chat.history').error('聊天记录写入失败: %s', 'disk full')
+
+        records = [json.loads(line) for line in lines(listener, output)]
+        assert records[0]['event'] == 'join'
+        assert records[0]['username'] == '日志用户'
+        assert records[0]['level'] == 'INFO'
+        assert records[1]['logger'] == 'chat.history'
+        assert records[1]['message'] == '聊天记录写入失败: disk full'
+        print("✅ JSON 日志输出")
+
+    def test_levels_and_text_output(self, output):
+        """测试低于级别的事件不记录，文本格式为 key=value"""
+        listener = setup_logging(logging.INFO, json_output=False, stream=output)
+        log_event('connect', logging.DEBUG, sid='abc')
+        log_event('leave', username='u', room='r')
+
+        text, = lines(listener, output)
+        assert text.endswith('INFO leave username=u room=r')
+        print("✅ 日志级别和文本格式")
+
+    def test_sampling_per_event(self, output):
+        """测试按事件采样，警告不采样，其他事件不受影响"""
+        listener = setup_logging(stream=output, sampling={'message': 3})
+        for i in range(7):
+            log_event('message', id=i)
+        log_event('message', logging.WARNING, id='warn')
+        log_event('join', room='r')
+
+        records = [json.loads(line) for line in lines(listener, output)]
+        assert [r['id'] for r in records if r['event'] == 'message'] == [0, 3, 6, 'warn']
+        assert [r['event'] for r in records].count('join') == 1
+        print("✅ 按事件采样")
+
+    def test_written_by_background_thread(self, output):
+        """测试写出发生在后台线程中，调用方只是放进队列"""
+        writers = []
+
+        class RecordingStream(io.StringIO):
+            def write(self, text):
+                writers.append(threading.current_thread())
+                return super().write(text)
+
+        stream = RecordingStream()
+        listener = setup_logging(stream=stream)
+        log_event('join', room='r')
+        lines(listener, stream)
+
+        assert writers and threading.current_thread() not in writers
+        # 重复配置时替换之前的队列
+        assert len([h for h in logger.handlers if isinstance(h, logging.handlers.QueueHandler)]) == 1
+        print("✅ 后台线程写日志")
@@ -0,0 +1,251 @@
+# tests/test_cluster.py - 多进程部署测试（用进程内消息队列模拟多个工作进程）
+import pytest
+import sys
+import os
+import importlib.util
+import subprocess
+import textwrap
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from cluster import LocalBroker, StateReplicator
+
+APP_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'app.py'))
+
+
+def load_worker(name):
+    """把 app.py 作为独立模块再加载一次，相当于一个新的工作进程"""
+    spec = importlib.util.spec_from_file_location(name, APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def workers(monkeypatch, request):
+    """共用同一个消息队列的两个工作进程"""
+    # Flask-SocketIO 的测试客户端拒绝使用消息队列（广播变成异步的），
+    # 这里的测试会自己等待消息送达
+    import flask_socketio.test_client
+    monkeypatch.setattr(flask_socketio.test_client, 'PubSubManager', ())
+    monkeypatch.setenv('CHAT_MESSAGE_QUEUE', f'local://{request.node.name}')
+    worker_a = load_worker('worker_a')
+    worker_b = load_worker('worker_b')
+    return worker_a, worker_b
+
+
+class TestConfiguration:
+    """多进程部署的配置检查"""
+
+    def test_segment_log_rejects_message_queue(self, monkeypatch, tmp_path):
+        """测试分段日志只允许单个写入进程，和消息队列一起使用时启动失败"""
+        monkeypatch.setenv('CHAT_MESSAGE_QUEUE', 'local://segment-log')
+        monkeypatch.setenv('CHAT_HISTORY_BACKEND', 'log')
+        monkeypatch.setenv('CHAT_HISTORY_LOG_DIR', str(tmp_path))
+        with pytest.raises(ValueError, match='CHAT_MESSAGE_QUEUE'):
+            load_worker('worker_log')
+        assert not list(tmp_path.iterdir())
+
+
+class TestLocalBroker:
+    """进程内消息队列测试"""
+
+    def test_subscribers_get_independent_copies(self):
+        """测试每个订阅者拿到独立的消息副本"""
+        import queue
+        broker = LocalBroker()
+        first = broker.listen('chat', queue.Queue)
+        second = broker.listen('chat', queue.Queue)
+
+        message = {'users': ['a']}
+        broker.publish('chat', message)
+        received_first, received_second = next(first), next(second)
+
+        assert received_first == received_second == message
+        received_first['users'].append('b')
+        assert received_second == {'users': ['a']}
+
+    def test_replicator_ignores_own_messages(self):
+        """测试同步器忽略自己发出的消息"""
+        import queue
+        broker = LocalBroker()
+        replicator = StateReplicator(broker)
+        other = StateReplicator(broker)
+        messages = broker.listen(replicator.channel, queue.Queue)
+
+        handled = []
+        replicator.on('join', handled.append)
+        replicator.publish('join', room='general')
+        other.publish('join', room='general')
+        replicator._dispatch(iter([next(messages), next(messages)]))
+
+        assert len(handled) == 1
+        assert handled[0]['host_id'] == other.host_id
+
+
+class TestMultipleWorkers:
+    """多个工作进程共享广播和状态"""
+
+    def test_broadcast_reaches_other_worker(self, workers):
+        """测试消息广播到连接在其他工作进程上的用户"""
+        worker_a, worker_b = workers
+        client_a = worker_a.socketio.test_client(worker_a.app)
+        client_b = worker_b.socketio.test_client(worker_b.app)
+
+        client_a.emit('join', {'username': '进程A用户', 'room': 'general'})
+        client_b.emit('join', {'username': '进程B用户', 'room': 'general'})
+        worker_a.socketio.sleep(0.1)
+        client_b.get_received()
+
+        client_a.emit('send_message', {'message': '跨进程消息', 'type': 'text'})
+        worker_a.socketio.sleep(0.1)
+
+        messages = [e for e in client_b.get_received() if e['name'] == 'receive_message']
+        assert len(messages) == 1
+        assert messages[0]['args'][0]['message'] == '跨进程消息'
+
+        # 聊天记录同步到了另一个进程
+        assert worker_b.chat_messages['general'][-1]['message'] == '跨进程消息'
+
+    def test_presence_is_shared(self, workers):
+        """测试在线列表包含所有工作进程上的用户"""
+        worker_a, worker_b = workers
+        client_a = worker_a.socketio.test_client(worker_a.app)
+        client_b = worker_b.socketio.test_client(worker_b.app)
+
+        client_a.emit('join', {'username': '进程A用户', 'room': 'general'})
+        client_b.emit('join', {'username': '进程B用户', 'room': 'general'})
+        worker_a.socketio.sleep(0.1)
+
+        names = {'进程A用户', '进程B用户'}
+        assert {u['username'] for u in worker_a.room_roster('general')} == names
+        assert {u['username'] for u in worker_b.room_roster('general')} == names
+
+        # 每个客户端只收到本进程发出的增量，版本号连续
+        worker_a.socketio.sleep(worker_a.presence.window + 0.1)
+        deltas = [e['args'][0] for e in client_a.get_received() if e['name'] == 'online_users_delta']
+        assert [d['version'] for d in deltas] == [1]
+        assert deltas[0]['count'] == 2
+
+        client_b.disconnect()
+        worker_a.socketio.sleep(0.1)
+        assert [u['username'] for u in worker_a.room_roster('general')] == ['进程A用户']
+
+    def test_message_ids_are_unique_across_workers(self, workers):
+        """测试两个工作进程交替发消息时 id 不重复，两边的记录顺序一致，分页不漏消息"""
+        worker_a, worker_b = workers
+        room = 'cluster-ids'
+        client_a = worker_a.socketio.test_client(worker_a.app)
+        client_b = worker_b.socketio.test_client(worker_b.app)
+        client_a.emit('join', {'username': '进程A用户', 'room': room})
+        client_b.emit('join', {'username': '进程B用户', 'room': room})
+        worker_a.socketio.sleep(0.1)
+
+        # 两个进程几乎同时发送，远程消息还没送到就各自分配 id
+        for i in range(3):
+            client_a.emit('send_message', {'message': f'A{i}', 'type': 'text'})
+            client_b.emit('send_message', {'message': f'B{i}', 'type': 'text'})
+        worker_a.socketio.sleep(0.2)
+
+        recent_a = worker_a.chat_messages.recent(room)
+        recent_b = worker_b.chat_messages.recent(room)
+        ids = [m['id'] for m in recent_a]
+        assert len(set(ids)) == 6
+        assert ids == sorted(ids)
+        assert [m.to_dict() for m in recent_b] == [m.to_dict() for m in recent_a]
+
+        # 按游标分页（包括从存储中读取）不会跳过另一个进程的消息
+        first = worker_b.chat_messages.page(room, limit=4)
+        rest = worker_b.chat_messages.page(room, before=first[0]['id'], limit=4)
+        assert [m['message'] for m in rest + first] == [m['message'] for m in recent_a]
+        worker_a.chat_messages.store.flush()
+        worker_b.chat_messages.store.flush()
+        stored = worker_a.chat_messages.store.load_before(room, ids[2], 10)
+        assert [m['id'] for m in stored] == ids[:2]
+
+    def test_new_worker_learns_existing_members(self, workers):
+        """测试后启动的工作进程能拿到已有的在线用户"""
+        worker_a, _ = workers
+        client_a = worker_a.socketio.test_client(worker_a.app)
+        client_a.emit('join', {'username': '先来的用户', 'room': 'general'})
+
+        worker_c = load_worker('worker_c')
+        worker_c.socketio.sleep(0.1)
+        assert [u['username'] for u in worker_c.room_roster('general')] == ['先来的用户']
+
+
+# 在打了猴子补丁的子进程里转码图片（redis:// 和 unix:// 队列时 app.py 会打补丁，
+# 测试进程本身不能打补丁）
+PATCHED_IMAGE_SCRIPT = textwrap.dedent("""
+    import eventlet
+    eventlet.monkey_patch()
+    import sys, types
+    sys.path.insert(0, sys.argv[1])
+    from PIL import Image
+    from blobstore import BlobStore
+    from images import ImageProcessor, DataURLReader, store_image
+    from pipeline import RoomPipeline
+
+    path = sys.argv[2] + '/big.png'
+    Image.new('RGB', (800, 800), 'red').save(path)
+    processor = ImageProcessor(2, 'eventlet')
+    print(processor.process(path)['image']['width'])
+
+    fake_socketio = types.SimpleNamespace(async_mode='eventlet', sleep=eventlet.sleep,
+                                          start_background_task=eventlet.spawn)
+    pipeline = RoomPipeline(fake_socketio, 2)
+    published = []
+    pipeline.submit('r', lambda result, error: published.append(error or result['width']),
+                    store_image, BlobStore(sys.argv[2] + '/store'), processor,
+                    DataURLReader(sys.argv[3]), 5 * 1024 * 1024)
+    pipeline.submit('r', lambda result, error: published.append('text'))
+    with eventlet.Timeout(20):
+        pipeline.wait()
+    print(published)
+
+    # 几张大图片同时处理时，解码、哈希和写文件不占用 hub：记录最大调度延迟
+    import base64, os, time
+    urls = []
+    for i in range(3):
+        noise = sys.argv[2] + f'/noise{i}.png'
+        Image.frombytes('RGB', (1000, 1000), os.urandom(3000000)).save(noise)
+        with open(noise, 'rb') as f:
+            urls.append('data:image/png;base64,' + base64.b64encode(f.read()).decode())
+    lags = []
+
+    def measure():
+        while True:
+            start = time.perf_counter()
+            eventlet.sleep(0.005)
+            lags.append(time.perf_counter() - start - 0.005)
+
+    monitor = eventlet.spawn(measure)
+    eventlet.sleep(0.05)
+    for url in urls:
+        pipeline.submit('big', lambda result, error: published.append(error or result['width']),
+                        store_image, BlobStore(sys.argv[2] + '/store'), processor,
+                        DataURLReader(url), 5 * 1024 * 1024)
+    with eventlet.Timeout(60):
+        pipeline.wait()
+    monitor.kill()
+    print(published[2:])
+    print(max(lags))
+    processor.shutdown()
+""")
+
+
+class TestMonkeyPatched:
+    """打了猴子补丁的工作进程"""
+
+    def test_image_processing_under_monkey_patch(self, tmp_path, sample_image_base64):
+        """测试打补丁后转码和 data URL 图片都能完成，不会卡住，也不占用 hub"""
+        root = os.path.dirname(APP_PATH)
+        result = subprocess.run(
+            [sys.executable, '-c', PATCHED_IMAGE_SCRIPT, root, str(tmp_path), sample_image_base64],
+            capture_output=True, text=True, timeout=120)
+        assert result.returncode == 0, result.stderr
+        lines = result.stdout.split('\n')
+        assert lines[:3] == ['800', "[1, 'text']", '[1000, 1000, 1000]']
+        # 在 hub 中解码和哈希时每张图片要卡住 100ms 以上
+        assert float(lines[3]) < 0.06
+        print("✅ 猴子补丁下的图片处理")
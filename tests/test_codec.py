@@ -0,0 +1,95 @@
+# tests/test_codec.py - MessagePack / JSON 按连接协商测试
+import pytest
+import sys
+import os
+import types
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+msgpack = pytest.importorskip('msgpack')
+
+import socketio
+from broadcast import broadcast
+from codec import CodecNegotiator
+
+
+@pytest.fixture
+def server():
+    """开启协商的 Socket.IO 服务器，发出的 Engine.IO 数据记录在 server.sent 中"""
+    sio = socketio.Server(async_mode='threading')
+    CodecNegotiator(sio)
+    sio.sent = []
+    sio.eio.send = lambda eio_sid, data: sio.sent.append((eio_sid, data))
+    sio.eio.send_packet = lambda eio_sid, pkt: sio.sent.append((eio_sid, pkt.data))
+
+    @sio.on('join')
+    def join(sid, room):
+        sio.enter_room(sid, room)
+        sio.emit('joined', {'room': room}, to=sid)
+    return sio
+
+
+def connect(server, eio_sid, binary):
+    server._handle_eio_connect(eio_sid, {})
+    if binary:
+        server._handle_eio_message(eio_sid, msgpack.dumps({'type': 0, 'nsp': '/'}))
+    else:
+        server._handle_eio_message(eio_sid, '0')
+
+
+def join(server, eio_sid, binary, room):
+    if binary:
+        server._handle_eio_message(eio_sid, msgpack.dumps(
+            {'type': 2, 'nsp': '/', 'data': ['join', room]}))
+    else:
+        server._handle_eio_message(eio_sid, '2["join","%s"]' % room)
+
+
+class TestCodecNegotiation:
+    """按连接选择序列化格式"""
+
+    def test_each_client_gets_its_own_format(self, server):
+        """测试 MessagePack 客户端收到二进制数据包，旧客户端仍然是 JSON"""
+        connect(server, 'binary', True)
+        connect(server, 'text', False)
+        join(server, 'binary', True, 'general')
+        join(server, 'text', False, 'general')
+
+        replies = dict(server.sent[-2:])
+        assert msgpack.loads(replies['binary'])['data'] == ['joined', {'room': 'general'}]
+        assert replies['text'] == '2["joined",{"room":"general"}]'
+        assert server.codecs.uses_msgpack('binary')
+        assert not server.codecs.uses_msgpack('text')
+
+    def test_broadcast_encodes_once_per_format(self, server):
+        """测试广播时每种格式只编码一次"""
+        for i in range(2):
+            connect(server, f'binary{i}', True)
+            join(server, f'binary{i}', True, 'general')
+            connect(server, f'text{i}', False)
+            join(server, f'text{i}', False, 'general')
+        server.sent.clear()
+
+        broadcast(types.SimpleNamespace(server=server), 'receive_message', {'message': '你好'}, 'general')
+
+        sent = dict(server.sent)
+        assert len(sent) == 4
+        assert sent['binary0'] is sent['binary1']
+        assert sent['text0'] is sent['text1']
+        assert msgpack.loads(sent['binary0'])['data'] == ['receive_message', {'message': '你好'}]
+
+    def test_binary_data_without_attachments(self, server):
+        """测试二进制数据直接放在 MessagePack 数据包里，不拆成附件"""
+        connect(server, 'binary', True)
+        server.emit('image', {'raw': b'\x00\xff'}, to=server.manager.sid_from_eio_sid('binary', '/'))
+
+        (eio_sid, data), = server.sent[-1:]
+        decoded = msgpack.loads(data)
+        assert decoded['type'] == 2
+        assert decoded['data'] == ['image', {'raw': b'\x00\xff'}]
+
+    def test_disconnect_forgets_client(self, server):
+        """测试断开后清除协商结果"""
+        connect(server, 'binary', True)
+        server.codecs.handle_eio_disconnect('binary')
+        assert not server.codecs.uses_msgpack('binary')
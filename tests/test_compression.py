@@ -0,0 +1,162 @@
+# tests/test_compression.py - WebSocket permessage-deflate 压缩测试
+import pytest
+import sys
+import os
+import socket
+import types
+import zlib
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+pytest.importorskip('eventlet')
+
+from engineio.async_drivers.eventlet import WebSocketWSGI
+from compression import CompressionStats, DeflateOptions, make_websocket_class
+
+
+def handshake(options, stats, extensions='permessage-deflate; client_max_window_bits'):
+    """完成握手，返回 (服务器端 WebSocket, 客户端 socket, 握手响应)"""
+    server_sock, client_sock = socket.socketpair()
+    wsgi = make_websocket_class(WebSocketWSGI, options, stats)(
+        lambda ws: None, types.SimpleNamespace(max_http_buffer_size=1000000))
+    environ = {
+        'gunicorn.socket': server_sock,
+        'HTTP_SEC_WEBSOCKET_VERSION': '13',
+        'HTTP_SEC_WEBSOCKET_KEY': 'dGhlIHNhbXBsZSBub25jZQ==',
+        'HTTP_SEC_WEBSOCKET_EXTENSIONS': extensions
+    }
+    ws = wsgi._handle_hybi_request(environ)
+    reply = client_sock.recv(4096).decode()
+    return ws, client_sock, reply
+
+
+def read_frame(sock):
+    """读一个服务器发来的（未加掩码的）帧，返回 (是否压缩, 负载)"""
+    first, second = sock.recv(2)
+    length = second & 0x7f
+    if length == 126:
+        length = int.from_bytes(sock.recv(2), 'big')
+    elif length == 127:
+        length = int.from_bytes(sock.recv(8), 'big')
+    payload = b''
+    while len(payload) < length:
+        payload += sock.recv(length - len(payload))
+    return bool(first & 0x40), payload
+
+
+def inflate(payload, decompressor=None):
+    decompressor = decompressor or zlib.decompressobj(-zlib.MAX_WBITS)
+    return decompressor.decompress(payload + b'\x00\x00\xff\xff')
+
+
+class TestDeflateNegotiation:
+    """握手协商"""
+
+    def test_disabled_compression(self):
+        """测试关闭压缩时不接受 permessage-deflate"""
+        ws, client, reply = handshake(DeflateOptions(enabled=False), CompressionStats())
+        assert 'Sec-WebSocket-Extensions' not in reply
+        assert 'permessage-deflate' not in ws.extensions
+
+    def test_no_context_takeover(self):
+        """测试关闭上下文接管时响应中要求双方都不保留压缩上下文"""
+        ws, client, reply = handshake(DeflateOptions(context_takeover=False), CompressionStats())
+        assert 'server_no_context_takeover' in reply
+        assert 'client_no_context_takeover' in reply
+        assert ws.extensions['permessage-deflate']['server_no_context_takeover']
+
+    def test_window_bits(self):
+        """测试限制服务器端的压缩窗口"""
+        with pytest.raises(ValueError):
+            DeflateOptions(window_bits=7)
+        ws, client, reply = handshake(DeflateOptions(window_bits=10), CompressionStats())
+        assert 'server_max_window_bits=10' in reply
+        # 客户端要求更小的窗口时按客户端的来
+        ws, client, reply = handshake(DeflateOptions(window_bits=10), CompressionStats(),
+                                      'permessage-deflate; server_max_window_bits=9')
+        assert 'server_max_window_bits=9' in reply
+
+
+class TestDeflateFrames:
+    """按阈值压缩数据帧"""
+
+    def test_small_frames_sent_uncompressed(self):
+        """测试小于阈值的帧不压缩"""
+        stats = CompressionStats()
+        ws, client, reply = handshake(DeflateOptions(threshold=100), stats)
+        ws.send('42["typing"]')
+
+        compressed, payload = read_frame(client)
+        assert not compressed
+        assert payload == b'42["typing"]'
+        assert stats.skipped_frames == 1
+        assert stats.compressed_frames == 0
+
+    def test_large_frames_compressed(self):
+        """测试超过阈值的帧压缩发送，并统计压缩比"""
+        stats = CompressionStats()
+        ws, client, reply = handshake(DeflateOptions(threshold=100), stats)
+        message = '42["receive_message",{"message":"%s"}]' % ('你好' * 200)
+        ws.send(message)
+
+        compressed, payload = read_frame(client)
+        assert compressed
+        assert inflate(payload).decode() == message
+        assert stats.compressed_frames == 1
+        # 统计的是包括帧头在内的发送字节数
+        assert stats.compressed_out == len(payload) + 2
+        assert stats.ratio < 0.2
+
+    def test_large_frames_encoded_once(self):
+        """测试达到阈值的帧只做一次 UTF-8 编码，压缩前的字节数按编码结果统计"""
+        encodes = []
+
+        class CountingStr(str):
+            def encode(self, *args, **kwargs):
+                encodes.append(len(self))
+                return super().encode(*args, **kwargs)
+
+        stats = CompressionStats()
+        ws, client, reply = handshake(DeflateOptions(threshold=100), stats)
+        message = CountingStr('42["receive_message",{"message":"%s"}]' % ('你好' * 200))
+        ws.send(message)
+
+        compressed, payload = read_frame(client)
+        assert compressed
+        assert encodes == [len(message)]
+        raw_size = len(str(message).encode('utf-8'))
+        assert stats.compressed_in == raw_size + 4
+        print("✅ 大帧只编码一次")
+
+    def test_short_text_threshold_uses_bytes(self):
+        """测试字符数不到阈值、字节数达到阈值的文本按字节数判断"""
+        stats = CompressionStats()
+        ws, client, reply = handshake(DeflateOptions(threshold=100), stats)
+        message = '你好' * 20
+        ws.send(message)
+
+        compressed, payload = read_frame(client)
+        assert compressed
+        assert inflate(payload).decode() == message
+        assert stats.compressed_frames == 1
+        print("✅ 短文本按字节数判断")
+
+    def test_mixed_frames_keep_context(self):
+        """测试跳过小帧不影响之后压缩帧共用的压缩上下文"""
+        ws, client, reply = handshake(DeflateOptions(threshold=100), CompressionStats())
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        big = 'x' * 500
+        for message in (big, 'small', big):
+            ws.send(message)
+            compressed, payload = read_frame(client)
+            if compressed:
+                payload = inflate(payload, decompressor)
+            assert payload.decode() == message
+
+    def test_control_frames_not_counted(self):
+        """测试控制帧不压缩也不计入统计"""
+        stats = CompressionStats()
+        ws, client, reply = handshake(DeflateOptions(threshold=0), stats)
+        ws.send(b'ping', control_code=0x9)
+        assert stats.snapshot()['compressed_frames'] == 0
+        assert stats.snapshot()['skipped_frames'] == 0
@@ -7,7 +7,7 @@ import imghdr
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app, socketio, validate_image_data, online_users, chat_messages
+from app import app, socketio, validate_image_data, online_users, chat_messages, typing_indicator
 
 class TestMissingLines:
     """专门针对缺失行号的测试"""
@@ -107,7 +107,7 @@ class TestMissingLines:
         })
         client.get_received()
         
-        initial_msg_count = len(chat_messages)
+        initial_msg_count = len(chat_messages['general'])
         
         # 发送一条正常的文本消息
         client.emit('send_message', {
@@ -118,8 +118,8 @@ class TestMissingLines:
         received = client.get_received()
         
         # 验证消息被存储
-        assert len(chat_messages) == initial_msg_count + 1
-        assert chat_messages[-1]['message'] == '测试消息存储'
+        assert len(chat_messages['general']) == initial_msg_count + 1
+        assert chat_messages['general'][-1]['message'] == '测试消息存储'
         
         # 验证消息被广播
         message_events = [e for e in received if e.get('name') == 'receive_message']
@@ -145,20 +145,19 @@ class TestMissingLines:
         
         # 用户1发送typing状态
         client1.emit('typing', {'is_typing': True})
+        typing_indicator.flush()
         
-        # 用户2应该收到typing通知，但用户1自己不应该收到
         received1 = client1.get_received()  # 发送者
         received2 = client2.get_received()  # 接收者
         
-        # 验证发送者没有收到自己的typing通知
-        typing_events1 = [e for e in received1 if e.get('name') == 'user_typing']
-        assert len(typing_events1) == 0, "发送者不应该收到自己的typing通知"
+        # 房间内所有人收到同一个汇总集合，发送者由客户端按用户名过滤掉自己
+        typing_events1 = [e for e in received1 if e.get('name') == 'users_typing']
+        assert len(typing_events1) == 1
         
         # 验证接收者收到了typing通知
-        typing_events2 = [e for e in received2 if e.get('name') == 'user_typing']
-        assert len(typing_events2) > 0, "接收者应该收到typing通知"
-        assert typing_events2[0]['args'][0]['username'] == 'TypingUser1'
-        assert typing_events2[0]['args'][0]['is_typing'] == True
+        typing_events2 = [e for e in received2 if e.get('name') == 'users_typing']
+        assert len(typing_events2) == 1, "接收者应该收到typing通知"
+        assert [u['username'] for u in typing_events2[0]['args'][0]['users']] == ['TypingUser1']
         
         print("✅ 测试第168-174行：typing处理器完整流程")
     
@@ -177,17 +176,19 @@ class TestMissingLines:
         
         # 先发送typing开始
         client1.emit('typing', {'is_typing': True})
+        typing_indicator.flush()
         client2.get_received()  # 清空
         
         # 然后发送typing停止
         client1.emit('typing', {'is_typing': False})
+        typing_indicator.flush()
         
         received2 = client2.get_received()
         
-        # 验证收到typing停止通知
-        typing_events = [e for e in received2 if e.get('name') == 'user_typing']
-        assert len(typing_events) > 0
-        assert typing_events[0]['args'][0]['is_typing'] == False
+        # 验证收到typing停止通知（集合为空）
+        typing_events = [e for e in received2 if e.get('name') == 'users_typing']
+        assert len(typing_events) == 1
+        assert typing_events[0]['args'][0]['users'] == []
         
         print("✅ 测试第180行：typing停止状态处理")
     
@@ -0,0 +1,220 @@
+# tests/test_metrics.py - 运行指标测试
+import pytest
+import sys
+import os
+import io
+import json
+import types
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import app, socketio, event_latency, room_messages, room_bytes, broadcast_fanout
+from metrics import MetricsRegistry, LoopLagMonitor, instrument_handlers
+from chatlog import setup_logging
+
+
+class TestMetricsRegistry:
+    """计数器、直方图和 Prometheus 文本格式"""
+
+    def test_histogram_buckets_are_cumulative(self):
+        """测试直方图输出累计的桶、总和和次数"""
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency_seconds', '耗时', (0.1, 1), ('event',))
+        for value in (0.05, 0.1, 0.5, 3):
+            latency.observe(value, 'join')
+
+        lines = registry.render().splitlines()
+        assert lines[:2] == ['# HELP latency_seconds 耗时', '# TYPE latency_seconds histogram']
+        assert lines[2:] == [
+            'latency_seconds_bucket{event="join",le="0.1"} 2',
+            'latency_seconds_bucket{event="join",le="1"} 3',
+            'latency_seconds_bucket{event="join",le="+Inf"} 4',
+            'latency_seconds_sum{event="join"} 3.65',
+            'latency_seconds_count{event="join"} 4',
+        ]
+        print("✅ 直方图输出")
+
+    def test_counter_labels_are_capped_and_escaped(self):
+        """测试标签值超过上限后合并，引号和换行被转义"""
+        registry = MetricsRegistry()
+        messages = registry.counter('messages_total', '消息数', ('room',), max_series=2)
+        messages.inc('a')
+        messages.inc('say "hi"\n', amount=2)
+        messages.inc('c')
+        messages.inc('d')
+        messages.inc('a')
+        registry.callback('users', '用户数', lambda: 3)
+
+        text = registry.render()
+        assert 'messages_total{room="a"} 2' in text
+        assert 'messages_total{room="say \\"hi\\"\\n"} 2' in text
+        assert 'messages_total{room="other"} 2' in text
+        assert '\nusers 3\n' in text
+        print("✅ 标签上限和转义")
+
+
+class TestMetricsEndpoint:
+    """/metrics 接口和聊天事件的统计"""
+
+    def test_message_is_counted(self):
+        """测试发送消息后记录事件耗时、房间消息数、字节数和广播接收者数"""
+        sent = event_latency.count('send_message')
+        count = room_messages.value('metrics')
+        size = room_bytes.value('metrics')
+        broadcasts = broadcast_fanout.count()
+
+        clients = [socketio.test_client(app) for _ in range(2)]
+        for i, client in enumerate(clients):
+            client.emit('join', {'username': f'指标用户{i}', 'room': 'metrics'})
+        clients[0].emit('send_message', {'message': '你好', 'type': 'text'})
+
+        assert event_latency.count('send_message') == sent + 1
+        assert room_messages.value('metrics') == count + 1
+        assert room_bytes.value('metrics') > size
+        assert broadcast_fanout.count() == broadcasts + 1
+
+        response = app.test_client().get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        text = response.get_data(as_text=True)
+        assert 'chat_event_duration_seconds_count{event="join"}' in text
+        assert 'chat_online_users 2' in text
+        assert 'chat_room_messages_total{room="metrics"}' in text
+
+        for client in clients:
+            client.disconnect()
+        print("✅ /metrics 统计")
+
+
+@pytest.fixture
+def warnings_log():
+    """警告日志写到内存中，返回读取已写出记录的函数"""
+    stream = io.StringIO()
+    listener = setup_logging(stream=stream)
+
+    def records():
+        listener.stop()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+    yield records
+    setup_logging()
+
+
+class TestSlowHandlers:
+    """hub 调度延迟和慢处理函数"""
+
+    def test_slow_handler_is_flagged(self, warnings_log):
+        """测试超过阈值的处理函数记录事件名、耗时和参数大小"""
+        now = [0.0]
+        durations = {'fast': 0.01, 'slow': 0.2}
+
+        def handler(event):
+            def handle(sid, data):
+                now[0] += durations[event]
+                return event
+            return handle
+
+        server = types.SimpleNamespace(handlers={'/': {e: handler(e) for e in durations}})
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency', '耗时', (0.1,), ('event',))
+        slow = registry.counter('slow_total', '慢处理', ('event',))
+        instrument_handlers(server, latency, slow=0.1, slow_counter=slow, clock=lambda: now[0])
+
+        assert server.handlers['/']['fast']('sid', {'message': '快'}) == 'fast'
+        server.handlers['/']['slow']('sid', {'message': '慢'})
+
+        assert latency.count('fast') == latency.count('slow') == 1
+        assert slow.value('fast') == 0 and slow.value('slow') == 1
+        record, = warnings_log()
+        assert record['event'] == 'slow_handler' and record['level'] == 'WARNING'
+        assert record['handler'] == 'slow'
+        assert record['duration_ms'] == 200.0
+        assert record['payload_bytes'] == len(json.dumps([{'message': '慢'}], ensure_ascii=False).encode())
+        print("✅ 慢处理函数检测")
+
+    def test_only_blocking_green_handler_is_flagged(self, warnings_log):
+        """测试 eventlet 下只有卡住 hub 的处理函数被记为慢处理，同时被挂起的不算"""
+        import time
+        import eventlet
+
+        def blocker(sid, data):
+            time.sleep(0.2)
+
+        def waiter(sid, data):
+            eventlet.sleep(0.3)
+
+        server = types.SimpleNamespace(async_mode='eventlet',
+                                       handlers={'/': {'blocker': blocker, 'waiter': waiter}})
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency', '耗时', (0.1,), ('event',))
+        slow = registry.counter('slow_total', '慢处理', ('event',))
+        instrument_handlers(server, latency, slow=0.1, slow_counter=slow)
+
+        waiting = eventlet.spawn(server.handlers['/']['waiter'], 'sid', {})
+        eventlet.sleep(0)
+        eventlet.spawn(server.handlers['/']['blocker'], 'sid', {}).wait()
+        waiting.wait()
+
+        assert slow.value('blocker') == 1 and slow.value('waiter') == 0
+        # 阻塞时 app 的调度延迟监控也会记录 loop_lag
+        record, = [r for r in warnings_log() if r['event'] == 'slow_handler']
+        assert record['handler'] == 'blocker'
+        assert 200 <= record['duration_ms'] <= record['wall_ms']
+        print("✅ eventlet 慢处理只记卡住 hub 的函数")
+
+    def test_only_blocking_coroutine_is_flagged(self, warnings_log):
+        """测试协程处理函数只按自己执行的时间判断，await 等待的时间不计入"""
+        import asyncio
+        import time
+
+        async def blocker(sid, data):
+            await asyncio.sleep(0)
+            time.sleep(0.2)
+            return 'blocked'
+
+        async def waiter(sid, data):
+            await asyncio.sleep(0.3)
+            return 'waited'
+
+        server = types.SimpleNamespace(handlers={'/': {'blocker': blocker, 'waiter': waiter}})
+        registry = MetricsRegistry()
+        latency = registry.histogram('latency', '耗时', (0.1,), ('event',))
+        slow = registry.counter('slow_total', '慢处理', ('event',))
+        instrument_handlers(server, latency, slow=0.1, slow_counter=slow)
+
+        async def scenario():
+            return await asyncio.gather(server.handlers['/']['waiter']('sid', {}),
+                                        server.handlers['/']['blocker']('sid', {}))
+
+        assert asyncio.run(scenario()) == ['waited', 'blocked']
+        assert latency.count('waiter') == latency.count('blocker') == 1
+        assert slow.value('blocker') == 1 and slow.value('waiter') == 0
+        record, = [r for r in warnings_log() if r['event'] == 'slow_handler']
+        assert record['handler'] == 'blocker' and record['duration_ms'] >= 200
+        print("✅ 协程慢处理只计自己执行的时间")
+
+    def test_loop_lag_is_measured(self, warnings_log):
+        """测试后台任务醒来的延迟记录到直方图，超过阈值时记录警告"""
+        now = [0.0]
+        extra = [0.0, 0.3]
+        started = []
+
+        def sleep(seconds):
+            now[0] += seconds + extra.pop(0)
+
+        fake_socketio = types.SimpleNamespace(
+            sleep=sleep, start_background_task=lambda task: started.append(task) or task)
+        registry = MetricsRegistry()
+        lag = registry.histogram('lag', '延迟', (0.01, 0.5))
+        monitor = LoopLagMonitor(fake_socketio, lag, interval=0.1, warn_threshold=0.1,
+                                 clock=lambda: now[0])
+        monitor.start()
+        monitor.start()
+        assert len(started) == 1
+
+        assert monitor.sample() == 0
+        assert monitor.sample() == pytest.approx(0.3)
+        assert lag.count() == 2
+        assert monitor.max == pytest.approx(0.3)
+        record, = warnings_log()
+        assert record['event'] == 'loop_lag' and record['lag_ms'] == 300.0
+        print("✅ hub 调度延迟")
@@ -8,7 +8,8 @@ import os
 # 添加项目根目录到Python路径
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from app import app, socketio, validate_image_data
+from app import app, socketio, validate_image_data, rate_limiter, chat_messages
+from ratelimit import RateLimiter
 
 @pytest.mark.security
 class TestXSSPrevention:
@@ -109,6 +110,32 @@ class TestXSSPrevention:
         
         assert safety_rate >= 0.5, f"XSS防护率过低: {safety_rate:.1%}"
     
+    def test_unknown_message_type_is_rejected(self):
+        """测试文字和图片以外的消息类型被拒绝，不会原样出现在首页"""
+        payload = '<img src=x onerror=alert(1)>'
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '类型测试', 'room': 'general'})
+        client.get_received()
+        
+        client.emit('send_message', {'message': payload, 'type': 'evil'})
+        client.emit('send_message', {'message': ['不是字符串'], 'type': 'text'})
+        
+        errors = [e['args'][0] for e in client.get_received() if e['name'] == 'error']
+        assert errors == [{'message': 'invalid message type'}] * 2
+        assert len(chat_messages['general']) == 0
+        client.disconnect()
+        print("✅ 未知消息类型被拒绝")
+    
+    def test_index_escapes_non_text_messages(self):
+        """测试记录中已有的其他类型消息在首页渲染时会被转义"""
+        payload = '<img src=x onerror=alert(1)>'
+        chat_messages.append('general', {'username': '旧记录', 'message': payload,
+                                         'type': 'evil', 'time': '12:00:00'})
+        body = app.test_client().get('/').get_data(as_text=True)
+        assert payload not in body
+        assert '&lt;img src=x onerror=alert(1)&gt;' in body
+        print("✅ 首页转义非文字消息")
+    
     def is_xss_dangerous(self, original, processed):
         """判断XSS载荷是否仍然危险"""
         # 如果消息完全没有改变，可能是危险的
@@ -407,4 +434,45 @@ class TestRateLimiting:
         if rate > 100:  # 每秒超过100条
             print("⚠️ 建议添加速率限制防护")
         else:
-            print("✅ 消息发送速率在合理范围内")
\ No newline at end of file
+            print("✅ 消息发送速率在合理范围内")
+    
+    def test_flooding_is_limited(self, monkeypatch):
+        """测试超过突发上限的消息被丢弃并计数"""
+        monkeypatch.setattr(rate_limiter, 'enabled', True)
+        rate_limiter.reset()
+        client = socketio.test_client(app)
+        client.emit('join', {'username': '限流用户', 'room': 'flood'})
+        client.get_received()
+        
+        rate, burst = rate_limiter.limits['send_message']
+        for i in range(burst + 20):
+            client.emit('send_message', {'message': f'洪水消息 {i}', 'type': 'text'})
+        
+        # 循环很快，期间补充的令牌不超过一两个
+        stored = len(chat_messages['flood'])
+        assert burst <= stored <= burst + 2
+        assert rate_limiter.dropped['send_message'] == burst + 20 - stored
+        errors = [e for e in client.get_received() if e['name'] == 'error']
+        assert len(errors) == rate_limiter.dropped['send_message']
+        
+        client.disconnect()
+        assert not rate_limiter._buckets
+        print("✅ 消息洪水被限流")
+    
+    def test_token_bucket_refills(self):
+        """测试令牌按速率补充，不超过突发上限，每个连接互不影响"""
+        now = [0.0]
+        limiter = RateLimiter({'typing': (2, 3)}, clock=lambda: now[0])
+        
+        assert [limiter.allow('a', 'typing') for _ in range(4)] == [True, True, True, False]
+        assert limiter.allow('b', 'typing')
+        now[0] += 0.5
+        assert limiter.allow('a', 'typing')
+        assert not limiter.allow('a', 'typing')
+        # 长时间空闲也只攒到突发上限
+        now[0] += 100
+        assert [limiter.allow('a', 'typing') for _ in range(4)] == [True, True, True, False]
+        # 没有配置的事件不限流
+        assert all(limiter.allow('a', 'join') for _ in range(100))
+        assert limiter.dropped == {'typing': 3}
+        print("✅ 令牌桶按速率补充")
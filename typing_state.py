@@ -0,0 +1,91 @@
+# typing_state.py - 正在输入状态：按房间汇总，定时广播
+import time
+
+# 默认广播间隔（秒）
+DEFAULT_TYPING_INTERVAL = 0.5
+# 多久没有收到 typing 就认为停止输入（秒）
+DEFAULT_TYPING_TTL = 3.0
+
+
+class TypingAggregator:
+    """按房间记录正在输入的用户，每个间隔最多广播一次 users_typing
+
+    客户端只需要在输入时定期发送 typing，超过 ttl 没有再收到就自动过期，
+    不需要发送停止事件。广播的是房间内正在输入的完整集合，集合没有变化时不发送。
+    """
+
+    def __init__(self, socketio, interval=DEFAULT_TYPING_INTERVAL, ttl=DEFAULT_TYPING_TTL,
+                 clock=time.monotonic):
+        self.socketio = socketio
+        self.interval = interval
+        self.ttl = ttl
+        self.clock = clock
+        # {room: {user_id: (user, 过期时间)}}
+        self._typing = {}
+        # 上次广播的集合 {room: frozenset(user_id)}
+        self._sent = {}
+        # 已经有定时广播任务的房间
+        self._scheduled = set()
+
+    def update(self, room, user, is_typing=True):
+        """user 是 {'username', 'user_id'}"""
+        if is_typing:
+            self._typing.setdefault(room, {})[user['user_id']] = (user, self.clock() + self.ttl)
+        elif self._typing.get(room, {}).pop(user['user_id'], None) is None:
+            return
+        self._schedule(room)
+
+    def user_left(self, room, user):
+        """离开房间或发送消息后不再显示正在输入"""
+        self.update(room, user, False)
+
+    def typing_users(self, room):
+        """房间内没有过期的正在输入的用户"""
+        users = self._typing.get(room)
+        if not users:
+            return []
+        now = self.clock()
+        for user_id in [user_id for user_id, (user, expires) in users.items() if expires <= now]:
+            del users[user_id]
+        return [user for user, expires in users.values()]
+
+    def _schedule(self, room):
+        if self.interval <= 0:
+            self.flush(room)
+            return
+        if room not in self._scheduled:
+            self._scheduled.add(room)
+            self.socketio.start_background_task(self._flush_loop, room)
+
+    def _flush_loop(self, room):
+        # 有人在输入时每个间隔检查一次，让过期的用户按时消失
+        try:
+            while True:
+                self.socketio.sleep(self.interval)
+                if not self.flush(room):
+                    return
+        finally:
+            self._scheduled.discard(room)
+
+    def flush(self, room=None):
+        """集合有变化时广播；返回房间内是否还有人在输入"""
+        if room is None:
+            for name in list(self._typing):
+                self.flush(name)
+            return False
+        users = self.typing_users(room)
+        user_ids = frozenset(user['user_id'] for user in users)
+        if user_ids != self._sent.get(room, frozenset()):
+            if user_ids:
+                self._sent[room] = user_ids
+            else:
+                self._sent.pop(room, None)
+            # 每个进程只发给自己的客户端，其他进程的输入状态通过状态同步得到
+            self.socketio.emit('users_typing', {'users': users}, room=room, ignore_queue=True)
+        if not users:
+            self._typing.pop(room, None)
+        return bool(users)
+
+    def reset(self):
+        self._typing.clear()
+        self._sent.clear()